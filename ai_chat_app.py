@@ -1,7 +1,14 @@
 import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
 import tkinter as tk
 from tkinter import filedialog
-from llama_cpp import Llama  # Use CUDA-accelerated llama-cpp-python for GGUF models
+from backends import create_backend, create_llama, KV_CACHE_TYPES  # llama-cpp-python (CUDA-accelerated) behind a backend interface
 
 # Ask User About GPU Usage
 def ask_gpu_usage():
@@ -12,8 +19,6 @@ def ask_gpu_usage():
             return choice == "y"
         print("Invalid input. Please enter 'Y' or 'N'.")
 
-USE_GPU = ask_gpu_usage()
-
 # Prompt User to Select Model File
 def select_model_file():
     """Opens a file dialog for the user to select a .gguf model file."""
@@ -22,64 +27,372 @@ def select_model_file():
     file_path = filedialog.askopenfilename(title="Select a GGUF Model", filetypes=[("GGUF files", "*.gguf")])
     return file_path
 
-MODEL_PATH = select_model_file()
-if not MODEL_PATH:
-    print("No model selected. Exiting.")
-    exit()
-
 # Load the GGUF Model
-def load_model(model_path, use_gpu):
-    """Loads a GGUF model using CUDA-accelerated llama-cpp-python with GPU optimization."""
+def load_model(model_path, use_gpu, kv_cache_type="f16", flash_attn=False):
+    """Loads a model and returns its inference backend.
+
+    model_path is a .gguf file, or a backend spec such as "stub" or
+    "openai:http://127.0.0.1:8080/v1" (see backends.create_backend).
+    """
     try:
         n_gpu_layers = -1 if use_gpu else 0  # Enable full GPU acceleration
         n_batch = 4096 if use_gpu else 256  # Batch size for performance tuning
 
-        model = Llama(
+        model = create_backend(
             model_path,
-            n_ctx=8192,  # Increase context size
-            chat_format="chatml",
             n_gpu_layers=n_gpu_layers,
             n_batch=n_batch,
-            f16_kv=True  # Use FP16 for better VRAM efficiency
+            n_ctx=8192,  # Increase context size
+            kv_cache_type=kv_cache_type,
+            flash_attn=flash_attn
         )
+        model.load()
         return model
     except Exception as e:
         print(f"Error loading model: {e}")
         return None
 
-# Initialize Model
-model = load_model(MODEL_PATH, USE_GPU)
-
-if model is None:
-    print("Failed to load model. Exiting.")
-    exit()
-
 # System Prompt to Guide the Model
 system_prompt = "You are a friendly, conversational AI. Keep responses casual and engaging."
 
 # Chat Loop
-def chat():
+def chat(model):
     """Runs the text-based chat interface."""
     print("\nLocal AI Chat is Ready! Type 'exit' to quit.\n")
     conversation_history = [
         {"role": "system", "content": system_prompt}  # Provide system context
     ]
-    
+
     while True:
         user_input = input("You: ")
         if user_input.lower() == "exit":
             print("Exiting chat. Goodbye!")
             break
-        
+
         conversation_history.append({"role": "user", "content": user_input})
-        
+
         # Generate response
-        output = model.create_chat_completion(conversation_history, max_tokens=200)
-        response = output["choices"][0]["message"]["content"].strip()
-        
+        output = model.complete(conversation_history, max_tokens=200)
+        response = output["text"].strip()
+
         conversation_history.append({"role": "assistant", "content": response})
         print(f"AI: {response}\n")
 
+
+# ===== BATCH MODE =====
+def read_batch_items(input_path):
+    """Yields (index, item) pairs from a JSONL file of conversations, one line at a time.
+
+    Each line is either {"messages": [...]} or {"prompt": "..."}, with optional
+    "id", "max_tokens" and "temperature" overrides.
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        index = 0
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                item = {"error": f"Invalid JSON: {e}"}
+            if not isinstance(item, dict):
+                item = {"error": f"Expected a JSON object, got {type(item).__name__}"}
+            yield index, item
+            index += 1
+
+
+def build_batch_messages(item):
+    """Turns a batch item into a chat message list."""
+    if "messages" in item:
+        return item["messages"]
+    if "prompt" in item:
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": item["prompt"]}
+        ]
+    raise ValueError("Item needs either 'messages' or 'prompt'")
+
+
+def run_batch_item(model, index, item, max_tokens, temperature, seed):
+    """Runs one conversation through the model and returns its result record."""
+    result = {"index": index, "id": item.get("id", index)}
+    if "error" in item:
+        result["error"] = item["error"]
+        return result
+
+    started = time.perf_counter()
+    try:
+        output = model.complete(
+            build_batch_messages(item),
+            max_tokens=item.get("max_tokens", max_tokens),
+            temperature=item.get("temperature", temperature),
+            seed=seed
+        )
+    except Exception as e:
+        result["error"] = str(e)
+        result["latency_s"] = round(time.perf_counter() - started, 4)
+        return result
+
+    latency = time.perf_counter() - started
+    completion_tokens = output["completion_tokens"]
+    result.update({
+        "response": output["text"].strip(),
+        "finish_reason": output["finish_reason"],
+        "latency_s": round(latency, 4),
+        "prompt_tokens": output["prompt_tokens"],
+        "completion_tokens": completion_tokens,
+        "tokens_per_s": round(completion_tokens / latency, 2) if latency > 0 else None
+    })
+    return result
+
+
+def run_batch(model_path, input_path, output_path, use_gpu=False, workers=1,
+              max_tokens=200, temperature=0.0, seed=None, kv_cache_type="f16", flash_attn=False):
+    """Runs every conversation in input_path and streams results to output_path.
+
+    Each worker owns its own backend instance (a "slot"), since a single Llama
+    object can't be shared between threads. Items are read lazily and results
+    are written as soon as they complete, so memory use doesn't grow with the
+    size of the input file.
+    """
+    # Fail before spending time on loading models
+    try:
+        open(input_path, "rb").close()
+    except OSError as e:
+        print(f"Can't read batch input: {e}", file=sys.stderr)
+        return False
+    try:
+        out = sys.stdout if output_path == "-" else open(output_path, "w", encoding="utf-8")
+    except OSError as e:
+        print(f"Can't write batch output: {e}", file=sys.stderr)
+        return False
+
+    models = []
+    for _ in range(max(1, workers)):
+        model = load_model(model_path, use_gpu, kv_cache_type, flash_attn)
+        if model is None:
+            if out is not sys.stdout:
+                out.close()
+            return False
+        models.append(model)
+
+    jobs = queue.Queue(maxsize=len(models) * 2)
+    results = queue.Queue()
+    done = object()
+
+    # Every worker and the feeder post done when they stop, however they stop,
+    # so the collecting loop below always ends
+    def worker(model):
+        try:
+            while True:
+                job = jobs.get()
+                if job is done:
+                    return
+                index, item = job
+                try:
+                    results.put(run_batch_item(model, index, item, max_tokens, temperature, seed))
+                except Exception as e:
+                    results.put({"index": index, "error": str(e)})
+        finally:
+            results.put(done)
+
+    def feeder():
+        try:
+            for job in read_batch_items(input_path):
+                jobs.put(job)
+        except Exception as e:
+            results.put({"index": None, "error": f"Reading {input_path} failed: {e}"})
+        finally:
+            for _ in models:
+                jobs.put(done)
+            results.put(done)
+
+    threads = [threading.Thread(target=worker, args=(m,), daemon=True) for m in models]
+    threads.append(threading.Thread(target=feeder, daemon=True))
+    for t in threads:
+        t.start()
+
+    started = time.perf_counter()
+    finished_threads = 0
+    count = 0
+    failures = 0
+    total_completion_tokens = 0
+
+    try:
+        while finished_threads < len(models) + 1:  # the workers and the feeder
+            record = results.get()
+            if record is done:
+                finished_threads += 1
+                continue
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            count += 1
+            if "error" in record:
+                failures += 1
+            total_completion_tokens += record.get("completion_tokens", 0)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Processed {count} items ({failures} failed) in {elapsed:.1f}s "
+        f"with {len(models)} worker(s), {total_completion_tokens / elapsed if elapsed else 0:.1f} tokens/s overall",
+        file=sys.stderr
+    )
+    return failures == 0
+
+
+# ===== BENCHMARK =====
+def get_rss_mb():
+    """Resident memory of this process in MiB (None if it can't be measured)"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def benchmark_setting(model_path, use_gpu, kv_cache_type, flash_attn, prompt_tokens, gen_tokens, results):
+    """Measures one KV setting; runs in its own process so RSS isn't polluted by earlier loads."""
+    record = {"kv_cache_type": kv_cache_type, "flash_attn": flash_attn}
+    try:
+        rss_before = get_rss_mb()
+        model, used = create_llama(
+            model_path,
+            n_gpu_layers=-1 if use_gpu else 0,
+            n_batch=2048 if use_gpu else 512,
+            kv_cache_type=kv_cache_type,
+            flash_attn=flash_attn,
+            verbose=False
+        )
+        record["used"] = used
+
+        # Fill the context with a long prompt so KV pages are actually touched
+        filler = "The quick brown fox jumps over the lazy dog. "
+        tokens = model.tokenize(filler.encode("utf-8"))
+        tokens = (tokens * (prompt_tokens // max(1, len(tokens)) + 1))[:prompt_tokens]
+
+        started = time.perf_counter()
+        first_token_at = None
+        generated = 0
+        for _ in model.create_completion(tokens, max_tokens=gen_tokens, temperature=0.0, stream=True):
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            generated += 1
+        finished = time.perf_counter()
+
+        prefill_s = (first_token_at or finished) - started
+        decode_s = finished - (first_token_at or finished)
+        rss_after = get_rss_mb()
+        record.update({
+            "rss_mb": round(rss_after, 1) if rss_after is not None else None,
+            "model_rss_mb": round(rss_after - rss_before, 1) if rss_after is not None else None,
+            "prefill_tokens_per_s": round(len(tokens) / prefill_s, 2) if prefill_s > 0 else None,
+            "decode_tokens_per_s": round((generated - 1) / decode_s, 2) if generated > 1 and decode_s > 0 else None
+        })
+    except Exception as e:
+        record["error"] = str(e)
+    results.put(record)
+
+
+def run_benchmark(model_path, use_gpu=False, kv_cache_types=("f16", "q8_0", "q4_0"),
+                  prompt_tokens=2048, gen_tokens=64):
+    """Reports resident memory and tokens/sec for each KV cache type, with and without flash attention."""
+    ctx = multiprocessing.get_context("spawn")
+    for kv_cache_type in kv_cache_types:
+        for flash_attn in (False, True):
+            results = ctx.Queue()
+            proc = ctx.Process(
+                target=benchmark_setting,
+                args=(model_path, use_gpu, kv_cache_type, flash_attn, prompt_tokens, gen_tokens, results)
+            )
+            proc.start()
+            proc.join()
+            if results.empty():
+                record = {
+                    "kv_cache_type": kv_cache_type,
+                    "flash_attn": flash_attn,
+                    "error": f"benchmark process exited with code {proc.exitcode}"
+                }
+            else:
+                record = results.get()
+            print(json.dumps(record), flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local AI chat (interactive or batch mode).")
+    parser.add_argument("--model", help="Path to a .gguf model file (skips the file dialog), "
+                                        "or a backend spec: stub[:prefill=800,decode=25] or openai:<base url>")
+    parser.add_argument("--input", help="JSONL file of conversations to run in batch mode")
+    parser.add_argument("--output", default="-", help="Where to write batch results as JSONL (default: stdout)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of model instances processing items in parallel")
+    parser.add_argument("--max-tokens", type=int, default=200, help="Default max tokens per reply")
+    parser.add_argument("--temperature", type=float, default=0.0, help="Default sampling temperature for batch mode")
+    parser.add_argument("--seed", type=int, default=None, help="Sampling seed for reproducible batch runs")
+    parser.add_argument("--kv-cache-type", choices=list(KV_CACHE_TYPES), default="f16",
+                        help="KV cache element type (q8_0/q4_0 cut context memory)")
+    parser.add_argument("--flash-attn", action="store_true", help="Use flash attention (needed to quantize the V cache)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Report RSS and tokens/sec for each KV cache type and flash attention setting")
+    parser.add_argument("--bench-prompt-tokens", type=int, default=2048, help="Prompt length used by --benchmark")
+    gpu = parser.add_mutually_exclusive_group()
+    gpu.add_argument("--gpu", dest="use_gpu", action="store_true", default=None, help="Use GPU acceleration")
+    gpu.add_argument("--cpu", dest="use_gpu", action="store_false", help="Run on CPU only")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.benchmark:
+        if not args.model:
+            print("--benchmark requires --model.", file=sys.stderr)
+            return 2
+        run_benchmark(args.model, use_gpu=bool(args.use_gpu), prompt_tokens=args.bench_prompt_tokens)
+        return 0
+
+    if args.input:
+        if not args.model:
+            print("--input requires --model.", file=sys.stderr)
+            return 2
+        ok = run_batch(
+            args.model, args.input, args.output,
+            use_gpu=bool(args.use_gpu),
+            workers=args.workers,
+            max_tokens=args.max_tokens,
+            temperature=args.temperature,
+            seed=args.seed,
+            kv_cache_type=args.kv_cache_type,
+            flash_attn=args.flash_attn
+        )
+        return 0 if ok else 1
+
+    use_gpu = ask_gpu_usage() if args.use_gpu is None else args.use_gpu
+
+    model_path = args.model or select_model_file()
+    if not model_path:
+        print("No model selected. Exiting.")
+        return 1
+
+    # Initialize Model
+    model = load_model(model_path, use_gpu, args.kv_cache_type, args.flash_attn)
+    if model is None:
+        print("Failed to load model. Exiting.")
+        return 1
+
+    chat(model)
+    return 0
+
 # Start Chat
 if __name__ == "__main__":
-    chat()
+    sys.exit(main())
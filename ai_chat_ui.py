@@ -6,8 +6,18 @@ import datetime
 import tkinter as tk
 from tkinter import filedialog
 import html
+import re
+import random
 import subprocess
 import platform
+import queue
+import threading
+import itertools
+import copy
+import collections
+import time
+import zlib
+import struct
 
 from PyQt6.QtWidgets import (
     QApplication,
@@ -25,48 +35,203 @@ from PyQt6.QtWidgets import (
     QMenu,
     QStyledItemDelegate,
     QDialog,
-    QInputDialog
+    QInputDialog,
+    QComboBox,
+    QCheckBox,
+    QProgressBar,
+    QTableView,
+    QHeaderView,
+    QAbstractItemView,
+    QLineEdit,
+    QProgressDialog
 )
 
-from PyQt6.QtCore import Qt, QSize, QPropertyAnimation, QEasingCurve, QThread, pyqtSignal, QTimer, QPoint, QRect
-from PyQt6.QtGui import QPainter, QPen, QColor
-from llama_cpp import Llama
+from PyQt6.QtCore import (
+    Qt, QSize, QPropertyAnimation, QEasingCurve, QThread, QObject, pyqtSignal, QTimer, QPoint, QRect,
+    QFileSystemWatcher, QAbstractTableModel, QModelIndex
+)
+from PyQt6.QtGui import QPainter, QPen, QColor, QTextCursor, QTextDocument, QTextDocumentFragment, QTextBlockFormat
+
+from offload_planner import plan_for_model, describe_plan
+from document_store import (
+    DocumentStore, iter_chunks, build_context,
+    DOCUMENTS_DIR, EMBED_BATCH, DOCUMENT_CONTEXT_TOKENS
+)
+from chat_index import ChatIndex, CHAT_INDEX_FILE, CHAT_CONTEXT_TOKENS
+from backends import (
+    InferenceBackend, LlamaCppBackend, backend_from_env,
+    SMALL_BACKEND_ENV, KV_CACHE_TYPES, KV_CACHE_BYTES_PER_ELEMENT
+)
+from model_router import ModelRouter
+from write_ahead_log import claim_journal, WAL_CHECKPOINT_RECORDS, WAL_CHECKPOINT_IDLE_S
+from file_lock import FileLock
+from chat_export import export_chats, import_chats, parse_since, bundle_suffix
 
 
 CHAT_DIR = "chats"
 MEMORY_FILE = "memories.json"
+ARCHIVE_FILE = "archive.bin"  # compressed cold-chat container, lives inside CHAT_DIR
+ARCHIVE_INDEX_FILE = "archive_index.json"
+ARCHIVE_MAGIC = b"CHATARC1"
+ARCHIVE_AFTER_DAYS = 30  # chats untouched for this long are moved into the archive
+ARCHIVE_RETIRED_KEEP_S = 3600  # a container replaced by compaction stays readable this long for other instances
+STORE_LOCK_FILE = "store.lock"  # advisory lock for chat and memory rewrites, lives inside CHAT_DIR
+STORE_SCAN_DEBOUNCE_MS = 250  # wait for a burst of file changes to settle before looking at them
+TRANSFER_PROGRESS_INTERVAL_S = 0.1  # export/import progress updates sent to the GUI at most this often
+MEMORY_SIMILARITY_THRESHOLD = 0.75  # Jaccard similarity above which two memories are duplicates
+MEMORY_CONSOLIDATION_IDLE_MS = 30000  # run consolidation after this much idle time
+
+MODEL_CONTEXT_TOKENS = 8192  # n_ctx every model is loaded with
+REPLY_MAX_TOKENS = 1024  # longer than the free context is fine: the oldest turns are shifted out (see backends.py)
+CHATML_MESSAGE_OVERHEAD = 4  # <|im_start|>role\n ... <|im_end|>\n around every message
+TOKEN_COUNT_DEBOUNCE_MS = 300
+TOKEN_CACHE_LINES = 20000  # per-line token counts kept by TokenCounter
+
+IDLE_DELAY_MS = 2000  # quiet time before the idle scheduler starts precomputing
+IDLE_WARM_CHATS = 2  # recent chats whose KV is warmed besides the open one
+
+# InferenceExecutor job priorities (lower runs first)
+PRIORITY_MODEL_SWAP = -1  # model swaps and the stop request go ahead of every job
+PRIORITY_INTERACTIVE = 0
+PRIORITY_EXTRACTION = 10
+PRIORITY_BACKGROUND = 20
+
+RENDER_CACHE_SIZE = 2048  # rendered message fragments kept by MessageRenderer
+TRANSCRIPT_MAX_BLOCKS = 3000  # text blocks kept live in the chat display before older ones are evicted
+TRANSCRIPT_PAGE_MESSAGES = 40  # messages rendered on open, and rehydrated per scroll to the top
+CANDIDATE_COUNT = 3  # replies drafted at once by "Alternatives"
+
+# Installed once as the chat document's default stylesheet, so each message
+# only carries class names instead of repeating its inline styles
+MESSAGE_CSS = """
+.msg { margin: 6px 0; }
+.meta { font-size: 0.5px; color: #202d4f; margin-bottom: 0.5px; }
+.user { background: rgba(42, 90, 223, 0.25); color: white; padding: 7px 10px; }
+.assistant { background: rgba(255, 255, 255, 0.04); color: #eee; padding: 7px 10px; }
+.user-name { color: #dbe6ff; font-weight: bold; }
+.assistant-name { color: #7fb3ff; font-weight: bold; }
+.separator { margin: 4px 0; }
+.system { color: #aaa; font-style: italic; font-size: 11px; }
+"""
 SYSTEM_PROMPT = "You are a friendly, conversational AI. Keep responses casual and engaging."
 
+# JSON schema the memory extractor's output is constrained to
+MEMORY_EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "memories": {
+            "type": "array",
+            "items": {"type": "string"},
+            "maxItems": 5
+        }
+    },
+    "required": ["memories"],
+    "additionalProperties": False
+}
+
 
 def load_stylesheet(qss_file):
     with open(qss_file, "r") as file:
         return file.read()
 
 
+def file_stamp(path: str):
+    """(mtime, size) of a file, or None if it doesn't exist; a cheap "has it changed" check"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def write_json_atomic(path: str, data, **dump_args):
+    """Write JSON to a temp file, fsync it and swap it in, so a crash leaves the old or the new file"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, **dump_args)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
 class MemoryManager:
     """Manages persistent memories across all chats"""
     def __init__(self, memory_file=MEMORY_FILE):
         self.memory_file = memory_file
+        self.file_stamp = None  # of the file as last read or written here
         self.memories = self.load_memories()
+        self.writer = None  # optional callable taking (snapshot, change), e.g. ChatStoreWorker.save_memories
     
     def load_memories(self):
         """Load memories from file"""
-        if os.path.exists(self.memory_file):
-            try:
-                with open(self.memory_file, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Error loading memories: {e}")
-                return []
-        return []
+        try:
+            return self.read_memories()
+        except Exception as e:
+            print(f"Error loading memories: {e}")
+            return []
+
+    def read_memories(self) -> list:
+        """Read the memory file ([] if there is none); raises if it can't be parsed"""
+        stamp = file_stamp(self.memory_file)
+        if stamp is None:
+            self.file_stamp = None
+            return []
+        with open(self.memory_file, "r", encoding="utf-8") as f:
+            memories = json.load(f)
+        self.file_stamp = stamp
+        return memories
     
-    def save_memories(self):
-        """Save memories to file"""
+    def save_memories(self, change: dict = None):
+        """Save memories to file (through the writer, if one is attached).
+
+        change describes the mutation for the writer's journal, e.g.
+        {"op": "memory_delete", "ids": [...]}; without one the whole list is logged.
+        """
+        if self.writer is not None:
+            self.writer([dict(m) for m in self.memories], change)
+        else:
+            self.write_memories(self.memories)
+
+    def write_memories(self, memories: list):
+        """Write a list of memories to disk"""
         try:
-            with open(self.memory_file, "w", encoding="utf-8") as f:
-                json.dump(self.memories, f, ensure_ascii=False, indent=2)
+            write_json_atomic(self.memory_file, memories, indent=2)
+            self.file_stamp = file_stamp(self.memory_file)
         except Exception as e:
             print(f"Error saving memories: {e}")
+            return False
+        return True
+
+    def reload_if_changed(self):
+        """The memory list on disk if someone else rewrote it since we last looked, else None"""
+        if file_stamp(self.memory_file) == self.file_stamp:
+            return None
+        try:
+            return self.read_memories()
+        except Exception as e:
+            print(f"Could not read changed memories: {e}")
+            return None
+
+    @staticmethod
+    def apply_change(memories: list, change: dict) -> list:
+        """Replay one journaled change onto a memory list"""
+        op = change["op"]
+        if op == "memory_add":
+            return [m for m in memories if m["id"] != change["memory"]["id"]] + [change["memory"]]
+        if op == "memory_delete":
+            ids = set(change["ids"])
+            return [m for m in memories if m["id"] not in ids]
+        if op == "memory_update":
+            for mem in memories:
+                if mem["id"] == change["id"]:
+                    mem["content"] = change["content"]
+            return memories
+        if op == "memory_updates":
+            for mem in memories:
+                if mem["id"] in change["contents"]:
+                    mem["content"] = change["contents"][mem["id"]]
+            return memories
+        return change["memories"]
     
     def add_memory(self, content: str, source: str = "user"):
         """Add a new memory"""
@@ -77,13 +242,18 @@ class MemoryManager:
             "source": source
         }
         self.memories.append(memory)
-        self.save_memories()
+        self.save_memories({"op": "memory_add", "memory": dict(memory)})
         return memory
     
     def delete_memory(self, memory_id: str):
         """Delete a memory by ID"""
-        self.memories = [m for m in self.memories if m["id"] != memory_id]
-        self.save_memories()
+        self.delete_memories([memory_id])
+
+    def delete_memories(self, memory_ids: list):
+        """Delete several memories with a single save"""
+        drop_ids = set(memory_ids)
+        self.memories = [m for m in self.memories if m["id"] not in drop_ids]
+        self.save_memories({"op": "memory_delete", "ids": sorted(drop_ids)})
     
     def update_memory(self, memory_id: str, new_content: str):
         """Update the content of an existing memory"""
@@ -94,8 +264,18 @@ class MemoryManager:
                 changed = True
                 break
         if changed:
-            self.save_memories()
+            self.save_memories({"op": "memory_update", "id": memory_id, "content": new_content.strip()})
         return changed
+
+    def update_memories(self, contents: dict):
+        """Replace the content of several memories (id -> new text) with a single save"""
+        contents = {memory_id: text.strip() for memory_id, text in contents.items()}
+        changed = [mem for mem in self.memories if mem["id"] in contents and mem["content"] != contents[mem["id"]]]
+        for mem in changed:
+            mem["content"] = contents[mem["id"]]
+        if changed:
+            self.save_memories({"op": "memory_updates", "contents": {mem["id"]: mem["content"] for mem in changed}})
+        return [mem["id"] for mem in changed]
     
     def get_all_memories(self):
         """Get all memories"""
@@ -113,27 +293,174 @@ class MemoryManager:
         memory_text += "=== END OF MEMORIES ===\n"
         return memory_text
 
+    def apply_consolidation(self, plans: list):
+        """Drop memories superseded by a consolidation pass, with a single save"""
+        drop_ids = {mem_id for plan in plans for mem_id in plan["drop"]}
+        if not drop_ids:
+            return 0
+        before = len(self.memories)
+        self.memories = [m for m in self.memories if m["id"] not in drop_ids]
+        removed = before - len(self.memories)
+        if removed:
+            self.save_memories({"op": "memory_delete", "ids": sorted(drop_ids)})
+        return removed
+
+
+class MemoryConsolidator:
+    """Finds near-duplicate memories using MinHash signatures and LSH buckets.
+
+    The index survives between passes, so each pass only compares memories
+    added (or edited) since the previous one against their LSH candidates.
+    """
+    MERSENNE_PRIME = (1 << 61) - 1
+
+    def __init__(self, threshold: float = MEMORY_SIMILARITY_THRESHOLD, num_perm: int = 32, bands: int = 16):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(1234)
+        self.permutations = [
+            (rng.randrange(1, self.MERSENNE_PRIME), rng.randrange(0, self.MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+        self.indexed = {}  # memory id -> (content, token set, band keys)
+        self.buckets = {}  # band key -> set of memory ids
+
+    @staticmethod
+    def tokenize(text: str) -> set:
+        return set(re.findall(r"[a-z0-9']+", text.lower()))
+
+    def band_keys(self, tokens: set) -> list:
+        hashes = [zlib.crc32(t.encode("utf-8")) for t in tokens] or [0]
+        signature = [
+            min((a * h + b) % self.MERSENNE_PRIME for h in hashes)
+            for a, b in self.permutations
+        ]
+        return [
+            (band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def similarity(self, a: set, b: set) -> float:
+        if not a or not b:
+            return 0.0
+        small, large = (a, b) if len(a) <= len(b) else (b, a)
+        # A short fact fully contained in a longer one adds nothing on its own
+        if len(small) >= 3 and small <= large:
+            return 1.0
+        return len(a & b) / len(a | b)
+
+    def _add(self, mem_id: str, content: str, tokens: set):
+        keys = self.band_keys(tokens)
+        self.indexed[mem_id] = (content, tokens, keys)
+        for key in keys:
+            self.buckets.setdefault(key, set()).add(mem_id)
+
+    def _remove(self, mem_id: str):
+        _, _, keys = self.indexed.pop(mem_id)
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(mem_id)
+                if not bucket:
+                    del self.buckets[key]
+
+    @staticmethod
+    def _rank(mem: dict, tokens: set):
+        # Prefer what the user wrote themselves, then the most informative, then the newest
+        return (mem.get("source") == "user", len(tokens), mem.get("created_at", ""))
+
+    def find_duplicates(self, memories: list) -> list:
+        """Return [{"keep": id, "drop": [ids]}] plans for memories not yet consolidated"""
+        current = {m["id"]: m for m in memories}
+
+        # Forget memories that were deleted or edited since the last pass
+        for mem_id in list(self.indexed):
+            mem = current.get(mem_id)
+            if mem is None or mem["content"] != self.indexed[mem_id][0]:
+                self._remove(mem_id)
+
+        plans = []
+        for mem in memories:
+            if mem["id"] in self.indexed:
+                continue
+            tokens = self.tokenize(mem["content"])
+            candidates = set()
+            for key in self.band_keys(tokens):
+                candidates |= self.buckets.get(key, set())
+
+            duplicates = [
+                cid for cid in candidates
+                if self.similarity(tokens, self.indexed[cid][1]) >= self.threshold
+            ]
+            if duplicates:
+                group = [(current[cid], self.indexed[cid][1]) for cid in duplicates]
+                group.append((mem, tokens))
+                keep = max(group, key=lambda g: self._rank(*g))[0]
+                drop = [m["id"] for m, _ in group if m is not keep]
+                plans.append({"keep": keep["id"], "drop": drop})
+                for mem_id in drop:
+                    if mem_id in self.indexed:
+                        self._remove(mem_id)
+                if keep is not mem:
+                    continue
+
+            self._add(mem["id"], mem["content"], tokens)
+        return plans
+
 
 class ChatManager:
     def __init__(self, chat_dir=CHAT_DIR):
         self.chat_dir = chat_dir
         os.makedirs(self.chat_dir, exist_ok=True)
+        self.archive_container = ARCHIVE_FILE
+        self.archive_retired = {}  # container replaced by a compaction -> when, until it is deleted
+        self.archive_stamp = None
+        self.archive_index = self._load_archive_index()
+        self.chat_index = ChatIndex(os.path.join(self.chat_dir, CHAT_INDEX_FILE))
+        # Other instances (or sync tools) may write the same folder: writers take this lock,
+        # and file_stamps (chat id -> stamp as last read or written here) tells their writes from ours
+        self.lock = FileLock(os.path.join(self.chat_dir, STORE_LOCK_FILE))
+        self.file_stamps = {}
 
     def _chat_path(self, chat_id: str) -> str:
         return os.path.join(self.chat_dir, f"{chat_id}.json")
 
+    def _archive_path(self) -> str:
+        return os.path.join(self.chat_dir, self.archive_container)
+
+    def _archive_index_path(self) -> str:
+        return os.path.join(self.chat_dir, ARCHIVE_INDEX_FILE)
+
     def list_chats(self):
         chats = []
+        seen = set()
         for fname in os.listdir(self.chat_dir):
-            if not fname.endswith(".json"):
+            if not fname.endswith(".json") or fname == ARCHIVE_INDEX_FILE:
                 continue
             fpath = os.path.join(self.chat_dir, fname)
             try:
+                stamp = file_stamp(fpath)
                 with open(fpath, "r", encoding="utf-8") as f:
                     data = json.load(f)
                 chats.append(data)
-            except Exception:
+                seen.add(data.get("id"))
+                self.file_stamps[fname[:-5]] = stamp
+            except Exception as e:
+                # Chats are written atomically, so this is damage from outside the app; say so
+                print(f"Skipping unreadable chat file {fname}: {e}")
+
+        # Archived chats are listed from the index, without decompressing them
+        for chat_id, entry in self.archive_index.items():
+            if chat_id in seen:
                 continue
+            chats.append({
+                "id": chat_id,
+                "title": entry.get("title", "Untitled chat"),
+                "created_at": entry.get("created_at", ""),
+                "archived": True
+            })
+
         chats.sort(key=lambda x: x.get("created_at", ""), reverse=True)
         return chats
 
@@ -155,22 +482,130 @@ class ChatManager:
 
     def save_chat(self, chat_data: dict):
         chat_id = chat_data["id"]
-        with open(self._chat_path(chat_id), "w", encoding="utf-8") as f:
-            json.dump(chat_data, f, ensure_ascii=False, indent=2)
+        path = self._chat_path(chat_id)
+        self.sync_tree(chat_data)
+        with self.lock:
+            stamp = file_stamp(path)
+            if stamp is not None and stamp != self.file_stamps.get(chat_id):
+                # Someone else wrote this chat since we read it; keep their messages as branches
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        theirs = json.load(f)
+                    for node_id, node in theirs.get("nodes", {}).items():
+                        chat_data["nodes"].setdefault(node_id, node)
+                except Exception as e:
+                    print(f"Error merging chat {chat_id} with its copy on disk: {e}")
+            # Only the tree is written; the flat message list is rebuilt from head on load
+            data = {key: value for key, value in chat_data.items() if key != "messages"}
+            write_json_atomic(path, data, indent=2)
+            self.file_stamps[chat_id] = file_stamp(path)
+
+            # A chat that is written again is hot; the JSON file now supersedes its archived copy
+            self._refresh_archive_index()
+            if chat_id in self.archive_index:
+                del self.archive_index[chat_id]
+                self._save_archive_index()
+
+        try:
+            self.chat_index.index_chat(chat_data)
+        except Exception as e:
+            print(f"Error indexing chat: {e}")
 
     def load_chat(self, chat_id: str):
-        with open(self._chat_path(chat_id), "r", encoding="utf-8") as f:
-            return json.load(f)
+        path = self._chat_path(chat_id)
+        if not os.path.exists(path) and chat_id in self.archive_index:
+            return self._from_disk(self._read_archived_chat(chat_id))
+        stamp = file_stamp(path)
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.file_stamps[chat_id] = stamp
+        return self._from_disk(data)
     
     def delete_chat(self, chat_id: str):
         """Delete a chat file"""
         try:
-            os.remove(self._chat_path(chat_id))
+            path = self._chat_path(chat_id)
+            with self.lock:
+                self._refresh_archive_index()
+                archived = chat_id in self.archive_index
+                if archived:
+                    del self.archive_index[chat_id]
+                    self._save_archive_index()
+                if os.path.exists(path) or not archived:
+                    os.remove(path)
+            self.file_stamps.pop(chat_id, None)
+            self.chat_index.remove_chat(chat_id)
             return True
         except Exception as e:
             print(f"Error deleting chat: {e}")
             return False
         
+    def scan_changes(self, full_ids=()) -> dict:
+        """Chats that someone else added, rewrote or removed since this instance last looked.
+
+        Only files whose stamp changed are read. The chat index is updated to
+        match. Returns {"changed": [chat dicts], "removed": [chat ids]}; only
+        chats in full_ids come back whole, the rest as sidebar entries (id,
+        title, created_at), so a bulk import doesn't pile every chat up here.
+        """
+        self._refresh_archive_index()
+        on_disk = {}
+        for entry in os.scandir(self.chat_dir):
+            if entry.name.endswith(".json") and entry.name != ARCHIVE_INDEX_FILE:
+                st = entry.stat()
+                on_disk[entry.name[:-5]] = (st.st_mtime_ns, st.st_size)
+
+        changed = []
+        for chat_id, stamp in on_disk.items():
+            if self.file_stamps.get(chat_id) == stamp:
+                continue
+            try:
+                chat = self.load_chat(chat_id)
+            except Exception as e:
+                # Probably caught mid-write by a tool that doesn't replace files atomically; the next event retries
+                print(f"Could not read changed chat {chat_id}: {e}")
+                continue
+            self.chat_index.index_chat(chat)
+            if chat_id not in full_ids:
+                chat = {key: chat.get(key, "") for key in ("id", "title", "created_at")}
+            changed.append(chat)
+
+        removed = []
+        for chat_id in [chat_id for chat_id in self.file_stamps if chat_id not in on_disk]:
+            del self.file_stamps[chat_id]
+            entry = self.archive_index.get(chat_id)
+            if entry is not None:
+                changed.append({"id": chat_id, "title": entry.get("title", "Untitled chat"),
+                                "created_at": entry.get("created_at", ""), "archived": True})
+            else:
+                self.chat_index.remove_chat(chat_id)
+                removed.append(chat_id)
+        return {"changed": changed, "removed": removed}
+
+    def chat_ids(self) -> list:
+        """Ids of every stored chat, archived ones included, without reading any of them"""
+        chat_ids = [fname[:-5] for fname in os.listdir(self.chat_dir)
+                    if fname.endswith(".json") and fname != ARCHIVE_INDEX_FILE]
+        on_disk = set(chat_ids)
+        return chat_ids + [chat_id for chat_id in self.archive_index if chat_id not in on_disk]
+
+    def chat_mtime(self, chat_id: str):
+        """When the chat's file was last written (None for archived chats)"""
+        try:
+            return os.path.getmtime(self._chat_path(chat_id))
+        except FileNotFoundError:
+            return None
+
+    def index_all_chats(self):
+        """Fill a fresh chat index from the chats already on disk (archived chats included)"""
+        indexed = 0
+        for chat_id in self.chat_ids():
+            try:
+                indexed += self.chat_index.index_chat(self.load_chat(chat_id))
+            except Exception as e:
+                print(f"Error indexing chat {chat_id}: {e}")
+        return indexed
+
     def rename_chat(self, chat_id: str, new_title: str):
         """Rename a chat (update its title and lock it so auto-title won't override)."""
         try:
@@ -183,10 +618,254 @@ class ChatManager:
             print(f"Error renaming chat: {e}")
             return False
 
-    
+    # ===== BRANCHES =====
+    # A chat is stored as a message tree: "nodes" maps message id -> {parent,
+    # role, content, created_at} and "head" is the leaf of the active branch.
+    # Regenerated replies and edited messages become siblings, so branches share
+    # their common-prefix nodes instead of copying the whole conversation. In
+    # memory the active branch is also kept as the flat "messages" list.
+
+    @staticmethod
+    def sync_tree(chat_data: dict):
+        """Record the active branch ("messages") in the node tree and point head at its leaf"""
+        nodes = chat_data.setdefault("nodes", {})
+        parent = None
+        for msg in chat_data.get("messages", []):
+            if msg["role"] == "separator":
+                continue
+            msg_id = msg.setdefault("id", str(uuid.uuid4()))
+            node = {"parent": parent, "role": msg["role"], "content": msg["content"]}
+            if msg.get("created_at"):
+                node["created_at"] = msg["created_at"]
+            nodes[msg_id] = node
+            parent = msg_id
+        chat_data["head"] = parent
+
+    @staticmethod
+    def branch_messages(nodes: dict, head: str | None) -> list:
+        """Rebuild the flat message list of the branch that ends at head"""
+        path = []
+        node_id = head
+        while node_id is not None and node_id in nodes and len(path) <= len(nodes):
+            path.append(node_id)
+            node_id = nodes[node_id].get("parent")
+
+        messages = []
+        for node_id in reversed(path):
+            node = nodes[node_id]
+            msg = {"id": node_id, "role": node["role"], "content": node["content"]}
+            if node.get("created_at"):
+                msg["created_at"] = node["created_at"]
+            messages.append(msg)
+            if node["role"] == "assistant":
+                messages.append({"role": "separator", "content": ""})
+        return messages
+
+    @staticmethod
+    def branch_leaves(chat_data: dict) -> list:
+        """Ids of every branch tip (nodes without children), oldest first"""
+        nodes = chat_data.get("nodes", {})
+        parents = {node.get("parent") for node in nodes.values()}
+        leaves = [node_id for node_id in nodes if node_id not in parents]
+        leaves.sort(key=lambda node_id: nodes[node_id].get("created_at") or "")
+        return leaves
+
+    @staticmethod
+    def add_branch(chat_data: dict, parent_id: str, msg: dict):
+        """Store msg as another child of parent_id without making it the active branch"""
+        node = {"parent": parent_id, "role": msg["role"], "content": msg["content"]}
+        if msg.get("created_at"):
+            node["created_at"] = msg["created_at"]
+        chat_data.setdefault("nodes", {})[msg["id"]] = node
+
+    def switch_branch(self, chat_data: dict, head: str):
+        """Make the branch ending at head the active one"""
+        self.sync_tree(chat_data)
+        chat_data["head"] = head
+        chat_data["messages"] = self.branch_messages(chat_data["nodes"], head)
+
+    def _from_disk(self, data: dict) -> dict:
+        if "nodes" in data:
+            data["messages"] = self.branch_messages(data["nodes"], data.get("head"))
+        else:
+            # Chats saved before branching have a flat message list: it becomes the only branch
+            self.sync_tree(data)
+        return data
+
+    # ===== ARCHIVE =====
+    # Cold chats are stored as zlib-compressed compact JSON frames appended to a
+    # single container file. The index maps chat id -> (offset, length) plus the
+    # title/created_at the sidebar needs, so a chat can be read with one seek.
+    # The index also names the current container file, so compaction can write
+    # a new container and switch over with a single atomic index replace. The
+    # old container is kept (listed as retired) for ARCHIVE_RETIRED_KEEP_S, so
+    # another instance still reading the old index finds its frames. The index
+    # is only changed under the store lock, after reloading it if it changed.
+
+    def _load_archive_index(self) -> dict:
+        path = self._archive_index_path()
+        if not os.path.exists(path):
+            return {}
+        try:
+            stamp = file_stamp(path)
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.archive_stamp = stamp
+            self.archive_container = data.get("container", ARCHIVE_FILE)
+            self.archive_retired = data.get("retired", {})
+            return data.get("chats", {})
+        except Exception as e:
+            print(f"Error loading archive index: {e}")
+            return {}
+
+    def _save_archive_index(self):
+        path = self._archive_index_path()
+        tmp_path = path + ".tmp"
+        data = {"container": self.archive_container, "chats": self.archive_index, "retired": self.archive_retired}
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+        self.archive_stamp = file_stamp(path)
+
+    def _refresh_archive_index(self):
+        """Reload the index if another instance rewrote it since this one last read or wrote it"""
+        if file_stamp(self._archive_index_path()) != self.archive_stamp:
+            self.archive_index = self._load_archive_index()
+
+    def _read_archived_chat(self, chat_id: str) -> dict:
+        try:
+            f = open(self._archive_path(), "rb")
+        except FileNotFoundError:
+            # Another instance compacted the archive long ago and the old container is gone
+            self._refresh_archive_index()
+            f = open(self._archive_path(), "rb")
+        entry = self.archive_index[chat_id]
+        with f:
+            f.seek(entry["offset"])
+            frame = f.read(entry["length"])
+        return json.loads(zlib.decompress(frame).decode("utf-8"))
+
+    def _append_archive_frames(self, frames: list) -> list:
+        """Append (chat_id, bytes) frames to the container and return their (offset, length)."""
+        path = self._archive_path()
+        locations = []
+        with open(path, "ab") as f:
+            if f.tell() == 0:
+                f.write(ARCHIVE_MAGIC)
+            for _, frame in frames:
+                offset = f.tell()
+                f.write(struct.pack(">I", len(frame)))
+                f.write(frame)
+                locations.append((offset + 4, len(frame)))
+            f.flush()
+            os.fsync(f.fileno())
+        return locations
+
+    def archive_stale_chats(self, max_age_days: int = ARCHIVE_AFTER_DAYS, exclude=()):
+        """Move chats whose files haven't been modified in max_age_days into the archive."""
+        with self.lock:
+            self._refresh_archive_index()
+            cutoff = time.time() - max_age_days * 86400
+            frames = []
+            stale_paths = []
+            for fname in os.listdir(self.chat_dir):
+                if not fname.endswith(".json") or fname == ARCHIVE_INDEX_FILE:
+                    continue
+                fpath = os.path.join(self.chat_dir, fname)
+                try:
+                    if os.path.getmtime(fpath) > cutoff:
+                        continue
+                    with open(fpath, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except Exception:
+                    continue
+                if data.get("id") in exclude:
+                    continue
+                raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                frames.append((data, zlib.compress(raw, 9)))
+                stale_paths.append(fpath)
+
+            if frames:
+                try:
+                    locations = self._append_archive_frames(frames)
+                    for (data, _), (offset, length) in zip(frames, locations):
+                        self.archive_index[data["id"]] = {
+                            "offset": offset,
+                            "length": length,
+                            "title": data.get("title", "Untitled chat"),
+                            "created_at": data.get("created_at", "")
+                        }
+                    self._save_archive_index()
+                except Exception as e:
+                    print(f"Error archiving chats: {e}")
+                    return 0
+
+                # Only drop the JSON files once the archive and its index are durable
+                for fpath in stale_paths:
+                    try:
+                        os.remove(fpath)
+                        self.file_stamps.pop(os.path.basename(fpath)[:-5], None)
+                    except Exception as e:
+                        print(f"Error removing archived chat file: {e}")
+
+            self.compact_archive()
+        return len(frames)
+
+    def compact_archive(self, min_waste_bytes: int = 1024 * 1024):
+        """Rewrite the container without frames that were deleted or un-archived."""
+        with self.lock:
+            self._refresh_archive_index()
+            self._remove_retired_containers()
+            path = self._archive_path()
+            if not os.path.exists(path):
+                return
+            live_bytes = sum(e["length"] + 4 for e in self.archive_index.values()) + len(ARCHIVE_MAGIC)
+            waste = os.path.getsize(path) - live_bytes
+            if waste < min_waste_bytes or waste < live_bytes:
+                return
+
+            new_container = f"archive-{uuid.uuid4().hex[:8]}.bin"
+            new_path = os.path.join(self.chat_dir, new_container)
+            new_index = {}
+            with open(path, "rb") as src, open(new_path, "wb") as dst:
+                dst.write(ARCHIVE_MAGIC)
+                for chat_id, entry in self.archive_index.items():
+                    src.seek(entry["offset"])
+                    frame = src.read(entry["length"])
+                    offset = dst.tell()
+                    dst.write(struct.pack(">I", len(frame)))
+                    dst.write(frame)
+                    new_index[chat_id] = dict(entry, offset=offset + 4)
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            # Other instances may still read the old container through the index they have loaded
+            self.archive_retired[self.archive_container] = time.time()
+            self.archive_container = new_container
+            self.archive_index = new_index
+            self._save_archive_index()
+
+    def _remove_retired_containers(self):
+        """Delete containers replaced long enough ago that every instance has moved on; call with the lock held"""
+        cutoff = time.time() - ARCHIVE_RETIRED_KEEP_S
+        expired = [name for name, retired_at in self.archive_retired.items() if retired_at < cutoff]
+        for name in expired:
+            try:
+                os.remove(os.path.join(self.chat_dir, name))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"Error removing old archive container: {e}")
+                continue  # tried again after the next compaction check
+            del self.archive_retired[name]
+        if expired:
+            self._save_archive_index()
+
     def open_chat_location(self, chat_id: str):
-        """Open file explorer to the chat's directory"""
+        """Open file explorer to the chat's file, or to the archive container holding it"""
         file_path = self._chat_path(chat_id)
+        if not os.path.exists(file_path) and chat_id in self.archive_index:
+            file_path = self._archive_path()
         folder_path = os.path.dirname(os.path.abspath(file_path))
         
         try:
@@ -289,64 +968,632 @@ class ChatListWidget(QListWidget):
             super().mousePressEvent(event)
 
 
-class AIWorkerThread(QThread):
-    """Background thread for AI model inference"""
-    finished = pyqtSignal(str)
-    error = pyqtSignal(str)
-    
-    def __init__(self, model, messages):
+class ChatStoreWorker(QThread):
+    """Owns chat and memory disk I/O so slow or network disks never stall the GUI thread.
+
+    Every change is appended to a write-ahead log right away (on the calling
+    thread; it's one small buffered write), and only the latest snapshot per
+    chat id (and of the memory list) is kept for the JSON files. Those full
+    rewrites are deferred to a checkpoint: when the log gets long, after a
+    quiet spell, before any queued task that may touch the files (renames,
+    deletes...), and on flush()/stop(). Chat loads and the chat list read
+    through the pending snapshots, so they don't force a rewrite.
+    recover() replays whatever the log holds after a crash.
+
+    Another instance may share the folder. Checkpoints hold the store lock
+    and merge instead of overwriting: memory changes are replayed onto the
+    current memory file (memories_synced carries the result), and chat
+    messages written elsewhere are kept as branches.
+    """
+    task_finished = pyqtSignal(object, object)  # callback, result
+    task_failed = pyqtSignal(object, str)  # callback, error message
+    memories_synced = pyqtSignal(list)  # the memory file as just read or merged
+
+    def __init__(self, chat_manager: ChatManager, memory_manager: MemoryManager):
         super().__init__()
-        self.model = model
-        self.messages = messages
-    
-    def run(self):
+        self.chat_manager = chat_manager
+        self.memory_manager = memory_manager
+        self.wal = claim_journal(chat_manager.chat_dir)
+        self._cond = threading.Condition()
+        self._pending_chats = {}
+        self._pending_memories = []  # logged memory changes not yet merged into the file
+        self._writing_memories = []  # ...and those a checkpoint is merging right now
+        self._logged_chats = {}  # chat id -> last snapshot in the log, to log only what changed
+        self._tasks = collections.deque()
+        self._reads = collections.deque()
+        self._flush_requested = False
+        self._busy = False
+        self._stopping = False
+
+        # This object lives on the GUI thread, so these run callbacks there
+        self.task_finished.connect(self._deliver)
+        self.task_failed.connect(self._deliver)
+
+    def _deliver(self, callback, result):
+        if callback is not None:
+            callback(result)
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending_chats or self._pending_memories)
+
+    def _has_work(self) -> bool:
+        return bool(self._tasks or self._reads or (self._has_pending() and (
+            self._flush_requested or self._stopping or self.wal.records >= WAL_CHECKPOINT_RECORDS)))
+
+    def recover(self) -> int:
+        """Replay the log left by a crash into the chat and memory files; call before start()"""
+        records = self.wal.replay()
+        if not records:
+            return 0
+        chats = {}
+        memory_changes = []
+        for record in records:
+            op = record["op"]
+            if op == "chat":
+                chat = chats.get(record["id"])
+                if chat is None or record.get("full"):
+                    chat = {"id": record["id"], "nodes": {}}
+                    if not record.get("full"):
+                        try:
+                            chat = self.chat_manager.load_chat(record["id"])
+                        except Exception as e:
+                            print(f"Recovering chat {record['id']} from the log alone: {e}")
+                    chats[record["id"]] = chat
+                chat.update(record["fields"])
+                for key in record.get("removed", ()):
+                    chat.pop(key, None)
+                chat.setdefault("nodes", {}).update(record["nodes"])
+                chat["head"] = record["head"]
+            elif op == "drop_chat":
+                chats[record["id"]] = None
+            else:
+                memory_changes.append(record)
+
+        self.wal.begin_checkpoint()
+        with self.chat_manager.lock:
+            ok = True
+            for chat_id, chat in chats.items():
+                try:
+                    if chat is None:
+                        self.chat_manager.delete_chat(chat_id)
+                    else:
+                        chat["messages"] = self.chat_manager.branch_messages(chat["nodes"], chat.get("head"))
+                        self.chat_manager.save_chat(chat)
+                except Exception as e:
+                    print(f"Error recovering chat {chat_id}: {e}")
+                    ok = False
+            if memory_changes:
+                memories = self._merge_memories(memory_changes)
+                if memories is None:
+                    ok = False
+                else:
+                    self.memory_manager.memories = memories
+        if ok:
+            self.wal.end_checkpoint()
+        print(f"Recovered {len(records)} logged changes ({len(chats)} chats)")
+        return len(records)
+
+    def _chat_record(self, snapshot: dict) -> dict:
+        """Log record with what changed since the chat was last logged"""
+        previous = self._logged_chats.get(snapshot["id"])
+        fields = {key: value for key, value in snapshot.items() if key not in ("messages", "nodes", "head")}
+        nodes = snapshot.get("nodes", {})
+        if previous is None:
+            return {"op": "chat", "id": snapshot["id"], "full": True,
+                    "fields": fields, "nodes": nodes, "head": snapshot.get("head")}
+        old_nodes = previous.get("nodes", {})
+        return {
+            "op": "chat",
+            "id": snapshot["id"],
+            "fields": {key: value for key, value in fields.items() if previous.get(key) != value},
+            "removed": [key for key in previous if key not in snapshot],  # e.g. "lora" once the adapter is cleared
+            "nodes": {node_id: node for node_id, node in nodes.items() if old_nodes.get(node_id) != node},
+            "head": snapshot.get("head")
+        }
+
+    def save_chat(self, chat_data: dict):
+        """Log the chat's changes and queue a snapshot; a later save of the same chat replaces it"""
+        # Fold new messages into the live tree first, so branching never loses nodes
+        self.chat_manager.sync_tree(chat_data)
+        snapshot = copy.deepcopy(chat_data)
+        with self._cond:
+            self.wal.append(self._chat_record(snapshot))
+            self._logged_chats[snapshot["id"]] = snapshot
+            self._pending_chats[snapshot["id"]] = snapshot
+            self._cond.notify_all()
+
+    def discard_chat(self, chat_id: str):
+        """Drop a queued write, e.g. before the chat is deleted"""
+        with self._cond:
+            if self._pending_chats.pop(chat_id, None) is not None or chat_id in self._logged_chats:
+                # Replaying earlier records must not bring the chat back
+                self.wal.append({"op": "drop_chat", "id": chat_id})
+            self._logged_chats.pop(chat_id, None)
+
+    def save_memories(self, memories: list, change: dict = None):
+        change = change or {"op": "memories", "memories": memories}
+        with self._cond:
+            self.wal.append(change)
+            self._pending_memories.append(change)
+            self._cond.notify_all()
+
+    def unwritten_memory_changes(self) -> list:
+        """Memory changes made here that the memory file doesn't have yet, oldest first"""
+        with self._cond:
+            return self._writing_memories + self._pending_memories
+
+    def _merge_memories(self, changes: list):
+        """Replay changes onto the memory file as it is now and write it back (store lock held)"""
         try:
-            output = self.model.create_chat_completion(
-                self.messages,
-                max_tokens=200
-            )
-            response = output["choices"][0]["message"]["content"].strip()
-            self.finished.emit(response)
+            memories = self.memory_manager.read_memories()
         except Exception as e:
-            self.error.emit(str(e))
+            print(f"Error reading memories to merge: {e}")
+            return None
+        for change in changes:
+            memories = self.memory_manager.apply_change(memories, change)
+        if not self.memory_manager.write_memories(memories):
+            return None
+        return memories
+
+    def _scan_changes(self, full_ids) -> dict:
+        changes = self.chat_manager.scan_changes(full_ids)
+        memories = self.memory_manager.reload_if_changed()
+        if memories is not None:
+            self.memories_synced.emit(memories)
+        return changes
+
+    def request_changes(self, on_done, full_ids=()):
+        """Look for files another instance changed; on_done gets ChatManager.scan_changes()'s result"""
+        self._read(lambda: self._scan_changes(full_ids), on_done)
+
+    def run_task(self, fn, on_done=None, on_error=None):
+        """Run fn() on the I/O thread; on_done(result) / on_error(message) are called on the GUI thread.
+
+        Pending snapshots are written first, so fn sees (and can't clobber) earlier changes.
+        """
+        with self._cond:
+            self._tasks.append((fn, on_done, on_error))
+            self._cond.notify_all()
+
+    def _read(self, fn, on_done=None, on_error=None):
+        with self._cond:
+            self._reads.append((fn, on_done, on_error))
+            self._cond.notify_all()
+
+    def _list_chats(self) -> list:
+        chats = {chat["id"]: chat for chat in self.chat_manager.list_chats() if "id" in chat}
+        with self._cond:
+            chats.update(self._pending_chats)
+        return sorted(chats.values(), key=lambda x: x.get("created_at", ""), reverse=True)
+
+    def read_chat(self, chat_id: str) -> dict:
+        """Latest version of a chat (its pending snapshot, else the file); safe from any thread"""
+        with self._cond:
+            snapshot = self._pending_chats.get(chat_id)
+            if snapshot is not None:
+                return copy.deepcopy(snapshot)
+        return self.chat_manager.load_chat(chat_id)
+
+    def request_chat_list(self, on_done):
+        self._read(self._list_chats, on_done)
+
+    def request_chat(self, chat_id: str, on_done, on_error=None):
+        self._read(lambda: self.read_chat(chat_id), on_done, on_error)
+
+    def flush(self):
+        """Block until every logged change is in the JSON files and every task has run"""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._has_work() or self._busy:
+                self._cond.wait()
+            self._flush_requested = False
+
+    def stop(self):
+        """Flush everything to disk and stop the thread"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self.wait()
+        self.wal.close()
+
+    def _checkpoint(self, chats: dict, memory_changes: list):
+        """Write the snapshots taken with the log set aside, then drop that part of the log"""
+        ok = True
+        with self.chat_manager.lock:
+            for chat_data in chats.values():
+                try:
+                    self.chat_manager.save_chat(chat_data)
+                except Exception as e:
+                    print(f"Error saving chat: {e}")
+                    ok = False
+            memories = self._merge_memories(memory_changes) if memory_changes else None
+        if memory_changes and memories is None:
+            ok = False
+        if ok:
+            self.wal.end_checkpoint()
+        with self._cond:
+            self._writing_memories = []
+            if not ok and not self._stopping:
+                # Keep the old log and try these again with the next checkpoint
+                for chat_id, chat_data in chats.items():
+                    self._pending_chats.setdefault(chat_id, chat_data)
+                if memories is None:
+                    self._pending_memories[:0] = memory_changes
+        if memories is not None:
+            self.memories_synced.emit(memories)
+
+    def run(self):
+        while True:
+            self.wal.sync()  # outside the lock, so an fsync never holds up the GUI thread
+            with self._cond:
+                idle = False
+                if not self._has_work() and not self._stopping:
+                    idle = not self._cond.wait(timeout=WAL_CHECKPOINT_IDLE_S)
+                    if not self._has_work() and not (idle and self._has_pending()):
+                        continue  # woken by a logged change: sync it and keep waiting
+                checkpoint = self._has_pending() and (
+                    idle or bool(self._tasks) or self._stopping or self._flush_requested
+                    or self.wal.records >= WAL_CHECKPOINT_RECORDS
+                )
+                if not checkpoint and not self._tasks and not self._reads:
+                    if self._stopping:
+                        return
+                    continue
+                chats = memories = None
+                if checkpoint:
+                    chats = self._pending_chats
+                    memories = self._writing_memories = self._pending_memories
+                    self._pending_chats = {}
+                    self._pending_memories = []
+                    self.wal.begin_checkpoint()
+                tasks = list(self._tasks)
+                reads = list(self._reads)
+                self._tasks.clear()
+                self._reads.clear()
+                self._busy = True
+
+            if checkpoint:
+                self._checkpoint(chats, memories)
+
+            # Tasks before reads, so a list or load queued after a rename or delete sees it
+            for fn, on_done, on_error in tasks + reads:
+                try:
+                    result = fn()
+                except Exception as e:
+                    print(f"Chat store task failed: {e}")
+                    self.task_failed.emit(on_error, str(e))
+                else:
+                    self.task_finished.emit(on_done, result)
 
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
 
-class MemoryDetectionThread(QThread):
-    """Background thread for detecting if user message should be saved to memory"""
-    memory_found = pyqtSignal(str)  # Emits formatted memory content
-    no_memory = pyqtSignal()
+
+class InferenceJob(QObject):
+    """Handle for a job queued on the InferenceExecutor; its signals are delivered on the GUI thread"""
+    finished = pyqtSignal(object)
     error = pyqtSignal(str)
-    
-    def __init__(self, model, user_message: str, conversation_context: list):
+
+    def __init__(self, fn, priority: int):
+        super().__init__()
+        self.fn = fn
+        self.priority = priority
+        self.cancelled = False
+        self.started = False
+        self._lock = threading.Lock()
+
+    def cancel(self) -> bool:
+        """Skip the job if it hasn't started yet; False if it already has"""
+        with self._lock:
+            self.cancelled = True
+            return not self.started
+
+    def begin(self) -> bool:
+        """Mark the job as running, unless it was cancelled first"""
+        with self._lock:
+            self.started = not self.cancelled
+            return self.started
+
+
+class InferenceExecutor(QThread):
+    """Long-lived thread that owns the model and runs inference jobs one at a time.
+
+    Jobs are taken from a priority queue (lower value first, FIFO within a
+    priority), so a user reply never waits behind queued extraction or
+    background work. Every job runs while holding model_lock, since a Llama
+    object must never be used from two threads at once. Jobs get the model
+    through for_priority, so a ModelRouter can pick a model per job.
+    """
+    def __init__(self, model=None):
         super().__init__()
         self.model = model
-        self.user_message = user_message
-        self.conversation_context = conversation_context
-    
+        self.model_lock = threading.RLock()
+        self.jobs = queue.PriorityQueue()
+        self._sequence = itertools.count()
+
+    def set_model(self, model, release=None):
+        """Queue a swap to model ahead of every waiting job and return at once.
+
+        The running job finishes on the old model; release() then runs on this
+        thread, after the swap, so the old model can be closed safely.
+        """
+        def swap(_):
+            self.model = model
+            if release is not None:
+                release()
+        self.jobs.put((PRIORITY_MODEL_SWAP, next(self._sequence), InferenceJob(swap, PRIORITY_MODEL_SWAP)))
+
+    def submit(self, fn, priority: int = PRIORITY_INTERACTIVE, on_finished=None, on_error=None) -> InferenceJob:
+        """Queue fn(model) and return a job whose finished/error signals report the outcome.
+
+        Callbacks are connected before the job is queued, so a job that completes
+        immediately can't emit before anyone is listening.
+        """
+        job = InferenceJob(fn, priority)
+        if on_finished is not None:
+            job.finished.connect(on_finished)
+        if on_error is not None:
+            job.error.connect(on_error)
+        self.jobs.put((priority, next(self._sequence), job))
+        return job
+
+    def stop(self):
+        """Finish the running job, drop the rest and stop the thread"""
+        self.jobs.put((PRIORITY_MODEL_SWAP, next(self._sequence), None))
+        self.wait()
+
     def run(self):
-        try:
-            # Simple heuristic check first - does this message warrant memory extraction?
-            lowered = self.user_message.lower()
-            
-            # Explicit memory requests
-            explicit_triggers = [
-                "remember that", "remember this", "save to memory",
-                "don't forget", "keep in mind", "note that", "add to memory",
-                "my name is", "i am", "i live in", "i like", "i love",
-                "i work", "i study", "my favorite", "i prefer"
-            ]
-            
-            should_extract = any(trigger in lowered for trigger in explicit_triggers)
-            
-            if not should_extract:
-                self.no_memory.emit()
+        while True:
+            _, _, job = self.jobs.get()
+            if job is None:
                 return
-            
-            # Use AI to extract and format the memory properly
-            memory_extraction_prompt = [
-                {
-                    "role": "system",
-                    "content": """You are a memory extraction assistant. Your job is to:
+            if not job.begin():
+                continue
+            try:
+                with self.model_lock:
+                    model = self.model.for_priority(job.priority) if self.model is not None else None
+                    result = job.fn(model)
+            except Exception as e:
+                job.error.emit(str(e))
+            else:
+                job.finished.emit(result)
+
+
+class IdleScheduler(QObject):
+    """Precomputes on the inference executor while nobody is waiting for it.
+
+    After IDLE_DELAY_MS without a poke(), the tasks returned by plan() are
+    submitted one at a time at PRIORITY_BACKGROUND. A task is
+    fn(model, cancelled) and checks cancelled() between small steps, so
+    preempt() (called before every reply) stops the running task within one
+    prefill chunk and drops the rest.
+    """
+    def __init__(self, executor: InferenceExecutor, plan):
+        super().__init__()
+        self.executor = executor
+        self.plan = plan
+        self.tasks = collections.deque()
+        self.job = None
+        self.stop_event = threading.Event()
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.start)
+
+    def poke(self):
+        """Something changed; plan again once things are quiet"""
+        self.preempt()
+        self.timer.start(IDLE_DELAY_MS)
+
+    def preempt(self):
+        self.timer.stop()
+        self.tasks.clear()
+        self.stop_event.set()
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+
+    def start(self):
+        self.stop_event = threading.Event()
+        self.tasks.extend(self.plan())
+        self._submit_next(self.stop_event)
+
+    def _submit_next(self, stop_event: threading.Event):
+        # Results of a preempted round arrive late and must not restart it
+        if stop_event is not self.stop_event or stop_event.is_set():
+            return
+        self.job = None
+        if not self.tasks:
+            return
+        task = self.tasks.popleft()
+        self.job = self.executor.submit(
+            lambda model: task(model, stop_event.is_set),
+            PRIORITY_BACKGROUND,
+            on_finished=lambda _: self._submit_next(stop_event),
+            on_error=lambda e: (print(f"Idle precomputation error: {e}"), self._submit_next(stop_event))
+        )
+
+
+def with_system_prompt(messages: list, system_prompt: str) -> list:
+    """Copy of the messages with the system message replaced (memories are injected this way)"""
+    messages = [dict(msg) for msg in messages]
+    for msg in messages:
+        if msg["role"] == "system":
+            msg["content"] = system_prompt
+            break
+    return messages
+
+
+def warm_chat(model: InferenceBackend, chat: dict, system_prompt: str, cancelled) -> bool:
+    """Idle job: prefill a chat's history, so its next reply only reads the new message"""
+    model.set_adapter(chat.get("lora"))
+    return model.prefill(with_system_prompt(chat["messages"], system_prompt), cancelled)
+
+
+def generate_reply(model: InferenceBackend, messages: list, adapter: str = None) -> str:
+    """Inference job: generate the assistant's reply to a conversation.
+
+    adapter is the chat's LoRA file, if it has one. The KV state after the
+    reply is checkpointed, so going back to a branch later only prefills the
+    messages after the fork.
+    """
+    model.set_adapter(adapter)
+    return model.complete(messages, max_tokens=REPLY_MAX_TOKENS, checkpoint=True)["text"].strip()
+
+
+def generate_alternatives(model: InferenceBackend, messages: list, adapter: str = None) -> list:
+    """Inference job: draft CANDIDATE_COUNT replies at once"""
+    model.set_adapter(adapter)
+    return model.complete_many(messages, CANDIDATE_COUNT)
+
+
+def add_retrieved_context(model: InferenceBackend, messages: list, store: DocumentStore,
+                          chat_index: ChatIndex = None, chat_id: str = None) -> list:
+    """Prefix the last user message with the document excerpts and other-chat snippets most relevant to it.
+
+    Runs inside the reply job. Each source has its own token budget. Only this
+    snapshot of the messages is changed, and only the newest message, so the
+    cached KV prefix of the earlier conversation stays valid.
+    """
+    last = next((msg for msg in reversed(messages) if msg["role"] == "user"), None)
+    if last is None:
+        return messages
+
+    sections = []
+    if store is not None and store.index["count"]:
+        results = store.search(model.embed([last["content"]])[0])
+        context = build_context(results, DOCUMENT_CONTEXT_TOKENS, model.count_tokens)
+        if context:
+            sections.append(f"Relevant excerpts from my documents:\n\n{context}")
+    if chat_index is not None:
+        results = chat_index.search(last["content"], exclude_chat_id=chat_id)
+        context = build_context(results, CHAT_CONTEXT_TOKENS, model.count_tokens)
+        if context:
+            sections.append(f"From our earlier conversations:\n\n{context}")
+
+    if sections:
+        last["content"] = "\n\n".join(sections) + f"\n\n---\n\n{last['content']}"
+    return messages
+
+
+class DocumentIngestTask:
+    """Background inference job that embeds the next EMBED_BATCH chunks of a document.
+
+    The chunk generator (which streams the file) lives on the task, so the GUI
+    requeues the same task until it returns True; replies queued meanwhile get
+    the executor between batches.
+    """
+    def __init__(self, path: str, store: DocumentStore):
+        self.path = path
+        self.store = store
+        self.doc_id = str(uuid.uuid4())
+        self.chunks = None
+        self.total = 0
+
+    def __call__(self, model) -> bool:
+        if self.chunks is None:
+            self.chunks = iter_chunks(self.path)
+        batch = list(itertools.islice(self.chunks, EMBED_BATCH))
+        if batch:
+            self.store.add_chunks(self.doc_id, self.path, batch, model.embed(batch))
+            self.total += len(batch)
+        return len(batch) < EMBED_BATCH
+
+
+class MemoryExtractionTask:
+    """Inference job: decide whether a user message holds facts worth remembering and extract them"""
+    def __init__(self, user_message: str, structured: bool = True):
+        self.user_message = user_message
+        self.structured = structured
+        self.model = None
+
+    def __call__(self, model) -> list:
+        self.model = model
+
+        # Simple heuristic check first - does this message warrant memory extraction?
+        lowered = self.user_message.lower()
+        
+        # Explicit memory requests
+        explicit_triggers = [
+            "remember that", "remember this", "save to memory",
+            "don't forget", "keep in mind", "note that", "add to memory",
+            "my name is", "i am", "i live in", "i like", "i love",
+            "i work", "i study", "my favorite", "i prefer"
+        ]
+        
+        should_extract = any(trigger in lowered for trigger in explicit_triggers)
+        
+        if not should_extract:
+            return []
+
+        if self.structured and model.supports_json_schema:
+            try:
+                return self.extract_structured()
+            except Exception as e:
+                print(f"Structured memory extraction unavailable, using free text: {e}")
+        return self.extract_free_text()
+
+    def extract_structured(self) -> list:
+        """Extract memories as a grammar-constrained {"memories": [...]} object"""
+        memory_extraction_prompt = [
+            {
+                "role": "system",
+                "content": """You are a memory extraction assistant. Your job is to:
+1. Extract ONLY factual information about the user that should be remembered
+2. Convert first-person statements ("I am...", "My name is...") to third-person ("User is...", "User's name is...")
+3. Remove any conversational fluff, questions, or requests
+4. Output a JSON object with one short statement per fact: {"memories": ["...", "..."]}
+5. If there's nothing worth remembering, output: {"memories": []}
+
+Examples:
+Input: "remember that I am an American citizen, but that I was originally born in Brazil. Can you remember that for me, please?"
+Output: {"memories": ["User is an American citizen.", "User was originally born in Brazil."]}
+
+Input: "my name is Henry and I'm 25 years old"
+Output: {"memories": ["User's name is Henry.", "User is 25 years old."]}
+
+Input: "I love pizza!"
+Output: {"memories": ["User loves pizza."]}
+
+Input: "what's the weather like?"
+Output: {"memories": []}"""
+            },
+            {
+                "role": "user",
+                "content": f"Extract memory from: {self.user_message}"
+            }
+        ]
+
+        # The schema forces EOS as soon as the object is closed, so no tokens go to preambles
+        output = self.model.complete(
+            memory_extraction_prompt,
+            max_tokens=150,
+            temperature=0.3,
+            json_schema=MEMORY_EXTRACTION_SCHEMA
+        )
+
+        try:
+            data = json.loads(output["text"])
+        except json.JSONDecodeError:
+            # Only happens if max_tokens cut the object short
+            return []
+
+        memories = []
+        for memory in data.get("memories", []):
+            if isinstance(memory, str):
+                memory = memory.strip()
+                if len(memory) > 5 and memory not in memories:
+                    memories.append(memory)
+        return memories
+
+    def extract_free_text(self) -> list:
+        """Extract a single memory as free text (fallback when grammars are unavailable)"""
+        # Use AI to extract and format the memory properly
+        memory_extraction_prompt = [
+            {
+                "role": "system",
+                "content": """You are a memory extraction assistant. Your job is to:
 1. Extract ONLY factual information about the user that should be remembered
 2. Convert first-person statements ("I am...", "My name is...") to third-person ("User is...", "User's name is...")
 3. Remove any conversational fluff, questions, or requests
@@ -365,92 +1612,237 @@ Output: User loves pizza.
 
 Input: "what's the weather like?"
 Output: NO_MEMORY"""
-                },
-                {
-                    "role": "user",
-                    "content": f"Extract memory from: {self.user_message}"
-                }
-            ]
-            
-            # Generate memory extraction
-            output = self.model.create_chat_completion(
-                memory_extraction_prompt,
-                max_tokens=150,
-                temperature=0.3  # Lower temperature for more consistent formatting
-            )
-            
-            extracted_memory = output["choices"][0]["message"]["content"].strip()
-            
-            # Check if there's actually something to remember
-            if extracted_memory and extracted_memory != "NO_MEMORY" and len(extracted_memory) > 5:
-                self.memory_found.emit(extracted_memory)
+            },
+            {
+                "role": "user",
+                "content": f"Extract memory from: {self.user_message}"
+            }
+        ]
+        
+        # Generate memory extraction
+        output = self.model.complete(
+            memory_extraction_prompt,
+            max_tokens=150,
+            temperature=0.3  # Lower temperature for more consistent formatting
+        )
+        
+        extracted_memory = output["text"].strip()
+        
+        # Check if there's actually something to remember
+        if extracted_memory and extracted_memory != "NO_MEMORY" and len(extracted_memory) > 5:
+            return [extracted_memory]
+        return []
+
+
+class MemoryConsolidationThread(QThread):
+    """Background thread that looks for duplicate memories without touching the live list"""
+    consolidated = pyqtSignal(list)  # Emits {"keep": id, "drop": [ids]} plans
+    error = pyqtSignal(str)
+
+    def __init__(self, consolidator: MemoryConsolidator, memories: list):
+        super().__init__()
+        self.consolidator = consolidator
+        self.memories = [dict(m) for m in memories]  # snapshot; the GUI thread keeps editing the original
+
+    def run(self):
+        try:
+            self.consolidated.emit(self.consolidator.find_duplicates(self.memories))
+        except Exception as e:
+            self.error.emit(str(e))
+
+
+class ChatTransferThread(QThread):
+    """Exports or imports the chat history in the background (see chat_export.py).
+
+    It reads and writes the folder through a ChatManager of its own, like
+    another instance would, so the store lock keeps it from colliding with
+    the chat store thread and the file watcher picks up what it imports.
+    """
+    progress = pyqtSignal(int)  # percent done
+    transferred = pyqtSignal(dict)
+    error = pyqtSignal(str)
+
+    def __init__(self, chat_store: ChatStoreWorker, action: str, path: str, since: str = None):
+        super().__init__()
+        self.chat_store = chat_store
+        self.chat_dir = chat_store.chat_manager.chat_dir
+        self.memory_file = chat_store.memory_manager.memory_file
+        self.action = action
+        self.path = path
+        self.since = since
+        self._cancelled = threading.Event()
+        self._last_progress = 0.0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def _report(self, done: int, total: int):
+        now = time.monotonic()
+        if total and (now - self._last_progress >= TRANSFER_PROGRESS_INTERVAL_S or done >= total):
+            self._last_progress = now
+            self.progress.emit(int(100 * done / total))
+
+    def run(self):
+        try:
+            chat_manager = ChatManager(self.chat_dir)
+            memory_manager = MemoryManager(self.memory_file)
+            if self.action == "export":
+                self.chat_store.flush()  # so chats still only in the journal are exported too
+                result = export_chats(chat_manager, memory_manager, self.path, self.since,
+                                      progress=self._report, cancelled=self._cancelled.is_set)
             else:
-                self.no_memory.emit()
-                
+                result = import_chats(chat_manager, memory_manager, self.path,
+                                      progress=self._report, cancelled=self._cancelled.is_set)
+            self.transferred.emit(result)
         except Exception as e:
             self.error.emit(str(e))
 
 
-class MemoryListWidget(QListWidget):
-    """Custom list widget for memories with hover detection"""
-    def __init__(self, parent=None):
+class MemoryTableModel(QAbstractTableModel):
+    """Memories as table rows (content, source, date), filtered and sorted in place.
+
+    The view only asks for the rows on screen, and edits touch single rows
+    instead of rebuilding the list. Filtering and sorting run over plain
+    Python lists (no per-comparison data() calls), and typing more of a
+    filter only narrows the rows already shown.
+    """
+    COLUMNS = ("Memory", "Source", "Saved")
+    SORT_KEYS = (
+        lambda mem: mem["content"].lower(),
+        lambda mem: (mem.get("source", ""), mem.get("created_at", "")),  # ties within a source go by date
+        lambda mem: mem.get("created_at", "")
+    )
+    BULK_RESET_RUNS = 32  # removing more separate row runs than this resets the view instead
+
+    def __init__(self, memories: list, parent=None):
         super().__init__(parent)
-        self.setMouseTracking(True)
-        self.parent_dialog = None
-        
-        # Set custom delegate
-        self.delegate = ChatItemDelegate(self)
-        self.setItemDelegate(self.delegate)
-        
-    def mouseMoveEvent(self, event):
-        item = self.itemAt(event.pos())
-        index = self.indexAt(event.pos())
-        
-        if item:
-            self.delegate.hovered_index = index
-            if self.is_over_dots(event.pos(), index):
-                self.setCursor(Qt.CursorShape.PointingHandCursor)
-            else:
-                self.setCursor(Qt.CursorShape.ArrowCursor)
-        else:
-            self.delegate.hovered_index = None
-            self.setCursor(Qt.CursorShape.ArrowCursor)
-        
-        self.viewport().update()
-        super().mouseMoveEvent(event)
-    
-    def leaveEvent(self, event):
-        self.delegate.hovered_index = None
-        self.setCursor(Qt.CursorShape.ArrowCursor)
-        self.viewport().update()
-        super().leaveEvent(event)
-    
-    def is_over_dots(self, pos, index):
-        rect = self.visualRect(index)
-        dots_x = rect.right() - 50
-        dots_rect = QRect(dots_x, rect.top(), 50, rect.height())
-        return dots_rect.contains(pos)
-    
-    def mousePressEvent(self, event):
-        item = self.itemAt(event.pos())
-        index = self.indexAt(event.pos())
-        
-        if item and self.is_over_dots(event.pos(), index):
-            if self.parent_dialog:
-                self.parent_dialog.show_memory_options(item, event.globalPosition().toPoint())
-            event.accept()
+        self.memories = list(memories)
+        self.filter_text = ""
+        self.sort_column = 2
+        self.sort_order = Qt.SortOrder.DescendingOrder
+        self.rows = self._sorted(self.memories)  # the memories shown, in display order
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.COLUMNS[section]
+        return None
+
+    @staticmethod
+    def format_date(created_at: str) -> str:
+        try:
+            return datetime.datetime.fromisoformat(created_at.replace("Z", "")).strftime("%Y-%m-%d %H:%M")
+        except ValueError:
+            return created_at
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        mem = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == 0:
+                return " ".join(mem["content"].split())
+            if column == 1:
+                return mem.get("source", "")
+            return self.format_date(mem.get("created_at", ""))
+        if role == Qt.ItemDataRole.ToolTipRole and column == 0:
+            return mem["content"]
+        return None
+
+    def memory_at(self, row: int) -> dict:
+        return self.rows[row]
+
+    def _matches(self, mem: dict) -> bool:
+        return not self.filter_text or self.filter_text in mem["content"].lower()
+
+    def _sorted(self, memories: list) -> list:
+        descending = self.sort_order == Qt.SortOrder.DescendingOrder
+        return sorted(memories, key=self.SORT_KEYS[self.sort_column], reverse=descending)
+
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        self.layoutAboutToBeChanged.emit()
+        self.sort_column, self.sort_order = column, order
+        self.rows = self._sorted(self.rows)
+        self.layoutChanged.emit()
+
+    def set_filter(self, text: str):
+        text = text.strip().lower()
+        # A longer filter can only drop rows, so there's no need to look past the current ones
+        narrowing = text.startswith(self.filter_text)
+        self.filter_text = text
+        self.beginResetModel()
+        if narrowing:
+            self.rows = [mem for mem in self.rows if self._matches(mem)]
         else:
-            super().mousePressEvent(event)
+            self.rows = self._sorted([mem for mem in self.memories if self._matches(mem)])
+        self.endResetModel()
+
+    def set_memories(self, memories: list):
+        if memories == self.memories:
+            # Same content (e.g. our own changes merged back in); keep the view, hold the new objects
+            by_id = {mem["id"]: mem for mem in memories}
+            self.memories = list(memories)
+            self.rows = [by_id[mem["id"]] for mem in self.rows]
+            return
+        self.beginResetModel()
+        self.memories = list(memories)
+        self.rows = self._sorted([mem for mem in self.memories if self._matches(mem)])
+        self.endResetModel()
+
+    def memory_added(self, memory: dict):
+        self.memories.append(memory)
+        if not self._matches(memory):
+            return
+        key = self.SORT_KEYS[self.sort_column]
+        descending = self.sort_order == Qt.SortOrder.DescendingOrder
+        row = 0
+        while row < len(self.rows) and (key(self.rows[row]) >= key(memory) if descending
+                                        else key(self.rows[row]) <= key(memory)):
+            row += 1
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.rows.insert(row, memory)
+        self.endInsertRows()
+
+    def memories_removed(self, memory_ids):
+        """Drop the given ids, one contiguous run of rows at a time"""
+        self.memories = [mem for mem in self.memories if mem["id"] not in memory_ids]
+        rows = [row for row, mem in enumerate(self.rows) if mem["id"] in memory_ids]
+        runs = sum(1 for i, row in enumerate(rows) if i == 0 or rows[i - 1] != row - 1)
+        if runs > self.BULK_RESET_RUNS:
+            self.beginResetModel()
+            self.rows = [mem for mem in self.rows if mem["id"] not in memory_ids]
+            self.endResetModel()
+            return
+        while rows:
+            last = rows.pop()
+            first = last
+            while rows and rows[-1] == first - 1:
+                first = rows.pop()
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.rows[first:last + 1]
+            self.endRemoveRows()
+
+    def memories_changed(self, memory_ids):
+        for row, mem in enumerate(self.rows):
+            if mem["id"] in memory_ids:
+                self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.COLUMNS) - 1))
+
 
 class MemoryEditDialog(QDialog):
-    def __init__(self, original_text: str, parent=None):
+    def __init__(self, original_text: str, parent=None, prompt: str = "Edit the memory below:"):
         super().__init__(parent)
         self.setWindowTitle("Edit Memory")
         self.setMinimumWidth(450)
 
         layout = QVBoxLayout()
 
-        label = QLabel("Edit the memory below:")
+        label = QLabel(prompt)
         layout.addWidget(label)
 
         self.text_edit = QTextEdit()
@@ -474,6 +1866,50 @@ class MemoryEditDialog(QDialog):
     def get_text(self) -> str:
         return self.text_edit.toPlainText().strip()
 
+class CandidateDialog(QDialog):
+    """Lets the user pick one of several drafted replies"""
+    def __init__(self, candidates: list, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Choose a Reply")
+        self.setMinimumSize(520, 380)
+        self.candidates = candidates
+
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel(f"{len(candidates)} alternative replies were drafted. Pick one to continue with:"))
+
+        self.list_widget = QListWidget()
+        for number, text in enumerate(candidates, start=1):
+            preview = " ".join(text.split())
+            self.list_widget.addItem(f"{number}. {preview[:80] + '.' if len(preview) > 80 else preview}")
+        self.list_widget.currentRowChanged.connect(self.show_candidate)
+        self.list_widget.itemDoubleClicked.connect(self.accept)
+        layout.addWidget(self.list_widget)
+
+        self.preview = QTextEdit()
+        self.preview.setReadOnly(True)
+        layout.addWidget(self.preview, stretch=1)
+
+        btn_row = QHBoxLayout()
+        use_btn = QPushButton("Use this reply")
+        cancel_btn = QPushButton("Cancel")
+        btn_row.addStretch()
+        btn_row.addWidget(use_btn)
+        btn_row.addWidget(cancel_btn)
+        layout.addLayout(btn_row)
+
+        use_btn.clicked.connect(self.accept)
+        cancel_btn.clicked.connect(self.reject)
+
+        self.setLayout(layout)
+        self.list_widget.setCurrentRow(0)
+
+    def show_candidate(self, row: int):
+        if 0 <= row < len(self.candidates):
+            self.preview.setPlainText(self.candidates[row])
+
+    def selected_index(self) -> int:
+        return max(0, self.list_widget.currentRow())
+
 class MemoryViewDialog(QDialog):
     """Dialog to view and manage memories"""
     def __init__(self, memory_manager: MemoryManager, parent=None):
@@ -481,7 +1917,7 @@ class MemoryViewDialog(QDialog):
         self.memory_manager = memory_manager
         
         self.setWindowTitle("Memory Manager")
-        self.setGeometry(300, 300, 600, 500)
+        self.setGeometry(300, 300, 700, 500)
         
         layout = QVBoxLayout()
         
@@ -508,21 +1944,59 @@ class MemoryViewDialog(QDialog):
 
         layout.addLayout(title_row)
 
-        
-        # Memory list
-        self.memory_list = MemoryListWidget()
-        self.memory_list.parent_dialog = self
-        self.memory_list.setStyleSheet("""
-            QListWidget::item {
-                padding: 10px;
-                border-radius: 4px;
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText("Filter memories...")
+        self.filter_edit.setClearButtonEnabled(True)
+        layout.addWidget(self.filter_edit)
+
+        # Memory table: a model/view pair, so thousands of memories cost only the visible rows
+        self.table_model = MemoryTableModel(memory_manager.get_all_memories(), self)
+        self.filter_edit.textChanged.connect(self.table_model.set_filter)
+
+        self.memory_table = QTableView()
+        self.memory_table.setModel(self.table_model)
+        self.memory_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.memory_table.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.memory_table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.memory_table.setShowGrid(False)
+        self.memory_table.setWordWrap(False)
+        self.memory_table.verticalHeader().hide()
+        self.memory_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.memory_table.verticalHeader().setDefaultSectionSize(32)
+        header = self.memory_table.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        # Fixed widths: sizing to contents would measure every row
+        metrics = self.memory_table.fontMetrics()
+        header.resizeSection(1, metrics.horizontalAdvance("Source") + 40)
+        header.resizeSection(2, metrics.horizontalAdvance("0000-00-00 00:00") + 40)
+        header.setSortIndicator(self.table_model.sort_column, self.table_model.sort_order)
+        self.memory_table.setSortingEnabled(True)
+        self.memory_table.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.memory_table.customContextMenuRequested.connect(self.show_memory_options)
+        self.memory_table.doubleClicked.connect(self.edit_selected)
+        self.memory_table.setStyleSheet("""
+            QTableView::item {
+                padding: 6px;
                 border-bottom: 1px solid rgba(255, 255, 255, 0.1);
             }
-            QListWidget::item:hover {
+            QTableView::item:hover {
                 background-color: rgba(255, 255, 255, 0.05);
             }
         """)
-        layout.addWidget(self.memory_list)
+        layout.addWidget(self.memory_table)
+
+        # Count + bulk actions on the selection
+        action_row = QHBoxLayout()
+        self.count_label = QLabel()
+        action_row.addWidget(self.count_label)
+        action_row.addStretch()
+        self.edit_btn = QPushButton("✏️ Edit")
+        self.edit_btn.clicked.connect(self.edit_selected)
+        self.delete_btn = QPushButton("🗑️ Delete")
+        self.delete_btn.clicked.connect(self.delete_selected)
+        action_row.addWidget(self.edit_btn)
+        action_row.addWidget(self.delete_btn)
+        layout.addLayout(action_row)
         
         # Close button
         close_btn = QPushButton("Close")
@@ -530,32 +2004,36 @@ class MemoryViewDialog(QDialog):
         layout.addWidget(close_btn)
         
         self.setLayout(layout)
-        
-        self.refresh_memories()
-    
-    def refresh_memories(self):
-        """Refresh the memory list"""
-        self.memory_list.clear()
-        memories = self.memory_manager.get_all_memories()
-        
-        if not memories:
-            item = QListWidgetItem("No memories saved yet.")
-            item.setFlags(Qt.ItemFlag.NoItemFlags)
-            self.memory_list.addItem(item)
+
+        for signal in (self.table_model.rowsInserted, self.table_model.rowsRemoved, self.table_model.modelReset):
+            signal.connect(self.update_count)
+        self.memory_table.selectionModel().selectionChanged.connect(self.update_count)
+        self.update_count()
+
+    def update_count(self, *args):
+        total = len(self.table_model.memories)
+        shown = self.table_model.rowCount()
+        selected = len(self.selected_memories())
+        if not total:
+            text = "No memories saved yet."
+        elif shown == total:
+            text = f"{total} memories"
         else:
-            for mem in memories:
-                # Format: content + timestamp
-                try:
-                    dt = datetime.datetime.fromisoformat(mem["created_at"].replace("Z", ""))
-                    timestamp = dt.strftime("%Y-%m-%d %H:%M")
-                except:
-                    timestamp = mem.get("created_at", "")
-                
-                display_text = f"{mem['content']}\n({timestamp})"
-                item = QListWidgetItem(display_text)
-                item.setData(Qt.ItemDataRole.UserRole, mem["id"])
-                item.setSizeHint(QSize(550, 60))
-                self.memory_list.addItem(item)
+            text = f"{shown} of {total} memories match"
+        if selected:
+            text += f", {selected} selected"
+        self.count_label.setText(text)
+        self.edit_btn.setEnabled(selected > 0)
+        self.delete_btn.setEnabled(selected > 0)
+
+    def refresh_memories(self):
+        """Reload the table, e.g. after the memory file changed elsewhere"""
+        self.table_model.set_memories(self.memory_manager.get_all_memories())
+
+    def selected_memories(self) -> list:
+        """Selected memories in on-screen order"""
+        rows = sorted(index.row() for index in self.memory_table.selectionModel().selectedRows())
+        return [self.table_model.memory_at(row) for row in rows]
     
     def add_memory_manual(self):
         """Open empty editor to manually add a new memory"""
@@ -563,23 +2041,21 @@ class MemoryViewDialog(QDialog):
         if dlg.exec():
             text = dlg.get_text()
             if text:
-                self.memory_manager.add_memory(text, source="user")
-                self.refresh_memories()
+                memory = self.memory_manager.add_memory(text, source="user")
+                self.table_model.memory_added(memory)
 
-    
-    def show_memory_options(self, item: QListWidgetItem, global_pos: QPoint):
-        """Show options menu for a memory item"""
-        memory_id = item.data(Qt.ItemDataRole.UserRole)
-        if not memory_id:
+    def show_memory_options(self, pos: QPoint):
+        """Show options menu for the selected memories"""
+        if not self.selected_memories():
             return
         
         menu = QMenu(self)
 
         edit_action = menu.addAction("✏️ Edit Memory")
-        edit_action.triggered.connect(lambda: self.edit_memory(item, memory_id))
+        edit_action.triggered.connect(self.edit_selected)
         
         delete_action = menu.addAction("🗑️ Delete Memory")
-        delete_action.triggered.connect(lambda: self.delete_memory(memory_id))
+        delete_action.triggered.connect(self.delete_selected)
 
         
         menu.setStyleSheet("""
@@ -597,46 +2073,64 @@ class MemoryViewDialog(QDialog):
             }
         """)
         
-        menu.exec(global_pos)
-
-    def edit_memory(self, item: QListWidgetItem, memory_id: str):
-        """Open dialog to edit this memory"""
-        # Grab current text (first line is the content, second line is timestamp)
-        full_text = item.text()
-        # Our display format was: "<content>\n(<timestamp>)"
-        # so split on newline and take the first line
-        current_content = full_text.split("\n", 1)[0].strip()
-
-        dlg = MemoryEditDialog(current_content, self)
-        if dlg.exec():  # user clicked Done
-            new_text = dlg.get_text()
-            if new_text:
-                updated = self.memory_manager.update_memory(memory_id, new_text)
-                if updated:
-                    self.refresh_memories()
-        # if Cancel, do nothing
+        menu.exec(self.memory_table.viewport().mapToGlobal(pos))
 
-    
-    def delete_memory(self, memory_id: str):
-        """Delete a memory after confirmation"""
+    def edit_selected(self, *args):
+        """Edit the selected memories; several are edited one per line and saved together"""
+        memories = self.selected_memories()
+        if not memories:
+            return
+        if len(memories) == 1:
+            dlg = MemoryEditDialog(memories[0]["content"], self)
+        else:
+            if any("\n" in mem["content"] for mem in memories):
+                QMessageBox.warning(self, "Edit Memories",
+                                    "Some of these memories span several lines; edit them one at a time.")
+                return
+            dlg = MemoryEditDialog("\n".join(mem["content"] for mem in memories), self,
+                                   prompt=f"Edit the {len(memories)} memories below, one per line:")
+        if not dlg.exec():  # Cancel
+            return
+
+        new_text = dlg.get_text()
+        lines = [new_text] if len(memories) == 1 else [line.strip() for line in new_text.splitlines()]
+        if len(lines) != len(memories) or not all(lines):
+            QMessageBox.warning(self, "Edit Memories",
+                                f"Expected {len(memories)} non-empty lines, one per memory. Nothing was changed.")
+            return
+        changed = self.memory_manager.update_memories(
+            {mem["id"]: line for mem, line in zip(memories, lines)}
+        )
+        self.table_model.memories_changed(set(changed))
+
+    def delete_selected(self):
+        """Delete the selected memories after confirmation, with a single save"""
+        memories = self.selected_memories()
+        if not memories:
+            return
+        question = ("Are you sure you want to delete this memory?" if len(memories) == 1
+                    else f"Are you sure you want to delete these {len(memories)} memories?")
         reply = QMessageBox.question(
             self,
             "Delete Memory",
-            "Are you sure you want to delete this memory?",
+            question,
             QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
             QMessageBox.StandardButton.No
         )
         
         if reply == QMessageBox.StandardButton.Yes:
-            self.memory_manager.delete_memory(memory_id)
-            self.refresh_memories()
+            memory_ids = {mem["id"] for mem in memories}
+            self.memory_manager.delete_memories(memory_ids)
+            self.table_model.memories_removed(memory_ids)
 
 
 class SettingsDialog(QDialog):
     """Settings dialog with various options"""
-    def __init__(self, memory_manager: MemoryManager, parent=None):
+    def __init__(self, memory_manager: MemoryManager, model_settings: dict = None, parent=None,
+                 on_export=None, on_import=None):
         super().__init__(parent)
         self.memory_manager = memory_manager
+        self.model_settings = model_settings
         
         self.setWindowTitle("Settings")
         self.setGeometry(300, 300, 400, 300)
@@ -662,6 +2156,41 @@ class SettingsDialog(QDialog):
             }
         """)
         layout.addWidget(memory_btn)
+
+        # Export / import of the whole history (run by the chat window, in the background)
+        for label, callback in (("📦 Export Chats", on_export), ("📥 Import Chats", on_import)):
+            if callback is None:
+                continue
+            button = QPushButton(label)
+            button.clicked.connect(callback)
+            button.setStyleSheet(memory_btn.styleSheet())
+            layout.addWidget(button)
+
+        # KV cache / attention options (applied the next time a model is loaded)
+        if self.model_settings is not None:
+            kv_row = QHBoxLayout()
+            kv_label = QLabel("KV cache type:")
+            kv_label.setStyleSheet("font-size: 14px; font-weight: normal;")
+            kv_row.addWidget(kv_label)
+            self.kv_combo = QComboBox()
+            self.kv_combo.addItems(list(KV_CACHE_TYPES))
+            self.kv_combo.setCurrentText(self.model_settings["kv_cache_type"])
+            self.kv_combo.currentTextChanged.connect(
+                lambda value: self.model_settings.__setitem__("kv_cache_type", value)
+            )
+            kv_row.addWidget(self.kv_combo)
+            layout.addLayout(kv_row)
+
+            self.flash_attn_check = QCheckBox("Flash attention (needed to quantize the V cache)")
+            self.flash_attn_check.setChecked(self.model_settings["flash_attn"])
+            self.flash_attn_check.toggled.connect(
+                lambda value: self.model_settings.__setitem__("flash_attn", value)
+            )
+            layout.addWidget(self.flash_attn_check)
+
+            note = QLabel("Model options take effect the next time a model is loaded.")
+            note.setStyleSheet("font-size: 11px; font-weight: normal; color: #aaa;")
+            layout.addWidget(note)
         
         # Spacer
         layout.addStretch()
@@ -700,15 +2229,405 @@ class GPUSelectionScreen(QWidget):
         self.gpu_button_yes.clicked.connect(lambda: self.select_mode(True))
         button_layout.addWidget(self.gpu_button_yes)
 
-        self.gpu_button_no = QPushButton("No (CPU)", self)
-        self.gpu_button_no.clicked.connect(lambda: self.select_mode(False))
-        button_layout.addWidget(self.gpu_button_no)
+        self.gpu_button_no = QPushButton("No (CPU)", self)
+        self.gpu_button_no.clicked.connect(lambda: self.select_mode(False))
+        button_layout.addWidget(self.gpu_button_no)
+
+        # Splits layers between CPU and one or more GPUs based on free VRAM
+        self.gpu_button_auto = QPushButton("Auto (fit to VRAM)", self)
+        self.gpu_button_auto.clicked.connect(lambda: self.select_mode("auto"))
+        button_layout.addWidget(self.gpu_button_auto)
+
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+
+    def select_mode(self, use_gpu):
+        self.switch_to_chat(use_gpu)
+
+
+class MessageRenderer:
+    """Renders chat messages as small class-tagged HTML fragments (styled by MESSAGE_CSS).
+
+    Fragments are memoized per (message id, role, timestamp, content hash) in a
+    bounded LRU, so re-rendering a transcript only formats messages it hasn't seen.
+    """
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.cache = collections.OrderedDict()
+
+    def render(self, role: str, content: str, created_at: str | None = None, msg_id: str | None = None) -> str:
+        key = (msg_id, role, created_at, hash(content))
+        fragment = self.cache.get(key)
+        if fragment is not None:
+            self.cache.move_to_end(key)
+            return fragment
+
+        fragment = self._format(role, content, created_at)
+        self.cache[key] = fragment
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        return fragment
+
+    def _format(self, role: str, content: str, created_at: str | None) -> str:
+        safe_content = html.escape(content).replace("\n", "<br>")
+        ts = None
+        if created_at:
+            try:
+                dt = datetime.datetime.fromisoformat(created_at.replace("Z", ""))
+                ts = dt.strftime("%Y-%m-%d %H:%M")
+            except Exception:
+                ts = created_at
+
+        meta_html = ""
+        if ts:
+            meta_html = f'<div class="meta">{ts} — {role.capitalize()}</div>'
 
-        layout.addLayout(button_layout)
-        self.setLayout(layout)
+        if role == "user":
+            return f'<div class="msg">{meta_html}<div class="user"><b class="user-name">You</b><br>{safe_content}</div></div>'
+        elif role == "assistant":
+            return f'<div class="msg">{meta_html}<div class="assistant"><b class="assistant-name">AI</b><br>{safe_content}</div></div>'
+        elif role == "separator":
+            return '<div class="separator"></div>'
+        else:
+            return f'<div class="msg"><div class="system">[system] {safe_content}</div></div>'
+
+
+class TranscriptView:
+    """Keeps the chat display bounded to a window of the chat's messages.
+
+    Each rendered entry is tracked with the number of text blocks it added,
+    so when the document grows past max_blocks messages are removed in place
+    from the end away from the reader. Scrolling to the top inserts the
+    previous page above the window and scrolling back down appends the next
+    one (fragments come from the renderer's cache), keeping the scroll
+    position. Notes are entries outside the message list. A transient
+    trailing entry (the typing indicator) can be shown and replaced without
+    touching the rest of the document.
+    """
+    def __init__(self, display: QTextEdit, renderer: MessageRenderer,
+                 max_blocks: int = TRANSCRIPT_MAX_BLOCKS, page_size: int = TRANSCRIPT_PAGE_MESSAGES):
+        self.display = display
+        self.renderer = renderer
+        self.max_blocks = max_blocks
+        self.page_size = page_size
+        self.messages = []  # every visible (non-system) message of the chat
+        self.start = 0  # self.messages[start:end] are rendered
+        self.end = 0
+        self.entries = collections.deque()  # (blocks, is_note) of each rendered entry, top first
+        self.indicator_blocks = 0
+        self.indicator_html = None  # shown whenever the newest message is rendered
+        self._rendering = False
+        self.display.verticalScrollBar().valueChanged.connect(self._on_scroll)
+
+    def _render(self, msg: dict) -> str:
+        return self.renderer.render(msg.get("role", ""), msg.get("content", ""), msg.get("created_at"), msg.get("id"))
+
+    def _append_html(self, fragment: str) -> int:
+        doc = self.display.document()
+        before = doc.blockCount()
+        if doc.isEmpty():
+            # append() fills the lone empty block, which blank entries (separators) may have left
+            before = 0
+            for i, (_, is_note) in enumerate(self.entries):
+                self.entries[i] = (0, is_note)
+        self.display.append(fragment)
+        return doc.blockCount() - before
+
+    def _prepend_html(self, fragment: str) -> int:
+        """Insert a fragment above everything, laid out as append() would have"""
+        doc = self.display.document()
+        if doc.isEmpty():
+            return self._append_html(fragment)
+        before = doc.blockCount()
+        block_format = doc.firstBlock().blockFormat()
+        rendered = QTextDocument()
+        QTextCursor(rendered).insertHtml(fragment)
+        cursor = QTextCursor(doc)
+        cursor.insertBlock()
+        cursor.setPosition(0)
+        cursor.setBlockFormat(QTextBlockFormat())
+        cursor.insertFragment(QTextDocumentFragment(rendered))
+        # The old first block got the new empty block's format when it was split; restore its own
+        QTextCursor(doc.findBlockByNumber(doc.blockCount() - before)).setBlockFormat(block_format)
+        return doc.blockCount() - before
+
+    def _remove_leading_blocks(self, count: int):
+        doc = self.display.document()
+        if count == 0:
+            return
+        if count >= doc.blockCount():
+            self.display.clear()
+            return
+        keep = doc.findBlockByNumber(count)
+        block_format = keep.blockFormat()
+        cursor = QTextCursor(doc)
+        cursor.setPosition(0)
+        cursor.setPosition(keep.position(), QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        # The merged first block inherits the removed block's format; restore its own
+        cursor.setBlockFormat(block_format)
+
+    def _remove_trailing_blocks(self, count: int):
+        doc = self.display.document()
+        if count == 0:
+            return
+        if count >= doc.blockCount():
+            self.display.clear()
+            return
+        first = doc.findBlockByNumber(doc.blockCount() - count)
+        cursor = QTextCursor(doc)
+        cursor.setPosition(first.position() - 1)
+        cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+
+    def _evict(self):
+        """Drop the oldest rendered entries until the document fits max_blocks"""
+        doc = self.display.document()
+        while len(self.entries) > 1 and doc.blockCount() > self.max_blocks:
+            blocks, is_note = self.entries.popleft()
+            self._remove_leading_blocks(blocks)
+            if not is_note:
+                self.start += 1
+
+    def _evict_newest(self):
+        """Drop the newest rendered entries (and the indicator) until the document fits max_blocks"""
+        doc = self.display.document()
+        if doc.blockCount() > self.max_blocks:
+            self._detach_indicator()
+        while len(self.entries) > 1 and doc.blockCount() > self.max_blocks:
+            blocks, is_note = self.entries.pop()
+            self._remove_trailing_blocks(blocks)
+            if not is_note:  # notes aren't kept anywhere else, so they are gone for good
+                self.end -= 1
+
+    def _detach_indicator(self):
+        if self.indicator_blocks:
+            self._remove_trailing_blocks(self.indicator_blocks)
+            self.indicator_blocks = 0
+
+    def _attach_indicator(self):
+        if self.indicator_html is not None and not self.indicator_blocks and self.end == len(self.messages):
+            self.indicator_blocks = self._append_html(self.indicator_html)
+
+    def _render_window(self, start: int):
+        """Re-render self.messages[start:] (plus the indicator, if shown)"""
+        self._rendering = True
+        self.display.clear()
+        self.entries.clear()
+        self.indicator_blocks = 0
+        self.start = start
+        self.end = len(self.messages)
+        for msg in self.messages[start:]:
+            self.entries.append((self._append_html(self._render(msg)), False))
+        self._attach_indicator()
+        self._rendering = False
+
+    def set_messages(self, messages: list):
+        """Show a chat, rendering only its newest page of messages"""
+        self.messages = [m for m in messages if m.get("role") != "system"]
+        self.indicator_html = None
+        self._render_window(max(0, len(self.messages) - self.page_size))
+        self._evict()
+        self.scroll_to_bottom()
+
+    def clear(self):
+        self.messages = []
+        self.start = self.end = 0
+        self.entries.clear()
+        self.indicator_blocks = 0
+        self.indicator_html = None
+        self.display.clear()
+
+    def append_message(self, msg: dict):
+        """Add a new message to the bottom (before the indicator, which is re-shown after it)"""
+        self.messages.append(msg)
+        if self.end < len(self.messages) - 1:
+            return  # the reader is further up; it is rendered when they scroll down to it
+        self._detach_indicator()
+        self.entries.append((self._append_html(self._render(msg)), False))
+        self.end += 1
+        self._attach_indicator()
+        self._evict()
+
+    def append_note(self, fragment: str):
+        """Show a transient note that isn't part of the chat (dropped on the next re-render)"""
+        if self.end < len(self.messages):
+            self._render_window(max(0, len(self.messages) - self.page_size))
+        self._detach_indicator()
+        self.entries.append((self._append_html(fragment), True))
+        self._attach_indicator()
+        self._evict()
+
+    def show_indicator(self, fragment: str):
+        """Show or replace the trailing transient entry"""
+        self._detach_indicator()
+        self.indicator_html = fragment
+        self._attach_indicator()
+
+    def hide_indicator(self):
+        self._detach_indicator()
+        self.indicator_html = None
+
+    def scroll_to_bottom(self):
+        if self.end < len(self.messages):
+            self._render_window(max(0, len(self.messages) - self.page_size))
+            self._evict()
+        scrollbar = self.display.verticalScrollBar()
+        scrollbar.setValue(scrollbar.maximum())
+
+    def _on_scroll(self, value: int):
+        if self._rendering:
+            return
+        scrollbar = self.display.verticalScrollBar()
+        if value == scrollbar.minimum() and self.start > 0:
+            self._load_older()
+        elif value == scrollbar.maximum() and self.end < len(self.messages):
+            self._load_newer()
+
+    def _viewport_anchor(self) -> tuple:
+        """(number of the block at the top of the viewport, how far the view is scrolled past its top)"""
+        block = self.display.cursorForPosition(QPoint(0, 0)).block()
+        top = self.display.document().documentLayout().blockBoundingRect(block).top()
+        return block.blockNumber(), self.display.verticalScrollBar().value() - top
+
+    def _restore_anchor(self, anchor: tuple, moved_by: int):
+        """Scroll the anchor block, now moved_by blocks further down, back to where it was"""
+        number, offset = anchor
+        doc = self.display.document()
+        layout = doc.documentLayout()
+        layout.blockBoundingRect(doc.lastBlock())  # lay out the rest now, so the scroll range is current
+        block = doc.findBlockByNumber(number + moved_by)
+        if block.isValid():
+            self.display.verticalScrollBar().setValue(round(layout.blockBoundingRect(block).top() + offset))
+
+    def _load_older(self):
+        """Insert the previous page above the window and drop as much from the bottom"""
+        self._rendering = True
+        anchor = self._viewport_anchor()
+        before = self.display.document().blockCount()
+        edit = QTextCursor(self.display.document())
+        edit.beginEditBlock()  # one relayout for the whole page, not one per message
+        first = max(0, self.start - self.page_size)
+        for msg in reversed(self.messages[first:self.start]):
+            self.entries.appendleft((self._prepend_html(self._render(msg)), False))
+        self.start = first
+        inserted = self.display.document().blockCount() - before
+        self._evict_newest()
+        edit.endEditBlock()
+        self._restore_anchor(anchor, inserted)
+        self._rendering = False
+
+    def _load_newer(self):
+        """Append the next page below the window and drop as much from the top"""
+        self._rendering = True
+        anchor = self._viewport_anchor()
+        edit = QTextCursor(self.display.document())
+        edit.beginEditBlock()
+        last = min(len(self.messages), self.end + self.page_size)
+        for msg in self.messages[self.end:last]:
+            self.entries.append((self._append_html(self._render(msg)), False))
+        self.end = last
+        self._attach_indicator()
+        before = self.display.document().blockCount()
+        self._evict()
+        edit.endEditBlock()
+        self._restore_anchor(anchor, self.display.document().blockCount() - before)
+        self._rendering = False
+
+
+class TokenCounter(QObject):
+    """Counts the tokens of the pending prompt as a background job on the inference executor.
+
+    Texts are split into lines and every line's count is cached, so after an
+    edit only the changed lines go through the tokenizer again, in one batch.
+    Only the newest request is kept: it replaces one that hasn't started, and
+    results of older ones are dropped. The cache is only touched by the job.
+    """
+    counted = pyqtSignal(dict, object)  # {name: tokens}, measured prefill tokens/s
+
+    def __init__(self, executor: InferenceExecutor):
+        super().__init__()
+        self.executor = executor
+        self.job = None
+        self.cache = collections.OrderedDict()  # (model id, line) -> token count
+
+    def request(self, parts: dict):
+        """Count each {name: [texts]} group with whatever model the executor has"""
+        if self.job is not None:
+            self.job.cancel()
+        job = self.executor.submit(
+            lambda model: self.count(model, parts),
+            PRIORITY_BACKGROUND,
+            on_finished=lambda result: self._finished(job, result),
+            on_error=lambda e: print(f"Error counting tokens: {e}")
+        )
+        self.job = job
+
+    def _finished(self, job: InferenceJob, result):
+        if job is self.job and result is not None:
+            self.counted.emit(*result)
+
+    def count(self, model: InferenceBackend, parts: dict):
+        """Runs on the executor thread, which owns the model"""
+        if model is None:
+            return None
+        lines = {
+            name: [line for text in texts for line in text.splitlines(keepends=True)]
+            for name, texts in parts.items()
+        }
+        missing = list(dict.fromkeys(
+            line for group in lines.values() for line in group if (model.model_id, line) not in self.cache
+        ))
+        for line, count in zip(missing, model.count_tokens_many(missing)):
+            self.cache[(model.model_id, line)] = count
+        counts = {}
+        for name, group in lines.items():
+            total = CHATML_MESSAGE_OVERHEAD * len(parts[name])
+            for line in group:
+                key = (model.model_id, line)
+                self.cache.move_to_end(key)
+                total += self.cache[key]
+            counts[name] = total
+        while len(self.cache) > TOKEN_CACHE_LINES:
+            self.cache.popitem(last=False)
+        return counts, model.prefill_tokens_per_s()
+
+
+class ContextMeter(QProgressBar):
+    """How much of the model's context the next request fills, and what reading the draft costs"""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setRange(0, MODEL_CONTEXT_TOKENS)
+        self.setValue(0)
+        self.setFixedHeight(18)
+        self.setTextVisible(True)
+        self.setFormat("Context: no model loaded")
+
+    def show_counts(self, counts: dict, prefill_tokens_per_s):
+        total = sum(counts.values())
+        self.setValue(min(total, MODEL_CONTEXT_TOKENS))
+        text = f"Context: {total:,} / {MODEL_CONTEXT_TOKENS:,} tokens · draft {counts.get('draft', 0):,}"
+        tooltip = (
+            f"Chat history: {counts.get('chat', 0):,} tokens\n"
+            f"System prompt and memories: {counts.get('system', 0):,} tokens\n"
+            f"Draft: {counts.get('draft', 0):,} tokens"
+        )
+        if total > MODEL_CONTEXT_TOKENS:
+            text += " · oldest turns left out"
+            tooltip += "\n\nThe model keeps the system prompt and memories and drops the oldest turns it can't fit"
+        if prefill_tokens_per_s:
+            # Earlier messages are normally still in the KV cache, so only the draft is new
+            text += f" · ~{counts.get('draft', 0) / prefill_tokens_per_s:.1f}s to read"
+            tooltip += (
+                f"\n\nMeasured prefill: {prefill_tokens_per_s:,.0f} tokens/s"
+                f"\nWhole prompt without cache: ~{total / prefill_tokens_per_s:.1f}s"
+            )
+        self.setFormat(text)
+        self.setToolTip(tooltip)
 
-    def select_mode(self, use_gpu):
-        self.switch_to_chat(use_gpu)
+        share = total / MODEL_CONTEXT_TOKENS
+        color = "#c0392b" if share > 0.9 else "#d68910" if share > 0.75 else "#2e86c1"
+        self.setStyleSheet(f"QProgressBar::chunk {{ background-color: {color}; }}")
 
 
 class ChatInputBox(QTextEdit):
@@ -748,9 +2667,35 @@ class AIChatGUI(QWidget):
         self.memory_manager = MemoryManager()
         self.current_chat = None
         
-        self.worker_thread = None
-        self.memory_thread = None
+        self.inference_executor = InferenceExecutor()
+        self.inference_executor.start()
+
+        self.chat_store = ChatStoreWorker(self.chat_manager, self.memory_manager)
+        self.chat_store.recover()
+        self.memory_manager.writer = self.chat_store.save_memories
+        self.chat_store.memories_synced.connect(self.on_memories_synced)
+        self.chat_store.start()
+
+        # Another instance or a sync tool may change the files under us; pick that up incrementally
+        self.store_watcher = QFileSystemWatcher(self)
+        self.store_watcher.directoryChanged.connect(self.schedule_store_scan)
+        self.store_watcher.fileChanged.connect(self.schedule_store_scan)
+        self.store_scan_timer = QTimer(self)
+        self.store_scan_timer.setSingleShot(True)
+        self.store_scan_timer.setInterval(STORE_SCAN_DEBOUNCE_MS)
+        self.store_scan_timer.timeout.connect(self.scan_store)
+        self.watch_store_files()
+        self.loading_chat_id = None
+        self.reply_job = None
+        self.extraction_job = None
         self.is_generating = False
+
+        self.memory_consolidator = MemoryConsolidator()
+        self.consolidation_thread = None
+        self.transfer_thread = None
+        self.consolidation_timer = QTimer()
+        self.consolidation_timer.setSingleShot(True)
+        self.consolidation_timer.timeout.connect(self.run_memory_consolidation)
         
         
         self.typing_timer = QTimer()
@@ -818,6 +2763,18 @@ class AIChatGUI(QWidget):
         self.settings_btn.clicked.connect(self.open_settings)
         top_bar.addWidget(self.settings_btn)
 
+        self.documents_btn = QPushButton("📎")
+        self.documents_btn.setFixedWidth(40)
+        self.documents_btn.setToolTip("Attach documents")
+        self.documents_btn.clicked.connect(self.show_documents_menu)
+        top_bar.addWidget(self.documents_btn)
+
+        self.persona_btn = QPushButton("🎭")
+        self.persona_btn.setFixedWidth(40)
+        self.persona_btn.setToolTip("Persona adapter (LoRA) for this chat")
+        self.persona_btn.clicked.connect(self.show_persona_menu)
+        top_bar.addWidget(self.persona_btn)
+
         self.model_label = QLabel("No model selected.", self)
         self.model_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         top_bar.addWidget(self.model_label, stretch=1)
@@ -826,19 +2783,61 @@ class AIChatGUI(QWidget):
         self.select_model_button.clicked.connect(self.select_model_file)
         top_bar.addWidget(self.select_model_button)
 
+        self.small_model_button = QPushButton("Add Small Model", self)
+        self.small_model_button.setToolTip(
+            "A second, faster model for memory extraction, and for replies while the main model is slow"
+        )
+        self.small_model_button.clicked.connect(self.select_small_model_file)
+        top_bar.addWidget(self.small_model_button)
+
         main_layout.addLayout(top_bar)
 
+        self.message_renderer = MessageRenderer()
         self.chat_display = QTextEdit(self)
         self.chat_display.setReadOnly(True)
+        self.chat_display.document().setDefaultStyleSheet(MESSAGE_CSS)
+        self.transcript = TranscriptView(self.chat_display, self.message_renderer)
         main_layout.addWidget(self.chat_display)
 
+        self.context_meter = ContextMeter(self)
+        main_layout.addWidget(self.context_meter)
+
         self.user_input = ChatInputBox(self)
         self.user_input.setPlaceholderText("Type your message.")
         self.user_input.setFixedHeight(100)
         main_layout.addWidget(self.user_input)
 
+        # Count tokens once typing pauses, as background work on the executor (a pasted book takes a while)
+        self.token_counter = TokenCounter(self.inference_executor)
+        self.token_counter.counted.connect(self.on_tokens_counted)
+        self.token_count_timer = QTimer(self)
+        self.token_count_timer.setSingleShot(True)
+        self.token_count_timer.timeout.connect(self.count_prompt_tokens)
+        self.user_input.textChanged.connect(self.schedule_token_count)
+
+        self.idle_scheduler = IdleScheduler(self.inference_executor, self.plan_idle_work)
+
+        branch_bar = QHBoxLayout()
+        self.regenerate_btn = QPushButton("↻ Regenerate", self)
+        self.regenerate_btn.clicked.connect(self.regenerate_reply)
+        branch_bar.addWidget(self.regenerate_btn)
+
+        self.edit_btn = QPushButton("✎ Edit message", self)
+        self.edit_btn.clicked.connect(self.show_edit_menu)
+        branch_bar.addWidget(self.edit_btn)
+
+        self.alternatives_btn = QPushButton(f"✦ {CANDIDATE_COUNT} alternatives", self)
+        self.alternatives_btn.clicked.connect(self.show_alternatives)
+        branch_bar.addWidget(self.alternatives_btn)
+
+        self.branches_btn = QPushButton("⑂ Branches", self)
+        self.branches_btn.clicked.connect(self.show_branch_menu)
+        branch_bar.addWidget(self.branches_btn)
+        branch_bar.addStretch(1)
+        main_layout.addLayout(branch_bar)
+
         self.send_button = QPushButton("Send", self)
-        self.send_button.clicked.connect(self.send_message)
+        self.send_button.clicked.connect(self.on_send_clicked)
         main_layout.addWidget(self.send_button)
 
         self.splitter.addWidget(main_widget)
@@ -850,19 +2849,111 @@ class AIChatGUI(QWidget):
 
         self.MODEL_PATH = None
         self.model = None
+        self.small_model = None
+        self.document_store = None
+        self.known_adapters = []  # LoRA files picked this session, offered again in the persona menu
+        self.model_settings = {"kv_cache_type": "f16", "flash_attn": False}
 
         self.sidebar_expanded = True
         self.sidebar_width_expanded = 220
         self.sidebar_width_collapsed = 0
         self.sidebar_widget.setMaximumWidth(self.sidebar_width_expanded)
 
+        # AI_CHAT_BACKEND (e.g. "stub") runs the whole UI without a model file
+        # AI_CHAT_SMALL_BACKEND adds a faster fallback next to it
+        env_backend = backend_from_env()
+        small_backend = backend_from_env(SMALL_BACKEND_ENV) if env_backend is not None else None
+        for backend, small in ((env_backend, False), (small_backend, True)):
+            if backend is None or (small and self.model is None):
+                continue
+            try:
+                backend.load()
+                self.use_backend(backend, "Model Loaded! Ready to chat. 🔥", small=small)
+            except Exception as e:
+                QMessageBox.critical(self, "Error", f"Failed to start backend:\n{e}")
+
+        self.chat_store.run_task(self.chat_manager.archive_stale_chats)
+        if self.chat_manager.chat_index.is_new:
+            self.chat_store.run_task(self.chat_manager.index_all_chats)
         self.refresh_chat_list()
+        self.schedule_memory_consolidation()
     
     def open_settings(self):
         """Open settings dialog"""
-        settings_dialog = SettingsDialog(self.memory_manager, self)
+        settings_dialog = SettingsDialog(self.memory_manager, self.model_settings, self,
+                                         on_export=self.export_chats_dialog, on_import=self.import_chats_dialog)
         settings_dialog.exec()
 
+    def export_chats_dialog(self):
+        if self.transfer_thread is not None and self.transfer_thread.isRunning():
+            QMessageBox.information(self, "Busy", "An export or import is already running.")
+            return
+        root = tk.Tk()
+        root.withdraw()
+        suffix = bundle_suffix()
+        path = filedialog.asksaveasfilename(
+            title="Export Chats",
+            initialfile=f"chats-{datetime.date.today().isoformat()}{suffix}",
+            filetypes=[("Bundle", f"*{suffix}"), ("JSON Lines", "*.jsonl"), ("Markdown", "*.md"), ("HTML", "*.html")]
+        )
+        if not path:
+            return
+        since, ok = QInputDialog.getText(
+            self, "Export Chats", "Only chats with messages since (YYYY-MM-DD, empty for everything):"
+        )
+        if not ok:
+            return
+        try:
+            since = parse_since(since) if since.strip() else None
+        except ValueError:
+            QMessageBox.warning(self, "Export Chats", f"Not a date: {since}")
+            return
+        self.start_transfer("export", path, since)
+
+    def import_chats_dialog(self):
+        if self.transfer_thread is not None and self.transfer_thread.isRunning():
+            QMessageBox.information(self, "Busy", "An export or import is already running.")
+            return
+        root = tk.Tk()
+        root.withdraw()
+        path = filedialog.askopenfilename(
+            title="Import Chats",
+            filetypes=[("Chat exports", "*.tar.zst *.tar.gz *.tgz *.jsonl"), ("All files", "*.*")]
+        )
+        if path:
+            self.start_transfer("import", path)
+
+    def start_transfer(self, action: str, path: str, since: str = None):
+        """Run an export or import on its own thread, with a progress dialog that can cancel it"""
+        thread = ChatTransferThread(self.chat_store, action, path, since)
+        dialog = QProgressDialog(f"{action.capitalize()}ing {os.path.basename(path)}...", "Cancel", 0, 100, self)
+        dialog.setWindowTitle(f"{action.capitalize()} Chats")
+        dialog.setMinimumDuration(500)
+        dialog.setAutoClose(False)
+        dialog.canceled.connect(thread.cancel)
+        thread.progress.connect(dialog.setValue)
+        thread.transferred.connect(lambda result: self.on_transfer_finished(action, result))
+        thread.error.connect(lambda e: self.on_transfer_finished(action, None, e))
+        thread.finished.connect(dialog.deleteLater)
+        self.transfer_thread = thread
+        thread.start()
+
+    def on_transfer_finished(self, action: str, result: dict = None, error: str = None):
+        if result is None:
+            QMessageBox.warning(self, f"{action.capitalize()} Chats", f"{action.capitalize()} stopped: {error}")
+        elif action == "export":
+            QMessageBox.information(
+                self, "Export Chats",
+                f"Exported {result['chats']} chats and {result['memories']} memories to {result['path']}.\n"
+                f"Export again from {result['exported_at'][:19]}Z to get only what is new after this."
+            )
+        else:
+            QMessageBox.information(
+                self, "Import Chats",
+                f"Imported {result['chats']} chats ({result['unchanged']} already up to date, "
+                f"{result['failed']} failed) and {result['memories']} new memories."
+            )
+
     def show_chat_options(self, item: QListWidgetItem, global_pos: QPoint):
         """Show options menu for a chat item"""
         try:
@@ -916,29 +3007,37 @@ class AIChatGUI(QWidget):
             )
             
             if reply == QMessageBox.StandardButton.Yes:
-                success = self.chat_manager.delete_chat(chat_id)
-                
-                if success:
-                    if self.current_chat and self.current_chat["id"] == chat_id:
-                        self.current_chat = None
-                        self.chat_display.clear()
-                    
-                    self.refresh_chat_list()
-                    #QMessageBox.information(self, "Success", "Chat deleted successfully.")
-                else:
-                    QMessageBox.critical(self, "Error", "Failed to delete chat.")
+                if self.current_chat and self.current_chat["id"] == chat_id:
+                    self.current_chat = None
+                    self.transcript.clear()
+
+                self.chat_store.discard_chat(chat_id)
+                self.chat_store.run_task(
+                    lambda: self.chat_manager.delete_chat(chat_id),
+                    lambda success: self.on_chat_deleted(success, chat_id)
+                )
         except Exception as e:
             print(f"Error in delete confirmation: {e}")
             QMessageBox.critical(self, "Error", f"An error occurred: {e}")
 
+    def on_chat_deleted(self, success: bool, chat_id: str):
+        if success:
+            self.remove_chat_from_list(chat_id)
+            #QMessageBox.information(self, "Success", "Chat deleted successfully.")
+        else:
+            QMessageBox.critical(self, "Error", "Failed to delete chat.")
+
+    def chat_title_in_list(self, chat_id: str) -> str:
+        for i in range(self.chat_list.count()):
+            item = self.chat_list.item(i)
+            if item.data(Qt.ItemDataRole.UserRole) == chat_id:
+                return item.text()
+        return "Untitled chat"
+
     def rename_chat_dialog(self, chat_id: str):
         """Ask user for a new name and rename the chat."""
-        # get current title to prefill
-        try:
-            chat_data = self.chat_manager.load_chat(chat_id)
-            current_title = chat_data.get("title", "Untitled chat")
-        except Exception:
-            current_title = "Untitled chat"
+        # get current title to prefill (the sidebar already shows it; no need to hit the disk)
+        current_title = self.chat_title_in_list(chat_id)
 
         new_title, ok = QInputDialog.getText(self, "Rename Chat", "New chat name:", text=current_title)
         if not ok:
@@ -949,14 +3048,21 @@ class AIChatGUI(QWidget):
             QMessageBox.warning(self, "Invalid name", "Chat name cannot be empty.")
             return
 
-        success = self.chat_manager.rename_chat(chat_id, new_title)
-        if success:
-            # if we're on this chat, update in-memory copy too
-            if self.current_chat and self.current_chat.get("id") == chat_id:
-                self.current_chat["title"] = new_title
-                self.current_chat["title_locked"] = True
+        # if we're on this chat, update in-memory copy and save it; otherwise rename on disk
+        if self.current_chat and self.current_chat.get("id") == chat_id:
+            self.current_chat["title"] = new_title
+            self.current_chat["title_locked"] = True
+            self.chat_store.save_chat(self.current_chat)
+            self.show_chat_in_list(self.current_chat)
+        else:
+            self.chat_store.run_task(
+                lambda: self.chat_manager.rename_chat(chat_id, new_title),
+                lambda success: self.on_chat_renamed(success, chat_id, new_title)
+            )
 
-            self.refresh_chat_list()
+    def on_chat_renamed(self, success: bool, chat_id: str, new_title: str):
+        if success:
+            self.show_chat_in_list({"id": chat_id, "title": new_title})
         else:
             QMessageBox.critical(self, "Error", "Failed to rename chat.")
 
@@ -966,13 +3072,9 @@ class AIChatGUI(QWidget):
         self.typing_dots = 0
         self.typing_indicator_visible = True
         
-        cursor = self.chat_display.textCursor()
-        cursor.movePosition(cursor.MoveOperation.End)
-        self.chat_display.setTextCursor(cursor)
-        
         typing_html = self.format_message("assistant", "...", None)
-        self.chat_display.append(typing_html)
-        self.chat_display.append("")
+        self.transcript.show_indicator(typing_html)
+        self.transcript.scroll_to_bottom()
         
         self.typing_timer.start(400)
     
@@ -984,33 +3086,12 @@ class AIChatGUI(QWidget):
         self.typing_dots = (self.typing_dots % 3) + 1
         dots = "." * self.typing_dots
         
-        full_text = self.chat_display.toPlainText()
-        lines = full_text.split('\n')
-        
-        for i in range(len(lines) - 1, -1, -1):
-            line = lines[i].strip()
-            if line in [".", "..", "..."]:
-                lines[i] = dots
-                break
-        
         scrollbar = self.chat_display.verticalScrollBar()
         at_bottom = scrollbar.value() >= scrollbar.maximum() - 10
         
-        self.chat_display.clear()
-        if self.current_chat:
-            messages = self.current_chat.get("messages", [])
-            for msg in messages:
-                role = msg.get("role", "")
-                # Skip system messages in display
-                if role == "system":
-                    continue
-                content = msg.get("content", "")
-                created_at = msg.get("created_at")
-                html_block = self.format_message(role, content, created_at)
-                self.chat_display.append(html_block)
-        
+        # Only the indicator's own blocks are replaced
         typing_html = self.format_message("assistant", dots, None)
-        self.chat_display.append(typing_html)
+        self.transcript.show_indicator(typing_html)
         
         if at_bottom:
             scrollbar.setValue(scrollbar.maximum())
@@ -1019,76 +3100,10 @@ class AIChatGUI(QWidget):
         """Remove typing indicator from display"""
         self.typing_timer.stop()
         self.typing_indicator_visible = False
-        
-        self.chat_display.clear()
-        if self.current_chat:
-            messages = self.current_chat.get("messages", [])
-            for msg in messages:
-                role = msg.get("role", "")
-                # Skip system messages in display
-                if role == "system":
-                    continue
-                content = msg.get("content", "")
-                created_at = msg.get("created_at")
-                html_block = self.format_message(role, content, created_at)
-                self.chat_display.append(html_block)
-
-    def format_message(self, role: str, content: str, created_at: str | None = None) -> str:
-        safe_content = html.escape(content).replace("\n", "<br>")
-        ts = None
-        if created_at:
-            try:
-                dt = datetime.datetime.fromisoformat(created_at.replace("Z", ""))
-                ts = dt.strftime("%Y-%m-%d %H:%M")
-            except Exception:
-                ts = created_at
-
-        meta_html = ""
-        if ts:
-            meta_html = f'<div style="font-size:0.5px; color:#202d4f; margin-bottom:0.5px;">{ts} — {role.capitalize()}</div>'
+        self.transcript.hide_indicator()
 
-        if role == "user":
-            return f"""
-            <div style="margin:6px 0;">
-                {meta_html}
-                <div style="
-                    background: rgba(42, 90, 223, 0.25);
-                    color:white;
-                    padding:7px 10px;
-                    border-radius:8px;
-                    display:inline-block;
-                    max-width:95%;
-                    ">
-                    <b style="color:#dbe6ff;">You</b><br>{safe_content}
-                </div>
-            </div>
-            """
-        elif role == "assistant":
-            return f"""
-            <div style="margin:6px 0;">
-                {meta_html}
-                <div style="
-                    background: rgba(255, 255, 255, 0.04);
-                    color:#eee;
-                    padding:7px 10px;
-                    border-radius:8px;
-                    display:inline-block;
-                    max-width:95%;
-                    ">
-                    <b style="color:#7fb3ff;">AI</b><br>{safe_content}
-                </div>
-            </div>
-            """
-        elif role == "separator":
-            return "<div style='margin:4px 0;'></div>"
-        else:
-            return f"""
-            <div style="margin:6px 0;">
-                <div style="color:#aaa; font-style:italic; font-size:11px;">
-                    [system] {safe_content}
-                </div>
-            </div>
-            """
+    def format_message(self, role: str, content: str, created_at: str | None = None, msg_id: str | None = None) -> str:
+        return self.message_renderer.render(role, content, created_at, msg_id)
 
     def toggle_sidebar(self):
         was_expanded = self.sidebar_expanded
@@ -1123,20 +3138,121 @@ class AIChatGUI(QWidget):
         anim.start()
 
     def refresh_chat_list(self):
+        """Reload the sidebar; the chat files are read on the I/O thread"""
+        self.chat_store.request_chat_list(self.on_chats_listed)
+
+    def on_chats_listed(self, chats: list):
         self.chat_list.clear()
-        chats = self.chat_manager.list_chats()
         for chat in chats:
-            item = QListWidgetItem(chat.get("title", "Untitled chat"))
-            item.setData(Qt.ItemDataRole.UserRole, chat["id"])
-            item.setSizeHint(QSize(200, 40))
-            self.chat_list.addItem(item)
+            self.chat_list.addItem(self.make_chat_item(chat))
 
         if self.current_chat:
-            for i in range(self.chat_list.count()):
-                item = self.chat_list.item(i)
-                if item.data(Qt.ItemDataRole.UserRole) == self.current_chat["id"]:
-                    self.chat_list.setCurrentItem(item)
-                    break
+            if len(self.current_chat["messages"]) > 1:
+                # The list may have been read before the open chat was first saved
+                self.show_chat_in_list(self.current_chat)
+            row = self.find_chat_item(self.current_chat["id"])
+            if row is not None:
+                self.chat_list.setCurrentRow(row)
+
+    @staticmethod
+    def make_chat_item(chat: dict) -> QListWidgetItem:
+        item = QListWidgetItem(chat.get("title", "Untitled chat"))
+        item.setData(Qt.ItemDataRole.UserRole, chat["id"])
+        item.setData(Qt.ItemDataRole.UserRole + 1, chat.get("created_at", ""))
+        item.setSizeHint(QSize(200, 40))
+        return item
+
+    def find_chat_item(self, chat_id: str):
+        for i in range(self.chat_list.count()):
+            if self.chat_list.item(i).data(Qt.ItemDataRole.UserRole) == chat_id:
+                return i
+        return None
+
+    def show_chat_in_list(self, chat: dict):
+        """Add or retitle one sidebar entry (newest first) without re-listing every chat"""
+        row = self.find_chat_item(chat["id"])
+        if row is not None:
+            self.chat_list.item(row).setText(chat.get("title", "Untitled chat"))
+            return
+        created_at = chat.get("created_at", "")
+        row = 0
+        while (row < self.chat_list.count()
+               and (self.chat_list.item(row).data(Qt.ItemDataRole.UserRole + 1) or "") > created_at):
+            row += 1
+        self.chat_list.insertItem(row, self.make_chat_item(chat))
+        if self.current_chat and self.current_chat["id"] == chat["id"]:
+            self.chat_list.setCurrentRow(row)
+
+    def remove_chat_from_list(self, chat_id: str):
+        row = self.find_chat_item(chat_id)
+        if row is not None:
+            self.chat_list.takeItem(row)
+
+    # ===== CHANGES FROM OTHER INSTANCES =====
+
+    def watch_store_files(self):
+        """Watch the chat folder, the memory file and the open chat's file (replacing a file drops its watch)"""
+        wanted = [self.chat_manager.chat_dir, self.memory_manager.memory_file]
+        if self.current_chat:
+            wanted.append(self.chat_manager._chat_path(self.current_chat["id"]))
+        wanted = [path for path in wanted if os.path.exists(path)]
+        stale = [path for path in self.store_watcher.files() if path not in wanted]
+        if stale:
+            self.store_watcher.removePaths(stale)
+        watched = set(self.store_watcher.files()) | set(self.store_watcher.directories())
+        missing = [path for path in wanted if path not in watched]
+        if missing:
+            self.store_watcher.addPaths(missing)
+
+    def schedule_store_scan(self, path: str = None):
+        self.store_scan_timer.start()
+
+    def scan_store(self):
+        self.watch_store_files()
+        open_ids = (self.current_chat["id"],) if self.current_chat else ()
+        self.chat_store.request_changes(self.on_store_changed, open_ids)
+
+    def on_store_changed(self, changes: dict):
+        for chat in changes["changed"]:
+            self.show_chat_in_list(chat)
+            if self.current_chat and chat["id"] == self.current_chat["id"] and not chat.get("archived"):
+                self.merge_external_chat(chat)
+        for chat_id in changes["removed"]:
+            self.remove_chat_from_list(chat_id)
+
+    def merge_external_chat(self, chat: dict):
+        """Fold messages another instance added to the open chat into it"""
+        if self.is_generating:
+            return  # our save after the reply merges their messages as branches
+        current = self.current_chat
+        self.chat_manager.sync_tree(current)
+        new_nodes = {node_id: node for node_id, node in chat.get("nodes", {}).items()
+                     if node_id not in current["nodes"]}
+        if chat.get("title_locked") or not current.get("title_locked"):
+            current["title"] = chat.get("title", current.get("title"))
+            current["title_locked"] = chat.get("title_locked", False)
+        if not new_nodes:
+            return
+        current["nodes"].update(new_nodes)
+
+        # If their branch continues ours, follow it; otherwise theirs is just another branch
+        node_id = chat.get("head")
+        for _ in range(len(current["nodes"])):
+            if node_id is None or node_id == current.get("head"):
+                break
+            node_id = current["nodes"].get(node_id, {}).get("parent")
+        if node_id == current.get("head"):
+            self.chat_manager.switch_branch(current, chat.get("head"))
+            self.load_chat_into_ui(current)
+            self.transcript.scroll_to_bottom()
+
+    def on_memories_synced(self, memories: list):
+        """The memory file changed (merged by us or written elsewhere); keep our unsaved changes on top"""
+        for change in self.chat_store.unwritten_memory_changes():
+            memories = self.memory_manager.apply_change(memories, change)
+        self.memory_manager.memories = memories
+        for dialog in self.findChildren(MemoryViewDialog):
+            dialog.refresh_memories()
 
     def create_new_chat(self):
         chat = self.chat_manager.create_new_chat(save=False)
@@ -1149,27 +3265,28 @@ class AIChatGUI(QWidget):
             return
             
         chat_id = item.data(Qt.ItemDataRole.UserRole)
-        try:
-            chat = self.chat_manager.load_chat(chat_id)
-            self.current_chat = chat
-            self.load_chat_into_ui(chat)
-            self.chat_list.setCurrentItem(item)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Could not load chat:\n{e}")
+        self.loading_chat_id = chat_id
+        self.chat_list.setCurrentItem(item)
+        self.chat_store.request_chat(chat_id, self.on_chat_loaded, self.on_chat_load_error)
+
+    def on_chat_loaded(self, chat: dict):
+        # Ignore loads that were overtaken by a later click
+        if chat.get("id") != self.loading_chat_id or self.is_generating:
+            return
+        self.loading_chat_id = None
+        self.current_chat = chat
+        self.load_chat_into_ui(chat)
+
+    def on_chat_load_error(self, error_msg: str):
+        self.loading_chat_id = None
+        QMessageBox.critical(self, "Error", f"Could not load chat:\n{error_msg}")
 
     def load_chat_into_ui(self, chat_data: dict):
-        self.chat_display.clear()
-        messages = chat_data.get("messages", [])
-        for msg in messages:
-            role = msg.get("role", "")
-            # Skip system messages - they shouldn't be visible to user
-            if role == "system":
-                continue
-            content = msg.get("content", "")
-            created_at = msg.get("created_at")
-            html_block = self.format_message(role, content, created_at)
-            self.chat_display.append(html_block)
-        self.chat_display.append("")
+        # System messages are skipped by the transcript - they shouldn't be visible to user
+        self.transcript.set_messages(chat_data.get("messages", []))
+        self.schedule_token_count()
+        self.idle_scheduler.poke()
+        self.watch_store_files()
 
     def update_chat_title_from_first_message(self):
         if not self.current_chat:
@@ -1186,9 +3303,7 @@ class AIChatGUI(QWidget):
                 if len(title) > 40:
                     title = title[:40] + "."
                 self.current_chat["title"] = title if title else "New chat"
-                # do NOT lock here, auto-titles can still change
-                self.chat_manager.save_chat(self.current_chat)
-                self.refresh_chat_list()
+                # do NOT lock here, auto-titles can still change; the caller saves the chat
                 break
 
 
@@ -1202,47 +3317,251 @@ class AIChatGUI(QWidget):
 
         if file_path:
             self.MODEL_PATH = file_path
-            self.model_label.setText(f"Model: {os.path.basename(file_path)}")
             self.load_model()
 
+    def select_small_model_file(self):
+        if self.model is None:
+            QMessageBox.warning(self, "Warning", "Load the main model first!")
+            return
+        root = tk.Tk()
+        root.withdraw()
+        file_path = filedialog.askopenfilename(
+            title="Select a smaller GGUF Model",
+            filetypes=[("GGUF files", "*.gguf")]
+        )
+
+        if file_path:
+            try:
+                backend, loaded_text = self.create_model_backend(file_path)
+                self.use_backend(backend, loaded_text.replace("Model Loaded!", "Small model loaded!"), small=True)
+            except Exception as e:
+                QMessageBox.critical(self, "Error", f"Failed to load model:\n{e}")
+
     def load_model(self):
         try:
             if self.MODEL_PATH is None:
                 QMessageBox.warning(self, "Warning", "Please select a model file first!")
                 return
 
-            n_gpu_layers = -1 if self.USE_GPU else 0
-            n_batch = 2048 if self.USE_GPU else 512
-
-            self.model = Llama(
-                self.MODEL_PATH,
-                n_ctx=8192,
-                chat_format="chatml",
-                n_gpu_layers=n_gpu_layers,
-                n_batch=n_batch,
-                f16_kv=True
-            )
-            loaded_html = self.format_message(
-                "assistant",
-                "Model Loaded! Ready to chat. 🔥",
-                datetime.datetime.utcnow().isoformat()
-            )
-            self.chat_display.append(loaded_html)
-            self.chat_display.append("")
+            backend, loaded_text = self.create_model_backend(self.MODEL_PATH)
+            self.use_backend(backend, loaded_text)
 
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Failed to load model:\n{e}")
+
+    def create_model_backend(self, model_path: str):
+        """Load a GGUF with the current GPU/KV settings; returns (backend, message for the chat)"""
+        offload = {}
+        loaded_text = "Model Loaded! Ready to chat. 🔥"
+        kv_cache_type = self.model_settings["kv_cache_type"]
+        if self.USE_GPU == "auto":
+            plan = plan_for_model(
+                model_path,
+                n_ctx=MODEL_CONTEXT_TOKENS,
+                kv_bytes_per_element=KV_CACHE_BYTES_PER_ELEMENT[kv_cache_type]
+            )
+            n_gpu_layers = plan["n_gpu_layers"]
+            offload["main_gpu"] = plan["main_gpu"]
+            if plan["tensor_split"]:
+                offload["tensor_split"] = plan["tensor_split"]
+            loaded_text += f"\nOffload: {describe_plan(plan)}"
+        else:
+            n_gpu_layers = -1 if self.USE_GPU else 0
+        n_batch = 2048 if n_gpu_layers else 512
+
+        backend = LlamaCppBackend(
+            model_path,
+            n_gpu_layers=n_gpu_layers,
+            n_batch=n_batch,
+            n_ctx=MODEL_CONTEXT_TOKENS,
+            kv_cache_type=kv_cache_type,
+            flash_attn=self.model_settings["flash_attn"],
+            **offload
+        )
+        used = backend.load()
+        if used["type_k"] != kv_cache_type or used["flash_attn"] != self.model_settings["flash_attn"]:
+            loaded_text += (
+                f"\nKV cache fell back to {used['type_k']}/{used['type_v']}, "
+                f"flash attention {'on' if used['flash_attn'] else 'off'}."
+            )
+        return backend, loaded_text
+
+    def use_backend(self, backend: InferenceBackend, loaded_text: str, small: bool = False):
+        """Hand a loaded backend to the executor and release the one it replaces.
+
+        With a small model as well, the executor gets a ModelRouter over both.
+        """
+        if small:
+            previous, self.small_model = self.small_model, backend
+        else:
+            previous, self.model = self.model, backend
+        # The swap waits on the executor for a running reply, not here, and closes the old model after it
+        release = previous.close if previous is not None else None
+        if self.small_model is not None:
+            self.inference_executor.set_model(
+                ModelRouter([self.model, self.small_model], background_priority=PRIORITY_EXTRACTION), release
+            )
+            self.model_label.setText(f"Model: {self.model.model_id} + {self.small_model.model_id}")
+        else:
+            self.inference_executor.set_model(self.model, release)
+            self.model_label.setText(f"Model: {self.model.model_id}")
+        # Vectors are only comparable within one model, so each model has its own document store
+        self.document_store = DocumentStore(os.path.join(DOCUMENTS_DIR, self.model.model_id))
+
+        loaded_html = self.format_message(
+            "assistant",
+            loaded_text,
+            datetime.datetime.utcnow().isoformat()
+        )
+        self.transcript.append_note(loaded_html)
+        self.schedule_token_count()
+        self.idle_scheduler.poke()
     
+    # ===== PERSONAS =====
+
+    def show_persona_menu(self):
+        """Pick the LoRA adapter the current chat's replies are generated with"""
+        if not self.current_chat:
+            QMessageBox.warning(self, "Warning", "Open or start a chat first.")
+            return
+
+        current = self.current_chat.get("lora")
+        if current and current not in self.known_adapters:
+            self.known_adapters.append(current)
+
+        menu = QMenu(self)
+        base_action = menu.addAction("Base model")
+        base_action.setCheckable(True)
+        base_action.setChecked(not current)
+        base_action.triggered.connect(lambda: self.set_chat_adapter(None))
+        for path in self.known_adapters:
+            action = menu.addAction(os.path.basename(path))
+            action.setCheckable(True)
+            action.setChecked(path == current)
+            action.triggered.connect(lambda checked=False, path=path: self.set_chat_adapter(path))
+        menu.addSeparator()
+        menu.addAction("Choose LoRA adapter.").triggered.connect(self.choose_adapter_file)
+        menu.exec(self.persona_btn.mapToGlobal(QPoint(0, self.persona_btn.height())))
+
+    def choose_adapter_file(self):
+        root = tk.Tk()
+        root.withdraw()
+        file_path = filedialog.askopenfilename(
+            title="Select a LoRA Adapter (made for the loaded model)",
+            filetypes=[("GGUF files", "*.gguf")]
+        )
+        if file_path:
+            if file_path not in self.known_adapters:
+                self.known_adapters.append(file_path)
+            self.set_chat_adapter(file_path)
+
+    def set_chat_adapter(self, path: str):
+        """The adapter is applied by the next reply job, so switching costs nothing up front"""
+        if path:
+            self.current_chat["lora"] = path
+        else:
+            self.current_chat.pop("lora", None)
+        self.chat_store.save_chat(self.current_chat)
+        self.transcript.append_note(self.format_message(
+            "assistant", f"Persona: {os.path.basename(path) if path else 'base model'}",
+            datetime.datetime.utcnow().isoformat()
+        ))
+
+    # ===== DOCUMENTS =====
+
+    def show_documents_menu(self):
+        """Attach a document, or see what is already indexed for this model"""
+        if not self.model:
+            QMessageBox.warning(self, "Warning", "Documents are indexed with the loaded model. Please select a model first.")
+            return
+
+        menu = QMenu(self)
+        menu.addAction("Attach document.").triggered.connect(self.attach_document)
+        documents = self.document_store.list_documents()
+        if documents:
+            menu.addSeparator()
+            for doc in documents:
+                menu.addAction(f"{doc['name']} ({doc['chunks']} chunks)").setEnabled(False)
+        menu.exec(self.documents_btn.mapToGlobal(QPoint(0, self.documents_btn.height())))
+
+    def attach_document(self):
+        root = tk.Tk()
+        root.withdraw()
+        file_path = filedialog.askopenfilename(
+            title="Attach a Document",
+            filetypes=[("Documents", "*.txt *.md *.pdf"), ("All files", "*.*")]
+        )
+        if not file_path:
+            return
+
+        task = DocumentIngestTask(file_path, self.document_store)
+        self.transcript.append_note(self.format_message(
+            "assistant", f"Indexing {os.path.basename(file_path)} in the background.",
+            datetime.datetime.utcnow().isoformat()
+        ))
+        self.submit_document_batch(task)
+
+    def submit_document_batch(self, task: DocumentIngestTask):
+        self.inference_executor.submit(
+            task,
+            PRIORITY_BACKGROUND,
+            on_finished=lambda done: self.on_document_batch_finished(task, done),
+            on_error=lambda e: self.on_document_error(task, e)
+        )
+
+    def on_document_batch_finished(self, task: DocumentIngestTask, done: bool):
+        if not done:
+            self.submit_document_batch(task)
+            return
+        self.transcript.append_note(self.format_message(
+            "assistant", f"Indexed {os.path.basename(task.path)} ({task.total} chunks). "
+            "Relevant parts will be added to your messages.",
+            datetime.datetime.utcnow().isoformat()
+        ))
+        self.transcript.scroll_to_bottom()
+
+    def on_document_error(self, task: DocumentIngestTask, error_msg: str):
+        QMessageBox.critical(self, "Error", f"Could not index {os.path.basename(task.path)}:\n{error_msg}")
+
     def get_system_prompt_with_memories(self):
         """Generate system prompt with memory context"""
         base_prompt = SYSTEM_PROMPT
         memory_context = self.memory_manager.get_memories_as_context()
         return base_prompt + memory_context
 
-    def on_memory_detection_finished(self, formatted_memory: str):
-        """Called when memory detection finds something to remember"""
-        self.memory_manager.add_memory(formatted_memory, source="auto")
-        print(f"Memory saved: {formatted_memory}")
+    def on_memory_detection_finished(self, memories: list):
+        """Called when memory detection finishes, with the facts worth remembering (if any)"""
+        if not memories:
+            self.on_memory_detection_none()
+            return
+        for formatted_memory in memories:
+            self.memory_manager.add_memory(formatted_memory, source="auto")
+            print(f"Memory saved: {formatted_memory}")
+        self.schedule_memory_consolidation()
+        self.schedule_token_count()
+
+    def schedule_memory_consolidation(self):
+        """(Re)start the idle countdown before the next consolidation pass"""
+        self.consolidation_timer.start(MEMORY_CONSOLIDATION_IDLE_MS)
+
+    def run_memory_consolidation(self):
+        """Deduplicate memories in the background, but only while the model is idle"""
+        if self.is_generating or (self.consolidation_thread and self.consolidation_thread.isRunning()):
+            self.schedule_memory_consolidation()
+            return
+
+        self.consolidation_thread = MemoryConsolidationThread(
+            self.memory_consolidator, self.memory_manager.get_all_memories()
+        )
+        self.consolidation_thread.consolidated.connect(self.on_memory_consolidation_finished)
+        self.consolidation_thread.error.connect(lambda e: print(f"Memory consolidation error: {e}"))
+        self.consolidation_thread.start()
+
+    def on_memory_consolidation_finished(self, plans: list):
+        """Apply the duplicate-removal plans computed in the background"""
+        removed = self.memory_manager.apply_consolidation(plans)
+        if removed:
+            print(f"Memory consolidation removed {removed} duplicate(s)")
     
     def on_memory_detection_none(self):
         """Called when no memory needs to be saved"""
@@ -1252,53 +3571,174 @@ class AIChatGUI(QWidget):
         """Called when memory detection encounters an error"""
         print(f"Memory detection error: {error_msg}")
     
+    def schedule_token_count(self):
+        self.token_count_timer.start(TOKEN_COUNT_DEBOUNCE_MS)
+
+    def count_prompt_tokens(self):
+        """Queue a count of what the next request would send"""
+        if self.model is None:
+            return
+        messages = self.messages_for_model() if self.current_chat else []
+        self.token_counter.request({
+            "system": [msg["content"] for msg in messages if msg["role"] == "system"],
+            "chat": [msg["content"] for msg in messages if msg["role"] in ("user", "assistant")],
+            "draft": [self.user_input.toPlainText()]
+        })
+
+    def on_tokens_counted(self, counts: dict, prefill_tokens_per_s):
+        if self.model is not None:
+            self.context_meter.show_counts(counts, prefill_tokens_per_s)
+
+    def messages_for_model(self) -> list:
+        """Snapshot the active branch (the executor reads it on its own thread) with memories in the system message"""
+        return with_system_prompt(self.current_chat["messages"], self.get_system_prompt_with_memories())
+
+    # ===== IDLE PRECOMPUTATION =====
+
+    def plan_idle_work(self) -> list:
+        """Warm the KV for the open chat (with its latest reply) and the chats most likely opened next"""
+        if self.model is None or self.is_generating:
+            return []
+        system_prompt = self.get_system_prompt_with_memories()
+        chat_store = self.chat_store
+        tasks = []
+
+        if self.current_chat and len(self.current_chat["messages"]) > 1:
+            current = copy.deepcopy(self.current_chat)
+            tasks.append(lambda model, cancelled: warm_chat(model, current, system_prompt, cancelled))
+
+        current_id = self.current_chat["id"] if self.current_chat else None
+        recent = [
+            self.chat_list.item(i).data(Qt.ItemDataRole.UserRole) for i in range(self.chat_list.count())
+        ]
+        for chat_id in [chat_id for chat_id in recent if chat_id != current_id][:IDLE_WARM_CHATS]:
+            # Other chats aren't being edited; their latest version may still be a pending snapshot
+            tasks.append(lambda model, cancelled, chat_id=chat_id: warm_chat(
+                model, chat_store.read_chat(chat_id), system_prompt, cancelled
+            ))
+
+        if len(tasks) > 1:
+            # Finish on the open chat, so the live context holds it (restored from its checkpoint)
+            tasks.append(tasks[0])
+        return tasks
+
     def start_ai_response(self):
-        """Start AI response generation after memory detection is complete"""
-        self.send_button.setText("Generating...")
-        
-        # Update system message with memories (including any just added)
-        messages_with_memory = self.current_chat["messages"].copy()
-        for msg in messages_with_memory:
-            if msg["role"] == "system":
-                msg["content"] = self.get_system_prompt_with_memories()
-                break
+        """Queue AI response generation at interactive priority"""
+        messages_with_memory = self.messages_for_model()
+
+        store = self.document_store
+        chat_index, chat_id = self.chat_manager.chat_index, self.current_chat["id"]
+        adapter = self.current_chat.get("lora")
+        self.reply_job = self.inference_executor.submit(
+            lambda model: generate_reply(
+                model, add_retrieved_context(model, messages_with_memory, store, chat_index, chat_id), adapter
+            ),
+            PRIORITY_INTERACTIVE,
+            on_finished=self.on_ai_response_finished,
+            on_error=self.on_ai_response_error
+        )
+
+    def start_alternatives(self):
+        """Queue drafting CANDIDATE_COUNT replies at once at interactive priority"""
+        messages_with_memory = self.messages_for_model()
+
+        store = self.document_store
+        chat_index, chat_id = self.chat_manager.chat_index, self.current_chat["id"]
+        adapter = self.current_chat.get("lora")
+        self.reply_job = self.inference_executor.submit(
+            lambda model: generate_alternatives(
+                model, add_retrieved_context(model, messages_with_memory, store, chat_index, chat_id), adapter
+            ),
+            PRIORITY_INTERACTIVE,
+            on_finished=self.on_alternatives_finished,
+            on_error=self.on_ai_response_error
+        )
+
+    def on_alternatives_finished(self, candidates: list):
+        """Let the user pick a draft; the others are kept as sibling branches.
+
+        Cancelling the dialog keeps every draft as a branch and leaves the active branch as it was.
+        """
+        self.remove_typing_indicator()
+        candidates = [text for text in candidates if text.strip()]
+        if not candidates:  # e.g. stopped before anything was drafted
+            self.on_ai_response_error("No replies were drafted.")
+            return
+        dialog = CandidateDialog(candidates, self)
+        chosen = dialog.selected_index() if dialog.exec() else None
 
-        self.worker_thread = AIWorkerThread(self.model, messages_with_memory)
-        self.worker_thread.finished.connect(self.on_ai_response_finished)
-        self.worker_thread.error.connect(self.on_ai_response_error)
-        self.worker_thread.start()
+        parent_id = self.current_chat["messages"][-1]["id"]
+        now_iso = datetime.datetime.utcnow().isoformat()
+        for index, text in enumerate(candidates):
+            if index != chosen:
+                self.chat_manager.add_branch(
+                    self.current_chat, parent_id,
+                    {"id": str(uuid.uuid4()), "role": "assistant", "content": text, "created_at": now_iso}
+                )
+        if chosen is None:
+            self.is_generating = False
+            self.reply_job = None
+            self.send_button.setText("Send")
+            self.chat_store.save_chat(self.current_chat)
+            self.idle_scheduler.poke()
+            return
+        self.on_ai_response_finished(candidates[chosen])
 
     def on_ai_response_finished(self, response: str):
         """Called when AI generation completes successfully"""
         self.is_generating = False
+        self.reply_job = None
         self.remove_typing_indicator()
-        
+        self.send_button.setText("Send")
+        if not response:  # stopped before the first token
+            self.idle_scheduler.poke()
+            return
+
         ai_now = datetime.datetime.utcnow().isoformat()
-        ai_html = self.format_message("assistant", response, ai_now)
-        self.chat_display.append(ai_html)
-        self.chat_display.append("")
+        ai_msg = {"id": str(uuid.uuid4()), "role": "assistant", "content": response, "created_at": ai_now}
+        separator = {"role": "separator", "content": ""}
+        self.current_chat["messages"].append(ai_msg)
+        self.current_chat["messages"].append(separator)
+        self.transcript.append_message(ai_msg)
+        self.transcript.append_message(separator)
 
-        self.current_chat["messages"].append(
-            {"role": "assistant", "content": response, "created_at": ai_now}
-        )
-        self.current_chat["messages"].append(
-            {"role": "separator", "content": ""}
-        )
+        self.chat_store.save_chat(self.current_chat)
+        self.schedule_token_count()
+        self.idle_scheduler.poke()
 
-        self.chat_manager.save_chat(self.current_chat)
-        
-        self.send_button.setEnabled(True)
-        self.send_button.setText("Send")
-    
     def on_ai_response_error(self, error_msg: str):
         """Called when AI generation fails"""
         self.is_generating = False
+        self.reply_job = None
         self.remove_typing_indicator()
-        
+        self.send_button.setText("Send")
+
         QMessageBox.critical(self, "Error", f"Error generating response:\n{error_msg}")
-        
-        self.send_button.setEnabled(True)
+
+    def on_send_clicked(self):
+        """The button sends, or stops the reply while one is being generated"""
+        if self.is_generating:
+            self.stop_generation()
+        else:
+            self.send_message()
+
+    def stop_generation(self, discard: bool = False):
+        """Stop the reply being generated; what it got to is kept as the reply unless discard"""
+        job = self.reply_job
+        if job is None or not self.is_generating:
+            return
+        if not job.cancel():
+            # The executor's model: with a small model too it is the router, which cancels on both
+            self.inference_executor.model.cancel()  # the running reply ends at its next token
+            if not discard:
+                return  # ...and arrives through on_ai_response_finished as usual
+            job.finished.disconnect()
+            job.error.disconnect()
+        self.is_generating = False
+        self.reply_job = None
+        self.remove_typing_indicator()
         self.send_button.setText("Send")
+        self.idle_scheduler.poke()
 
     def send_message(self):
         if not self.model:
@@ -1319,31 +3759,183 @@ class AIChatGUI(QWidget):
         self.user_input.clear()
 
         now_iso = datetime.datetime.utcnow().isoformat()
-        user_html = self.format_message("user", user_text, now_iso)
-        self.chat_display.append(user_html)
-
-        user_msg = {"role": "user", "content": user_text, "created_at": now_iso}
+        user_msg = {"id": str(uuid.uuid4()), "role": "user", "content": user_text, "created_at": now_iso}
         self.current_chat["messages"].append(user_msg)
+        self.transcript.append_message(user_msg)
+        self.transcript.scroll_to_bottom()
 
         self.update_chat_title_from_first_message()
-        self.chat_manager.save_chat(self.current_chat)
-        self.refresh_chat_list()
+        self.chat_store.save_chat(self.current_chat)
+        self.show_chat_in_list(self.current_chat)
 
-        self.chat_display.append("")
-        
+        # The reply goes first; memory extraction runs on the executor right after it
+        self.begin_reply()
+        self.submit_memory_extraction(user_text)
+
+    def begin_reply(self, alternatives: bool = False):
+        """Show the typing indicator, lock the send button and queue the reply (or several drafts)"""
+        self.idle_scheduler.preempt()  # a running warm-up stops within one chunk
         self.show_typing_indicator()
-        
-        self.send_button.setEnabled(False)
-        self.send_button.setText("Processing...")
+
+        self.send_button.setText("Stop")
         self.is_generating = True
 
-        # First, run memory detection, then generate response
-        self.memory_thread = MemoryDetectionThread(self.model, user_text, self.current_chat["messages"])
-        self.memory_thread.memory_found.connect(self.on_memory_detection_finished)
-        self.memory_thread.no_memory.connect(self.on_memory_detection_none)
-        self.memory_thread.error.connect(self.on_memory_detection_error)
-        self.memory_thread.finished.connect(self.start_ai_response)  # Start AI after memory is done
-        self.memory_thread.start()
+        if alternatives:
+            self.start_alternatives()
+        else:
+            self.start_ai_response()
+
+    def submit_memory_extraction(self, user_text: str):
+        self.extraction_job = self.inference_executor.submit(
+            MemoryExtractionTask(user_text),
+            PRIORITY_EXTRACTION,
+            on_finished=self.on_memory_detection_finished,
+            on_error=self.on_memory_detection_error
+        )
+
+    # ===== BRANCHING =====
+
+    def can_branch(self) -> bool:
+        """Regenerate / edit need a loaded model, an idle model and an open chat"""
+        if not self.model:
+            QMessageBox.warning(self, "Warning", "No model loaded! Please select a model first.")
+            return False
+        if self.is_generating:
+            QMessageBox.warning(self, "Please Wait", "Please wait for the current response to finish.")
+            return False
+        return self.current_chat is not None
+
+    @staticmethod
+    def preview_text(text: str, limit: int = 40) -> str:
+        text = " ".join(text.split())
+        return text[:limit] + "." if len(text) > limit else text
+
+    def regenerate_reply(self, alternatives: bool = False):
+        """Generate a new reply to the last user message; the old reply stays as a sibling branch.
+
+        A reply still being generated is stopped and dropped instead.
+        """
+        self.stop_generation(discard=True)
+        if not self.can_branch():
+            return
+
+        messages = self.current_chat["messages"]
+        user_indexes = [i for i, msg in enumerate(messages) if msg["role"] == "user"]
+        if not user_indexes:
+            QMessageBox.information(self, "Regenerate", "There is no message to reply to yet.")
+            return
+
+        # Record the current branch in the tree before cutting it off the active path
+        self.chat_manager.sync_tree(self.current_chat)
+        del messages[user_indexes[-1] + 1:]
+        self.load_chat_into_ui(self.current_chat)
+        self.transcript.scroll_to_bottom()
+        self.begin_reply(alternatives)
+
+    def show_alternatives(self):
+        """Draft several replies to the last user message in one batched pass and pick one"""
+        self.regenerate_reply(alternatives=True)
+
+    def show_edit_menu(self):
+        """Pick one of your messages on this branch to edit and resend"""
+        if not self.can_branch():
+            return
+
+        user_msgs = [msg for msg in self.current_chat["messages"] if msg["role"] == "user"]
+        if not user_msgs:
+            QMessageBox.information(self, "Edit Message", "There are no messages to edit yet.")
+            return
+
+        menu = QMenu(self)
+        for msg in reversed(user_msgs):
+            action = menu.addAction(self.preview_text(msg["content"]))
+            action.triggered.connect(lambda checked=False, msg_id=msg["id"]: self.edit_and_resend(msg_id))
+        menu.exec(self.edit_btn.mapToGlobal(QPoint(0, self.edit_btn.height())))
+
+    def edit_and_resend(self, msg_id: str):
+        """Fork the conversation at msg_id with an edited copy of that message"""
+        messages = self.current_chat["messages"]
+        index = next((i for i, msg in enumerate(messages) if msg.get("id") == msg_id), None)
+        if index is None:
+            return
+
+        new_text, ok = QInputDialog.getMultiLineText(
+            self, "Edit Message", "Edit your message:", messages[index]["content"]
+        )
+        new_text = new_text.strip()
+        if not ok or not new_text:
+            return
+
+        # The edited message becomes a sibling of the original; everything before it is shared
+        self.chat_manager.sync_tree(self.current_chat)
+        del messages[index:]
+        now_iso = datetime.datetime.utcnow().isoformat()
+        messages.append({"id": str(uuid.uuid4()), "role": "user", "content": new_text, "created_at": now_iso})
+        self.load_chat_into_ui(self.current_chat)
+        self.transcript.scroll_to_bottom()
+
+        self.update_chat_title_from_first_message()
+        self.chat_store.save_chat(self.current_chat)
+        self.show_chat_in_list(self.current_chat)
+
+        self.begin_reply()
+        self.submit_memory_extraction(new_text)
+
+    def branch_label(self, leaf_id: str) -> str:
+        """Describe a branch by the last message you sent on it"""
+        nodes = self.current_chat["nodes"]
+        node_id = leaf_id
+        while node_id is not None and node_id in nodes:
+            node = nodes[node_id]
+            if node["role"] == "user":
+                return self.preview_text(node["content"])
+            node_id = node.get("parent")
+        return "(empty)"
+
+    def show_branch_menu(self):
+        """List every branch of the current chat and switch to the chosen one"""
+        if self.is_generating:
+            QMessageBox.warning(self, "Please Wait", "Please wait for the current response to finish.")
+            return
+        if not self.current_chat:
+            return
+
+        self.chat_manager.sync_tree(self.current_chat)
+        leaves = self.chat_manager.branch_leaves(self.current_chat)
+        if len(leaves) < 2:
+            QMessageBox.information(
+                self, "Branches",
+                "This chat has a single branch. Regenerate a reply or edit a message to start another."
+            )
+            return
+
+        menu = QMenu(self)
+        for number, leaf_id in enumerate(leaves, start=1):
+            action = menu.addAction(f"Branch {number}: {self.branch_label(leaf_id)}")
+            action.setCheckable(True)
+            action.setChecked(leaf_id == self.current_chat.get("head"))
+            action.triggered.connect(lambda checked=False, leaf_id=leaf_id: self.switch_branch(leaf_id))
+        menu.exec(self.branches_btn.mapToGlobal(QPoint(0, self.branches_btn.height())))
+
+    def switch_branch(self, leaf_id: str):
+        self.chat_manager.switch_branch(self.current_chat, leaf_id)
+        self.load_chat_into_ui(self.current_chat)
+        self.transcript.scroll_to_bottom()
+        self.chat_store.save_chat(self.current_chat)
+
+    def shutdown(self):
+        """Stop background threads before the app exits; pending chat/memory writes are flushed"""
+        self.idle_scheduler.preempt()
+        if self.transfer_thread is not None:
+            self.transfer_thread.cancel()
+            self.transfer_thread.wait()
+        if self.inference_executor.model is not None:
+            self.inference_executor.model.cancel()  # so stopping the executor doesn't wait for a whole reply
+        self.inference_executor.stop()
+        for backend in (self.model, self.small_model):
+            if backend is not None:
+                backend.close()
+        self.chat_store.stop()
 
 
 class MainApp(QStackedWidget):
@@ -1363,6 +3955,11 @@ class MainApp(QStackedWidget):
         self.addWidget(self.chat_screen)
         self.setCurrentWidget(self.chat_screen)
 
+    def closeEvent(self, event):
+        if self.chat_screen:
+            self.chat_screen.shutdown()
+        super().closeEvent(event)
+
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
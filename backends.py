@@ -0,0 +1,1053 @@
+"""Inference backends behind one interface: load, tokenize, complete, stream, embed, cancel.
+
+    LlamaCppBackend      a local GGUF model through llama-cpp-python
+    StubBackend          deterministic replies with simulated prefill/decode speed,
+                         so the UI, storage and scheduling can run without a model
+    OpenAICompatBackend  any server that speaks the OpenAI HTTP API
+                         (llama.cpp server, vLLM, LM Studio, Ollama...)
+
+Messages are OpenAI-style {"role", "content"} dicts. complete() returns
+{"text", "finish_reason", "prompt_tokens", "completion_tokens", "ttft_s"}
+(ttft_s is None when the backend can't tell); stream() yields text pieces. cancel() may be called from any thread and stops the
+request that is running. set_adapter() applies a LoRA adapter on top of
+the loaded weights, and prefill() reads a conversation into the KV cache
+ahead of its next request, where the backend supports them.
+
+create_backend() turns a spec string into a backend: a .gguf path, "stub",
+"stub:prefill=800,decode=25" or "openai:http://127.0.0.1:8080/v1". The
+AI_CHAT_BACKEND environment variable uses the same format, and
+AI_CHAT_SMALL_BACKEND adds a smaller model for model_router.ModelRouter.
+"""
+import os
+import re
+import json
+import time
+import zlib
+import codecs
+import ctypes
+import random
+import bisect
+import itertools
+import threading
+import collections
+import urllib.request
+
+import numpy as np
+
+try:
+    import llama_cpp
+    from llama_cpp import Llama, LlamaGrammar, LlamaRAMCache, LogitsProcessorList
+    from llama_cpp._internals import LlamaContext, LlamaBatch, LlamaSampler
+    from llama_cpp.llama_chat_format import format_chatml
+except ImportError:  # the stub and HTTP backends work without llama-cpp-python
+    llama_cpp = None
+
+
+BACKEND_ENV = "AI_CHAT_BACKEND"
+SMALL_BACKEND_ENV = "AI_CHAT_SMALL_BACKEND"
+KV_CHECKPOINT_CACHE_MB = 1024  # RAM for KV states of branch prefixes, so switching branches skips their prefill
+CANDIDATE_MAX_TOKENS = 200
+EMBED_CONTEXT = 1024  # tokens; longer texts are truncated by the embedder
+LORA_CACHE_SIZE = 4  # adapters kept loaded next to the base weights
+LORA_CHECKPOINT_CACHE_MB = 256  # KV checkpoints kept per cached adapter
+PREFILL_CHUNK_TOKENS = 128  # prefill() checks for preemption between chunks of this size
+CHATML_GENERATION_PROMPT = "<|im_start|>assistant\n"
+CONTEXT_SHIFT_FREE_TOKENS = 1024  # freed beyond what's needed when old turns are shifted out, so the next turns fit too
+
+# KV cache element types (ggml type ids) selectable for type_k / type_v
+KV_CACHE_TYPES = {
+    "f16": 1,
+    "q8_0": 8,  # ~half the memory of f16
+    "q4_0": 2   # ~quarter the memory of f16
+}
+KV_CACHE_BYTES_PER_ELEMENT = {"f16": 2, "q8_0": 34 / 32, "q4_0": 18 / 32}
+
+_GRAMMAR_CACHE = {}
+
+
+def create_llama(model_path, n_gpu_layers=0, n_batch=512, n_ctx=8192,
+                 kv_cache_type="f16", flash_attn=False, **extra):
+    """Creates a Llama with the requested KV cache type and flash attention.
+
+    Falls back step by step when the build or model doesn't support a setting:
+    quantized K+V with flash attention -> quantized K only -> plain f16.
+    Returns (model, settings actually used). Raises if even the plain load fails.
+    """
+    attempts = []
+    if kv_cache_type != "f16":
+        if flash_attn:
+            # llama.cpp can only quantize the V cache when flash attention is on
+            attempts.append({"type_k": kv_cache_type, "type_v": kv_cache_type, "flash_attn": True})
+        attempts.append({"type_k": kv_cache_type, "type_v": "f16", "flash_attn": False})
+    elif flash_attn:
+        attempts.append({"type_k": "f16", "type_v": "f16", "flash_attn": True})
+    attempts.append({"type_k": "f16", "type_v": "f16", "flash_attn": False})
+
+    last_error = None
+    for settings in attempts:
+        kv_params = {}
+        if settings["type_k"] != "f16" or settings["type_v"] != "f16":
+            kv_params = {
+                "type_k": KV_CACHE_TYPES[settings["type_k"]],
+                "type_v": KV_CACHE_TYPES[settings["type_v"]]
+            }
+        try:
+            model = Llama(
+                model_path,
+                n_ctx=n_ctx,
+                chat_format="chatml",
+                n_gpu_layers=n_gpu_layers,
+                n_batch=n_batch,
+                flash_attn=settings["flash_attn"],
+                **kv_params,
+                **extra
+            )
+            return model, settings
+        except Exception as e:
+            last_error = e
+            print(f"Could not load with KV cache {settings['type_k']}/{settings['type_v']}, "
+                  f"flash_attn={settings['flash_attn']}: {e}")
+    raise last_error
+
+
+def get_json_grammar(schema: dict):
+    """Compile a JSON schema into a llama.cpp grammar once and reuse it for every call"""
+    key = json.dumps(schema, sort_keys=True)
+    grammar = _GRAMMAR_CACHE.get(key)
+    if grammar is None:
+        grammar = LlamaGrammar.from_json_schema(key, verbose=False)
+        _GRAMMAR_CACHE[key] = grammar
+    return grammar
+
+
+class InferenceBackend:
+    """Base class. Subclasses implement load/tokenize/stream/embed; complete and
+    complete_many fall back to collecting stream() output."""
+    supports_json_schema = False
+
+    def __init__(self):
+        self._cancel = threading.Event()
+
+    @property
+    def model_id(self) -> str:
+        """Stable name of the loaded model (used e.g. to keep per-model document indexes apart)"""
+        return "model"
+
+    def load(self) -> dict:
+        """Load the model; returns the settings actually used"""
+        return {}
+
+    def tokenize(self, text: str) -> list:
+        raise NotImplementedError
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenize(text))
+
+    def count_tokens_many(self, texts: list) -> list:
+        """Token count of each text; remote backends answer them all in one request"""
+        return [self.count_tokens(text) for text in texts]
+
+    def prefill_tokens_per_s(self):
+        """Measured prompt processing speed, or None before there is a measurement"""
+        return None
+
+    def for_priority(self, priority: int):
+        """The backend a job of this priority should use (see ModelRouter)"""
+        return self
+
+    def set_adapter(self, path: str = None, scale: float = 1.0):
+        """Apply a LoRA adapter to the following requests (None for the plain model)"""
+        if path:
+            raise NotImplementedError(f"{type(self).__name__} can't apply LoRA adapters")
+
+    def prefill(self, messages: list, cancelled=lambda: False) -> bool:
+        """Evaluate a conversation into the KV cache, so a request that continues it
+        only has to read what comes after. Stops early once cancelled() is true;
+        returns whether the whole conversation is cached."""
+        return False
+
+    def complete(self, messages: list, max_tokens: int = 200, temperature: float = 0.2,
+                 seed: int = None, json_schema: dict = None, checkpoint: bool = False) -> dict:
+        """Generate one reply. json_schema constrains the output where supported;
+        checkpoint asks the backend to keep the KV state for later prefix reuse."""
+        started = time.perf_counter()
+        first_piece_at = None
+        pieces = []
+        for piece in self.stream(messages, max_tokens, temperature, seed):
+            if first_piece_at is None:
+                first_piece_at = time.perf_counter()
+            pieces.append(piece)
+        return {
+            "text": "".join(pieces),
+            "finish_reason": "length" if len(pieces) >= max_tokens else "stop",
+            "prompt_tokens": sum(self.count_tokens(m["content"]) for m in messages),
+            "completion_tokens": len(pieces),
+            "ttft_s": (first_piece_at or time.perf_counter()) - started
+        }
+
+    def stream(self, messages: list, max_tokens: int = 200, temperature: float = 0.2, seed: int = None):
+        raise NotImplementedError
+
+    def complete_many(self, messages: list, n: int, max_tokens: int = CANDIDATE_MAX_TOKENS,
+                      temperature: float = 0.8) -> list:
+        """n alternative replies to the same conversation"""
+        return [
+            self.complete(messages, max_tokens, temperature, seed=random.randrange(2 ** 31))["text"].strip()
+            for _ in range(n)
+        ]
+
+    def embed(self, texts: list) -> np.ndarray:
+        """Normalized embeddings, one row per text"""
+        raise NotImplementedError
+
+    def cancel(self):
+        """Stop the running request early (safe to call from any thread)"""
+        self._cancel.set()
+
+    def close(self):
+        pass
+
+
+# ===== LLAMA.CPP =====
+
+def apply_lora(ctx, adapter, scale: float = 1.0):
+    """Make adapter the only LoRA active on a llama context (None clears it)"""
+    if hasattr(llama_cpp, "llama_set_adapters_lora"):
+        if adapter is None:
+            result = llama_cpp.llama_set_adapters_lora(ctx, None, 0, None)
+        else:
+            adapters = (llama_cpp.llama_adapter_lora_p_ctypes * 1)(adapter)
+            scales = (ctypes.c_float * 1)(scale)
+            result = llama_cpp.llama_set_adapters_lora(ctx, adapters, 1, scales)
+    else:  # llama-cpp-python before the adapters were set as a list
+        llama_cpp.llama_clear_adapter_lora(ctx)
+        result = llama_cpp.llama_set_adapter_lora(ctx, adapter, scale) if adapter is not None else 0
+    if result:
+        raise RuntimeError(f"llama.cpp refused the LoRA adapter (error {result})")
+
+
+class CandidateDecoder:
+    """Drafts several replies to one prompt as parallel sequences of a single llama context.
+
+    The prompt is evaluated once into sequence 0 and its KV cells are shared
+    with the other sequences (unified KV cache), then every unfinished
+    candidate advances by one token per batched decode. The main context only
+    holds one sequence, so this uses a second context on the same weights,
+    sized to the prompt plus the candidates and reused while it is big enough.
+    """
+    def __init__(self):
+        self.model = None
+        self.ctx = None
+        self.batch = None
+        self.n_ctx = 0
+        self.n_seq = 0
+
+    def _ensure_context(self, model, n_ctx: int, n_seq: int):
+        if self.model is model and self.n_ctx >= n_ctx and self.n_seq >= n_seq:
+            return
+        self.close()
+        params = llama_cpp.llama_context_params.from_buffer_copy(model.context_params)
+        params.n_ctx = n_ctx
+        params.n_seq_max = n_seq
+        params.kv_unified = True
+        self.ctx = LlamaContext(model=model._model, params=params, verbose=False)
+        self.batch = LlamaBatch(n_tokens=max(model.n_batch, n_seq), embd=0, n_seq_max=n_seq, verbose=False)
+        self.model, self.n_ctx, self.n_seq = model, n_ctx, n_seq
+
+    def close(self):
+        if self.ctx is not None:
+            self.batch.close()
+            self.ctx.close()
+        self.model = self.ctx = self.batch = None
+        self.n_ctx = self.n_seq = 0
+
+    def generate(self, model, messages: list, n: int, max_tokens: int, temperature: float,
+                 cancelled=lambda: False, lora=(None, 1.0)) -> list:
+        # create_llama always loads models with the chatml format
+        formatted = format_chatml(messages)
+        tokens = model.tokenize(formatted.prompt.encode("utf-8"), add_bos=True, special=True)
+        n_ctx = (len(tokens) + n * max_tokens) // 256 * 256 + 256
+        self._ensure_context(model, n_ctx, n)
+        ctx, batch, n_batch = self.ctx, self.batch, model.n_batch
+        apply_lora(ctx.ctx, *lora)  # adapters are per context, so mirror the main one
+        ctx.kv_cache_clear()
+
+        try:
+            for start in range(0, len(tokens), n_batch):
+                batch.set_batch(tokens[start:start + n_batch], n_past=start, logits_all=False)
+                ctx.decode(batch)
+            last = batch.n_tokens() - 1
+            for seq in range(1, n):
+                ctx.kv_cache_seq_cp(0, seq, 0, -1)
+
+            samplers = []
+            seed = random.randrange(2 ** 31)
+            for seq in range(n):
+                sampler = LlamaSampler()
+                sampler.add_top_k(40)
+                sampler.add_top_p(0.95, 1)
+                sampler.add_temp(temperature)
+                sampler.add_dist(seed + seq)
+                samplers.append(sampler)
+
+            vocab = llama_cpp.llama_model_get_vocab(model.model)
+            next_tokens = [sampler.sample(ctx, last) for sampler in samplers]
+            outputs = [[] for _ in range(n)]
+            active = list(range(n))
+            pos = len(tokens)
+            while not cancelled():
+                active = [seq for seq in active if not llama_cpp.llama_vocab_is_eog(vocab, next_tokens[seq])]
+                for seq in active:
+                    outputs[seq].append(next_tokens[seq])
+                active = [seq for seq in active if len(outputs[seq]) < max_tokens]
+                if not active:
+                    break
+
+                # One decode step for every unfinished candidate, each in its own sequence
+                raw = batch.batch
+                raw.n_tokens = len(active)
+                for i, seq in enumerate(active):
+                    raw.token[i] = next_tokens[seq]
+                    raw.pos[i] = pos
+                    raw.seq_id[i][0] = seq
+                    raw.n_seq_id[i] = 1
+                    raw.logits[i] = True
+                ctx.decode(batch)
+                for i, seq in enumerate(active):
+                    next_tokens[seq] = samplers[seq].sample(ctx, i)
+                pos += 1
+        finally:
+            ctx.kv_cache_clear()
+
+        candidates = []
+        for output in outputs:
+            text = model.detokenize(output).decode("utf-8", errors="ignore")
+            candidates.append(text.split(formatted.stop)[0].strip())
+        return candidates
+
+
+class LlamaCppBackend(InferenceBackend):
+    supports_json_schema = True
+
+    def __init__(self, model_path: str, n_gpu_layers: int = 0, n_batch: int = 512, n_ctx: int = 8192,
+                 kv_cache_type: str = "f16", flash_attn: bool = False,
+                 kv_checkpoint_mb: int = KV_CHECKPOINT_CACHE_MB, **extra):
+        super().__init__()
+        self.model_path = model_path
+        self.load_args = dict(
+            n_gpu_layers=n_gpu_layers, n_batch=n_batch, n_ctx=n_ctx,
+            kv_cache_type=kv_cache_type, flash_attn=flash_attn, **extra
+        )
+        self.kv_checkpoint_mb = kv_checkpoint_mb
+        self.model = None
+        self.settings = None
+        self.kv_checkpoints = None
+        self.base_checkpoints = None
+        self.candidates = CandidateDecoder()
+        self.embedding_model = None
+        self.first_token_at = None
+        self.can_shift = False
+        self.adapters = collections.OrderedDict()  # path -> loaded adapter, least recently used first
+        self.adapter = None  # (path, scale) of the active adapter
+        self.adapter_checkpoints = {}  # (path, scale) -> that adapter's KV checkpoints
+
+    @property
+    def model_id(self) -> str:
+        return os.path.splitext(os.path.basename(self.model_path))[0]
+
+    def load(self) -> dict:
+        if llama_cpp is None:
+            raise RuntimeError("llama-cpp-python is not installed")
+        self.model, self.settings = create_llama(self.model_path, **self.load_args)
+        # Some models (e.g. recurrent ones) can't move KV cells; long chats then re-read the turns they keep
+        self.can_shift = bool(llama_cpp.llama_memory_can_shift(self.model._ctx.memory))
+        # KV states are only valid for the model that produced them
+        if self.kv_checkpoint_mb:
+            self.kv_checkpoints = LlamaRAMCache(capacity_bytes=self.kv_checkpoint_mb * 1024 * 1024)
+        self.base_checkpoints = self.kv_checkpoints
+        return self.settings
+
+    def tokenize(self, text: str) -> list:
+        return self.model.tokenize(text.encode("utf-8"), add_bos=False)
+
+    def prefill_tokens_per_s(self):
+        # llama.cpp's own counters only include prompt tokens that were really evaluated
+        perf = llama_cpp.llama_perf_context(self.model.ctx)
+        if perf.n_p_eval == 0 or perf.t_p_eval_ms <= 0:
+            return None
+        return perf.n_p_eval / (perf.t_p_eval_ms / 1000)
+
+    def set_adapter(self, path: str = None, scale: float = 1.0):
+        """Switch the LoRA adapter without touching the base weights.
+
+        Loaded adapters stay in an LRU cache of LORA_CACHE_SIZE, so switching
+        between personas only re-points the context at other adapter tensors.
+        KV state computed under one adapter is wrong for another, so the
+        context starts over and every adapter keeps its own KV checkpoints;
+        switching back to a chat restores its prefix instead of prefilling it.
+        """
+        key = (path, scale) if path else None
+        if key == self.adapter:
+            return
+        adapter = None
+        if path:
+            adapter = self.adapters.pop(path, None)
+            if adapter is None:
+                adapter = llama_cpp.llama_adapter_lora_init(self.model.model, path.encode("utf-8"))
+                if not adapter:
+                    raise RuntimeError(f"Failed to load LoRA adapter: {path}")
+            self.adapters[path] = adapter
+            while len(self.adapters) > LORA_CACHE_SIZE:
+                evicted, evicted_adapter = self.adapters.popitem(last=False)
+                llama_cpp.llama_adapter_lora_free(evicted_adapter)
+                for evicted_key in [k for k in self.adapter_checkpoints if k[0] == evicted]:
+                    del self.adapter_checkpoints[evicted_key]
+        apply_lora(self.model.ctx, adapter, scale)
+        self.model.reset()
+
+        if key is None or not self.kv_checkpoint_mb:
+            self.kv_checkpoints = self.base_checkpoints
+        else:
+            if key not in self.adapter_checkpoints:
+                self.adapter_checkpoints[key] = LlamaRAMCache(capacity_bytes=LORA_CHECKPOINT_CACHE_MB * 1024 * 1024)
+            self.kv_checkpoints = self.adapter_checkpoints[key]
+        self.adapter = key
+
+    # ===== CONTEXT SHIFT =====
+    # A conversation longer than the context keeps its system message (the
+    # memories are injected there) and leaves out its oldest turns. Rather
+    # than prefilling the shortened prompt from scratch, the left-out turns
+    # are removed from the live KV cache and the cells after them are moved
+    # down (llama.cpp's KV shift re-rotates their positions), so only new
+    # turns are read. A reply that fills the context shifts turns out the
+    # same way and keeps going. Shifted cells keep what they attended to
+    # before the shift, which is the approximation llama.cpp's own context
+    # shift makes.
+
+    @staticmethod
+    def _chatml_messages(messages: list) -> list:
+        """The messages format_chatml renders: the first system message (always, empty if
+        there is none) followed by the user and assistant turns. Other roles, such as the
+        chat window's separators, and later system messages are left out, as it does."""
+        system = next((msg.get("content") or "" for msg in messages if msg["role"] == "system"), "")
+        return [{"role": "system", "content": system}] + [
+            {"role": msg["role"], "content": msg["content"] if isinstance(msg["content"], str) else None}
+            for msg in messages if msg["role"] in ("user", "assistant")
+        ]
+
+    def _message_tokens(self, messages: list) -> list:
+        """Token block of every message as format_chatml lays it out; joined they are the prompt"""
+        blocks = []
+        for msg in messages:
+            if msg["role"] == "system" or msg["content"]:
+                text = f"<|im_start|>{msg['role']}\n{msg['content']}<|im_end|>\n"
+            else:
+                text = f"<|im_start|>{msg['role']}\n"  # format_chatml leaves empty turns open
+            blocks.append(self.model.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+        return blocks
+
+    def _shift_context(self, n_keep: int, n_discard: int):
+        """Drop the n_discard KV cells after the first n_keep and move the rest down to close the gap"""
+        n_tokens = self.model.n_tokens
+        self.model._ctx.kv_cache_seq_rm(0, n_keep, n_keep + n_discard)
+        self.model._ctx.kv_cache_seq_shift(0, n_keep + n_discard, -1, -n_discard)
+        ids = self.model.input_ids
+        ids[n_keep:n_tokens - n_discard] = ids[n_keep + n_discard:n_tokens]
+        self.model.n_tokens = n_tokens - n_discard
+
+    def _fit_context(self, messages: list, reserve: int) -> tuple:
+        """Leave out the oldest turns so the conversation fits next to reserve tokens of reply.
+
+        Returns (messages, prompt tokens, n_keep, turn starts): n_keep tokens
+        (BOS and the system message) are pinned and the turn starts are the
+        token offsets of the messages after them. When the live KV cache holds
+        the turns being left out, they are shifted out of it in place.
+        """
+        messages = self._chatml_messages(messages)
+        bos = self.model.tokenize(b"", add_bos=True, special=True)
+        blocks = self._message_tokens(messages)
+        generation = self.model.tokenize(CHATML_GENERATION_PROMPT.encode("utf-8"), add_bos=False, special=True)
+        n_ctx = self.model.n_ctx()
+        n_keep = len(bos) + len(blocks[0])
+        total = n_keep + sum(len(block) for block in blocks[1:]) + len(generation)
+
+        first = 1
+        budget = n_ctx - reserve
+        if total > budget:
+            pinned = bos + blocks[0]
+            resume, cached_tokens = self._cached_turn(pinned, blocks)
+            kept = total - sum(len(block) for block in blocks[1:resume or 1])
+            if resume is not None and kept <= budget:
+                # The cache already starts where it did last time, and that still fits
+                first, total = resume, kept
+            else:
+                target = max(budget - CONTEXT_SHIFT_FREE_TOKENS, budget // 2)
+                # Keep at least the newest message, and start the kept part on a user turn
+                while first < len(messages) - 1 and (total > target or messages[first]["role"] != "user"):
+                    total -= len(blocks[first])
+                    first += 1
+                discard = sum(len(block) for block in blocks[resume or first:first])
+                if self.can_shift and resume is not None and 0 < discard < cached_tokens:
+                    self._shift_context(len(pinned), discard)
+                    print(f"Context full: shifted {first - resume} old messages ({discard} tokens) out of the KV cache")
+            if total >= n_ctx:
+                raise ValueError(f"The last message is {total} tokens long, more than the {n_ctx}-token context")
+
+        tokens = bos + blocks[0]
+        turn_starts = []
+        for block in blocks[first:]:
+            turn_starts.append(len(tokens))
+            tokens += block
+        return messages[:1] + messages[first:], tokens + generation, n_keep, turn_starts
+
+    def _cached_turn(self, pinned: list, blocks: list) -> tuple:
+        """(index of the message the KV cache continues the pinned prefix with, tokens of whole
+        messages it holds from there), or (None, 0) if it holds another conversation"""
+        cached = self.model._input_ids.tolist()
+        n_keep = len(pinned)
+        if cached[:n_keep] != pinned:
+            return None, 0
+        best, best_tokens = None, 0
+        for start in range(1, len(blocks)):
+            offset = n_keep
+            for block in blocks[start:]:
+                if cached[offset:offset + len(block)] != block:
+                    break
+                offset += len(block)
+            if offset - n_keep > best_tokens:
+                best, best_tokens = start, offset - n_keep
+        return best, best_tokens
+
+    def _make_room(self, n_keep: int, turn_starts: list) -> list:
+        """The context is full mid-reply: shift out the oldest turns, or the older half of a very long one"""
+        n_tokens = self.model.n_tokens
+        want = min(CONTEXT_SHIFT_FREE_TOKENS, (n_tokens - n_keep) // 2)
+        cut = next((start for start in turn_starts if start - n_keep >= want and start < n_tokens), n_keep + want)
+        discard = cut - n_keep
+        self._shift_context(n_keep, discard)
+        return [start - discard for start in turn_starts if start - discard > n_keep]
+
+    def _generate_shifting(self, tokens: list, n_keep: int, turn_starts: list, max_tokens: int,
+                           temperature: float, seed: int = None, result: dict = None):
+        """Yield reply pieces for up to max_tokens, shifting old turns out whenever the context fills up.
+
+        result (if given) gets "completion_tokens" and "finish_reason".
+        """
+        model = self.model
+        n_ctx = model.n_ctx()
+        if seed is not None:
+            model.set_seed(seed)
+        vocab = llama_cpp.llama_model_get_vocab(model.model)
+        im_end = model.tokenize(b"<|im_end|>", add_bos=False, special=True)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        processors = self._cancel_processor()
+        reply = []
+        finish_reason = "length"
+        while len(reply) < max_tokens:
+            generator = model.generate(tokens, temp=temperature, logits_processor=processors)
+            shifted = False
+            for token in generator:
+                if llama_cpp.llama_vocab_is_eog(vocab, token) or [token] == im_end or self._cancel.is_set():
+                    finish_reason = "stop"
+                    break
+                piece = decoder.decode(model.detokenize([token], prev_tokens=reply))
+                reply.append(token)
+                if piece:
+                    yield piece
+                if len(reply) >= max_tokens:
+                    break
+                if model.n_tokens + 1 >= n_ctx:
+                    # The next token has no cell left; evaluate it after the shift
+                    if not self.can_shift:
+                        break
+                    turn_starts = self._make_room(n_keep, turn_starts)
+                    tokens = model._input_ids.tolist() + [token]
+                    shifted = True
+                    break
+            generator.close()
+            if not shifted:
+                break
+        if result is not None:
+            result["completion_tokens"] = len(reply)
+            result["finish_reason"] = finish_reason
+
+    def prefill(self, messages: list, cancelled=lambda: False) -> bool:
+        # The same tokens the chat handler will produce, up to where the next turn starts.
+        # A chat too long for the context is cut the way the next reply will cut it,
+        # shifting older turns out of the cache in place
+        generation = self.model.tokenize(CHATML_GENERATION_PROMPT.encode("utf-8"), add_bos=False, special=True)
+        tokens = self._fit_context(messages, CONTEXT_SHIFT_FREE_TOKENS)[1][:-len(generation)]
+
+        # Start from whatever is already computed: the live context or a checkpoint
+        cached = Llama.longest_token_prefix(self.model._input_ids.tolist(), tokens)
+        if self.kv_checkpoints is not None:
+            try:
+                state = self.kv_checkpoints[tokens]
+                if Llama.longest_token_prefix(state.input_ids.tolist(), tokens) > cached:
+                    self.model.load_state(state)
+                    cached = Llama.longest_token_prefix(self.model._input_ids.tolist(), tokens)
+            except KeyError:
+                pass
+        if cached == len(tokens):
+            return True
+
+        self.model.n_tokens = cached  # eval() drops the KV cells past this point
+        for start in range(cached, len(tokens), PREFILL_CHUNK_TOKENS):
+            if cancelled():
+                return False
+            self.model.eval(tokens[start:start + PREFILL_CHUNK_TOKENS])
+        if self.kv_checkpoints is not None:
+            # Keep it even if other chats are read into the context before this one continues
+            self.kv_checkpoints[tokens] = self.model.save_state()
+        return True
+
+    def _cancel_processor(self):
+        """Force end-of-generation on the next token once cancel() was called.
+
+        Also notes when the first token is sampled, i.e. when prefill is done.
+        """
+        eos = self.model.token_eos()
+        self.first_token_at = None
+
+        def processor(input_ids, scores):
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            if self._cancel.is_set():
+                scores[:] = -np.inf
+                scores[eos] = 0.0
+            return scores
+        return LogitsProcessorList([processor])
+
+    def complete(self, messages: list, max_tokens: int = 200, temperature: float = 0.2,
+                 seed: int = None, json_schema: dict = None, checkpoint: bool = False) -> dict:
+        """With checkpoint, the KV state after the reply is saved under its token
+        prefix and a later prompt restores the longest cached prefix, so going
+        back to a branch only prefills the messages after the fork."""
+        self._cancel.clear()
+        n_ctx = self.model.n_ctx()
+        messages, tokens, n_keep, turn_starts = self._fit_context(messages, min(max_tokens, n_ctx // 4))
+        if json_schema is None and len(tokens) + max_tokens > n_ctx:
+            # A reply that may outgrow the context; the grammar path can't shift mid-reply, so it stays capped
+            return self._complete_shifting(tokens, n_keep, turn_starts, max_tokens, temperature, seed, checkpoint)
+
+        kwargs = {}
+        if json_schema is not None:
+            kwargs["grammar"] = get_json_grammar(json_schema)
+        if seed is not None:
+            kwargs["seed"] = seed
+        self.model.set_cache(self.kv_checkpoints if checkpoint else None)
+        started = time.perf_counter()
+        try:
+            output = self.model.create_chat_completion(
+                messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                logits_processor=self._cancel_processor(),
+                **kwargs
+            )
+        finally:
+            self.model.set_cache(None)
+        usage = output.get("usage", {})
+        return {
+            "text": output["choices"][0]["message"]["content"] or "",
+            "finish_reason": output["choices"][0].get("finish_reason"),
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", 0),
+            "ttft_s": (self.first_token_at or time.perf_counter()) - started
+        }
+
+    def _complete_shifting(self, tokens: list, n_keep: int, turn_starts: list, max_tokens: int,
+                           temperature: float, seed: int, checkpoint: bool) -> dict:
+        started = time.perf_counter()
+        result = {}
+        text = "".join(self._generate_shifting(tokens, n_keep, turn_starts, max_tokens, temperature, seed, result))
+        if checkpoint and self.kv_checkpoints is not None:
+            self.kv_checkpoints[self.model._input_ids.tolist()] = self.model.save_state()
+        return {
+            "text": text,
+            "finish_reason": result["finish_reason"],
+            "prompt_tokens": len(tokens),
+            "completion_tokens": result["completion_tokens"],
+            "ttft_s": (self.first_token_at or time.perf_counter()) - started
+        }
+
+    def stream(self, messages: list, max_tokens: int = 200, temperature: float = 0.2, seed: int = None):
+        self._cancel.clear()
+        n_ctx = self.model.n_ctx()
+        messages, tokens, n_keep, turn_starts = self._fit_context(messages, min(max_tokens, n_ctx // 4))
+        if len(tokens) + max_tokens > n_ctx:
+            yield from self._generate_shifting(tokens, n_keep, turn_starts, max_tokens, temperature, seed)
+            return
+        chunks = self.model.create_chat_completion(
+            messages, max_tokens=max_tokens, temperature=temperature, seed=seed, stream=True
+        )
+        for chunk in chunks:
+            if self._cancel.is_set():
+                chunks.close()
+                return
+            piece = chunk["choices"][0]["delta"].get("content")
+            if piece:
+                yield piece
+
+    def complete_many(self, messages: list, n: int, max_tokens: int = CANDIDATE_MAX_TOKENS,
+                      temperature: float = 0.8) -> list:
+        self._cancel.clear()
+        messages = self._fit_context(messages, n * max_tokens)[0]
+        try:
+            adapter = self.adapters[self.adapter[0]] if self.adapter else None
+            return self.candidates.generate(
+                self.model, messages, n, max_tokens, temperature, cancelled=self._cancel.is_set,
+                lora=(adapter, self.adapter[1] if self.adapter else 1.0)
+            )
+        except Exception as e:
+            # Still a single prefill: each completion reuses the prompt already in the KV cache
+            print(f"Parallel candidate decoding unavailable ({e}), drafting sequentially")
+            return super().complete_many(messages, n, max_tokens, temperature)
+
+    def embed(self, texts: list) -> np.ndarray:
+        # A second, embedding-mode instance of the same file. The weights are
+        # memory-mapped, so it mostly costs its own small context; it stays on
+        # the CPU to leave GPU memory to the chat model.
+        if self.embedding_model is None:
+            self.embedding_model = Llama(
+                self.model_path,
+                embedding=True,
+                n_ctx=EMBED_CONTEXT,
+                n_batch=EMBED_CONTEXT,
+                n_gpu_layers=0,
+                pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN,
+                verbose=False
+            )
+        return np.asarray(self.embedding_model.embed(texts, normalize=True), dtype=np.float32)
+
+    def close(self):
+        self.candidates.close()
+        # Adapters hang off the model's weights, so they go first
+        for adapter in self.adapters.values():
+            llama_cpp.llama_adapter_lora_free(adapter)
+        self.adapters.clear()
+        for model in (self.model, self.embedding_model):
+            if model is not None:
+                model.close()
+        self.model = self.embedding_model = None
+
+
+# ===== STUB =====
+
+STUB_WORDS = (
+    "sure here is what i think about that the idea sounds good and you could try it "
+    "step by step first check the basics then look at details it depends on context "
+    "but in general this works well let me know if you want more"
+).split()
+
+
+class StubBackend(InferenceBackend):
+    """Deterministic stand-in for a model.
+
+    Replies depend only on the conversation and seed. Time is spent like a
+    real model: prompt tokens not shared with the previous request cost
+    1/prefill_tps each (mimicking KV prefix reuse), then every generated
+    token costs 1/decode_tps. Embeddings are hashed bags of words, so
+    retrieval still finds texts that share words.
+    """
+    supports_json_schema = True
+
+    def __init__(self, prefill_tps: float = 800.0, decode_tps: float = 25.0,
+                 reply_tokens: int = 40, embedding_dim: int = 64, name: str = "stub"):
+        super().__init__()
+        self.prefill_tps = prefill_tps
+        self.decode_tps = decode_tps
+        self.reply_tokens = reply_tokens
+        self.embedding_dim = embedding_dim
+        self.name = name
+        self.cached_tokens = []
+        self.adapter = None
+
+    @property
+    def model_id(self) -> str:
+        return self.name
+
+    def tokenize(self, text: str) -> list:
+        return [zlib.crc32(word.encode("utf-8")) % 32000 for word in re.findall(r"\w+|[^\w\s]", text)]
+
+    def prefill_tokens_per_s(self):
+        return self.prefill_tps
+
+    def set_adapter(self, path: str = None, scale: float = 1.0):
+        """Adapters only change which replies come out (and drop the cached prefix)"""
+        key = (path, scale) if path else None
+        if key != self.adapter:
+            self.adapter = key
+            self.cached_tokens = []
+
+    def _prompt_tokens(self, messages: list) -> tuple:
+        """(prompt tokens, how many of them are already cached)"""
+        tokens = []
+        for msg in messages:
+            tokens += self.tokenize(f"{msg['role']}: {msg['content']}")
+        shared = 0
+        for a, b in zip(tokens, self.cached_tokens):
+            if a != b:
+                break
+            shared += 1
+        return tokens, shared
+
+    def _prefill(self, messages: list) -> int:
+        tokens, shared = self._prompt_tokens(messages)
+        time.sleep((len(tokens) - shared) / self.prefill_tps)
+        self.cached_tokens = tokens
+        return len(tokens)
+
+    def prefill(self, messages: list, cancelled=lambda: False) -> bool:
+        tokens, shared = self._prompt_tokens(messages)
+        for start in range(shared, len(tokens), PREFILL_CHUNK_TOKENS):
+            if cancelled():
+                return False
+            end = min(start + PREFILL_CHUNK_TOKENS, len(tokens))
+            time.sleep((end - start) / self.prefill_tps)
+            self.cached_tokens = tokens[:end]
+        return True
+
+    def _reply_words(self, messages: list, seed) -> list:
+        key = json.dumps([messages, seed, self.adapter], sort_keys=True).encode("utf-8")
+        rng = random.Random(zlib.crc32(key))
+        return [rng.choice(STUB_WORDS) for _ in range(self.reply_tokens)]
+
+    def complete(self, messages: list, max_tokens: int = 200, temperature: float = 0.2,
+                 seed: int = None, json_schema: dict = None, checkpoint: bool = False) -> dict:
+        self._cancel.clear()
+        started = time.perf_counter()
+        prompt_tokens = self._prefill(messages)
+        ttft = time.perf_counter() - started + 1 / self.decode_tps
+        if json_schema is not None:
+            text = json.dumps(self._schema_instance(json_schema))
+            completion_tokens = len(self.tokenize(text))
+            time.sleep(completion_tokens / self.decode_tps)
+            return {"text": text, "finish_reason": "stop", "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens, "ttft_s": ttft}
+
+        pieces = list(self._decode(messages, max_tokens, seed))
+        return {
+            "text": "".join(pieces),
+            "finish_reason": "length" if len(pieces) >= max_tokens else "stop",
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(pieces),
+            "ttft_s": ttft
+        }
+
+    def stream(self, messages: list, max_tokens: int = 200, temperature: float = 0.2, seed: int = None):
+        self._cancel.clear()
+        self._prefill(messages)
+        yield from self._decode(messages, max_tokens, seed)
+
+    def _decode(self, messages: list, max_tokens: int, seed):
+        for index, word in enumerate(self._reply_words(messages, seed)[:max_tokens]):
+            if self._cancel.is_set():
+                return
+            time.sleep(1 / self.decode_tps)
+            yield word if index == 0 else " " + word
+
+    @staticmethod
+    def _schema_instance(schema: dict):
+        """Smallest value that satisfies a simple JSON schema"""
+        kind = schema.get("type")
+        if kind == "object":
+            return {key: StubBackend._schema_instance(schema["properties"][key]) for key in schema.get("required", [])}
+        if kind == "array":
+            return []
+        if kind in ("integer", "number"):
+            return 0
+        if kind == "boolean":
+            return False
+        return ""
+
+    def embed(self, texts: list) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.embedding_dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                vectors[row, zlib.crc32(word.encode("utf-8")) % self.embedding_dim] += 1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-9)
+
+
+# ===== OPENAI-COMPATIBLE SERVER =====
+
+class OpenAICompatBackend(InferenceBackend):
+    """Talks to a local server speaking the OpenAI chat/embeddings API, using only urllib"""
+    supports_json_schema = True
+
+    def __init__(self, base_url: str = "http://127.0.0.1:8080/v1", model: str = "local",
+                 api_key: str = None, timeout: float = 300):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.timeout = timeout
+        self._response = None
+
+    @property
+    def model_id(self) -> str:
+        return re.sub(r"[^\w.-]+", "_", self.model)
+
+    def _request(self, path: str, payload: dict = None):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def load(self) -> dict:
+        """Check the server is reachable and pick its first model if none was named"""
+        with self._request("/models") as response:
+            models = json.loads(response.read()).get("data", [])
+        if self.model == "local" and models:
+            self.model = models[0]["id"]
+        return {"model": self.model}
+
+    def _server_tokenize(self, text: str, **extra) -> list:
+        # llama.cpp's server has /tokenize next to the /v1 routes
+        root = self.base_url[:-3] if self.base_url.endswith("/v1") else self.base_url
+        request = urllib.request.Request(
+            root + "/tokenize", data=json.dumps(dict(extra, content=text)).encode("utf-8"),
+            headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read())["tokens"]
+
+    def tokenize(self, text: str) -> list:
+        # Servers without /tokenize get a ~4 chars/token estimate
+        try:
+            return self._server_tokenize(text)
+        except Exception:
+            return list(range((len(text) + 3) // 4))
+
+    def count_tokens_many(self, texts: list) -> list:
+        """One /tokenize call for all texts; each token is counted for the text its piece starts in"""
+        if not texts:
+            return []
+        try:
+            tokens = self._server_tokenize("".join(texts), with_pieces=True)
+        except Exception:
+            return [(len(text) + 3) // 4 for text in texts]
+        ends = list(itertools.accumulate(len(text) for text in texts))
+        counts = [0] * len(texts)
+        if tokens and not isinstance(tokens[0], dict):
+            # An older server ignored with_pieces; share the total out by length
+            total = max(ends[-1], 1)
+            return [round(len(tokens) * len(text) / total) for text in texts]
+        position = 0
+        for token in tokens:
+            index = min(bisect.bisect_right(ends, position), len(texts) - 1)
+            counts[index] += 1
+            position += len(token["piece"]) if isinstance(token["piece"], str) else 1
+        return counts
+
+    def _payload(self, messages, max_tokens, temperature, seed, **extra) -> dict:
+        payload = {"model": self.model, "messages": messages, "max_tokens": max_tokens, "temperature": temperature}
+        if seed is not None:
+            payload["seed"] = seed
+        payload.update(extra)
+        return payload
+
+    def _chunks(self, payload: dict):
+        """Yield the parsed chunks of a streamed completion until it ends or cancel() closes it"""
+        response = self._request("/chat/completions", dict(payload, stream=True))
+        self._response = response
+        try:
+            for raw in response:
+                if self._cancel.is_set():
+                    return
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    return
+                yield json.loads(data)
+        except Exception:
+            if not self._cancel.is_set():
+                raise  # otherwise it's the closed connection
+        finally:
+            self._response = None
+            response.close()
+
+    def complete(self, messages: list, max_tokens: int = 200, temperature: float = 0.2,
+                 seed: int = None, json_schema: dict = None, checkpoint: bool = False) -> dict:
+        # Streamed and joined: a non-streamed response only arrives once the whole reply
+        # is generated, so cancel() would have no connection to close until then
+        self._cancel.clear()
+        extra = {"stream_options": {"include_usage": True}}
+        if json_schema is not None:
+            extra["response_format"] = {"type": "json_schema", "json_schema": {"name": "output", "schema": json_schema}}
+        started = time.perf_counter()
+        ttft = None
+        pieces = []
+        finish_reason = None
+        usage = {}
+        for chunk in self._chunks(self._payload(messages, max_tokens, temperature, seed, **extra)):
+            usage = chunk.get("usage") or usage
+            for choice in chunk.get("choices") or []:
+                piece = choice.get("delta", {}).get("content")
+                if piece:
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                    pieces.append(piece)
+                finish_reason = choice.get("finish_reason") or finish_reason
+        if finish_reason is None and self._cancel.is_set():
+            finish_reason = "cancelled"
+        return {
+            "text": "".join(pieces),
+            "finish_reason": finish_reason,
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "completion_tokens": usage.get("completion_tokens", len(pieces)),
+            "ttft_s": ttft
+        }
+
+    def stream(self, messages: list, max_tokens: int = 200, temperature: float = 0.2, seed: int = None):
+        self._cancel.clear()
+        for chunk in self._chunks(self._payload(messages, max_tokens, temperature, seed)):
+            piece = (chunk.get("choices") or [{}])[0].get("delta", {}).get("content")
+            if piece:
+                yield piece
+
+    def embed(self, texts: list) -> np.ndarray:
+        with self._request("/embeddings", {"model": self.model, "input": texts}) as response:
+            rows = sorted(json.loads(response.read())["data"], key=lambda row: row["index"])
+        vectors = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-9)
+
+    def cancel(self):
+        super().cancel()
+        response = self._response
+        if response is not None:
+            try:
+                response.close()  # unblocks a read that is waiting on the server
+            except Exception:
+                pass
+
+
+def create_backend(spec: str, **llama_args) -> InferenceBackend:
+    """Backend for a spec: a .gguf path, "stub[:prefill=800,decode=25,reply=40,name=stub]" or "openai:<base url>" """
+    if spec == "stub" or spec.startswith("stub:"):
+        options = {}
+        for pair in spec[5:].split(","):
+            if "=" in pair:
+                key, value = pair.split("=", 1)
+                options[key.strip()] = value.strip()
+        return StubBackend(
+            prefill_tps=float(options.get("prefill", 800.0)),
+            decode_tps=float(options.get("decode", 25.0)),
+            reply_tokens=int(options.get("reply", 40)),
+            name=options.get("name", "stub")
+        )
+    if spec.startswith("openai:"):
+        return OpenAICompatBackend(spec[len("openai:"):])
+    return LlamaCppBackend(spec, **llama_args)
+
+
+def backend_from_env(variable: str = BACKEND_ENV):
+    """The backend named by an environment variable (AI_CHAT_BACKEND by default), or None"""
+    spec = os.environ.get(variable)
+    return create_backend(spec) if spec else None
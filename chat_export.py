@@ -0,0 +1,422 @@
+"""Streaming export and import of the whole chat history.
+
+Chats are read and written one at a time, so memory use is bounded by the
+largest single chat, not by the size of the history. Formats, picked by the
+file name:
+
+    .jsonl               one JSON object per line: a header, then {"chat": ...}
+                         per chat, then {"memories": [...]}
+    .tar.zst / .tar.gz   a tar bundle of manifest.json, chats/<id>.json and
+                         memories.json (zstd needs the optional zstandard
+                         package; gzip always works)
+    .md / .html          a readable transcript of every chat's active branch
+                         (export only)
+
+An incremental export (since=...) only takes chats with a message written at
+or after that time, and memories saved since then. Importing merges by id:
+new chats are added, messages missing from an existing chat are added to it
+as branches, and memories the store already has are left alone, so the same
+bundle can be imported twice or on top of an older one.
+"""
+import io
+import os
+import re
+import sys
+import json
+import html
+import tarfile
+import argparse
+import datetime
+
+try:
+    import zstandard
+except ImportError:  # bundles fall back to tar.gz
+    zstandard = None
+
+
+EXPORT_FORMAT = "ai-chat-export"
+EXPORT_VERSION = 1
+ZSTD_LEVEL = 3  # zstd's default; higher levels cost far more time for a few percent
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_MAGIC = b"\x1f\x8b"
+CHAT_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")  # ids become file names; refuse anything else
+SPEAKERS = {"user": "You", "assistant": "AI"}
+
+HTML_HEAD = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Chat history</title>
+<style>
+body { font-family: sans-serif; max-width: 50em; margin: 2em auto; background: #1e1e1e; color: #eee; }
+section { border-top: 1px solid #444; padding-top: 1em; }
+.meta { color: #888; font-size: 0.8em; }
+.msg { white-space: pre-wrap; padding: 7px 10px; margin: 6px 0; }
+.user { background: rgba(42, 90, 223, 0.25); }
+.assistant { background: rgba(255, 255, 255, 0.04); }
+</style></head><body>
+"""
+
+
+def bundle_suffix() -> str:
+    """File suffix of the best tar bundle this install can write"""
+    return ".tar.zst" if zstandard is not None else ".tar.gz"
+
+
+def format_for_path(path: str) -> str:
+    """"jsonl", "tar.zst", "tar.gz", "md" or "html", from the file name"""
+    name = path.lower()
+    for suffixes, fmt in (((".jsonl",), "jsonl"), ((".tar.zst", ".tzst"), "tar.zst"),
+                          ((".tar.gz", ".tgz"), "tar.gz"), ((".md",), "md"), ((".html", ".htm"), "html")):
+        if name.endswith(suffixes):
+            return fmt
+    raise ValueError(f"Don't know which format to use for {os.path.basename(path)}; "
+                     "use .jsonl, .tar.zst, .tar.gz, .md or .html")
+
+
+def parse_since(text: str) -> str:
+    """An ISO date or time (local time unless it names a zone) as the UTC form chats store"""
+    moment = datetime.datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = moment.astimezone()
+    return moment.astimezone(datetime.timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def _utc(timestamp: str) -> str:
+    # Chats store naive UTC isoformat, memories add a "Z"; both compare as plain strings without it
+    return (timestamp or "").rstrip("Z")
+
+
+def chat_updated_at(chat: dict) -> str:
+    """When the chat last got a message (or was created)"""
+    times = [_utc(node.get("created_at")) for node in chat.get("nodes", {}).values()]
+    return max(times + [_utc(chat.get("created_at"))])
+
+
+def iter_chats(chat_manager, since: str = None):
+    """Yield (number, total, chat) for every stored chat, archived ones included, one at a time"""
+    chat_ids = chat_manager.chat_ids()
+    cutoff = None
+    if since:
+        cutoff = datetime.datetime.fromisoformat(since).replace(tzinfo=datetime.timezone.utc).timestamp()
+    for number, chat_id in enumerate(chat_ids, 1):
+        try:
+            # A file last written before the cutoff can't hold a newer message; skip it unread
+            mtime = chat_manager.chat_mtime(chat_id) if cutoff is not None else None
+            if mtime is not None and mtime < cutoff:
+                yield number, len(chat_ids), None
+                continue
+            chat = chat_manager.load_chat(chat_id)
+        except Exception as e:
+            print(f"Skipping unreadable chat {chat_id}: {e}")
+            yield number, len(chat_ids), None
+            continue
+        if since and chat_updated_at(chat) < since:
+            chat = None
+        yield number, len(chat_ids), chat
+
+
+class JsonlWriter:
+    def __init__(self, path: str, header: dict):
+        self.file = open(path, "w", encoding="utf-8", newline="\n")
+        self._write(header)
+
+    def _write(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def add_chat(self, chat: dict):
+        self._write({"chat": {key: value for key, value in chat.items() if key != "messages"}})
+
+    def add_memories(self, memories: list):
+        self._write({"memories": memories})
+
+    def close(self):
+        self.file.close()
+
+
+class BundleWriter:
+    """A tar stream written straight through the compressor; nothing is seekable or buffered whole"""
+    def __init__(self, path: str, header: dict, compression: str):
+        self.raw = None
+        if compression == "zst":
+            if zstandard is None:
+                raise RuntimeError("Writing .tar.zst needs the zstandard package (pip install zstandard); "
+                                   "use .tar.gz instead")
+            self.raw = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, "wb"))
+            self.tar = tarfile.open(fileobj=self.raw, mode="w|")
+        else:
+            self.tar = tarfile.open(path, mode="w|gz")
+        self._add("manifest.json", header)
+
+    def _add(self, name: str, data):
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        info = tarfile.TarInfo(name)
+        info.size = len(body)
+        info.mtime = int(datetime.datetime.now().timestamp())
+        self.tar.addfile(info, io.BytesIO(body))
+
+    def add_chat(self, chat: dict):
+        self._add(f"chats/{chat['id']}.json", {key: value for key, value in chat.items() if key != "messages"})
+
+    def add_memories(self, memories: list):
+        self._add("memories.json", memories)
+
+    def close(self):
+        self.tar.close()
+        if self.raw is not None:
+            self.raw.close()
+
+
+class MarkdownWriter:
+    def __init__(self, path: str, header: dict):
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write(f"# Chat history\n\nExported {header['exported_at']} UTC"
+                        + (f", chats with messages since {header['since']}" if header.get("since") else "")
+                        + "\n")
+
+    def add_chat(self, chat: dict):
+        self.file.write(f"\n---\n\n## {chat.get('title', 'Untitled chat')}\n\n_{chat.get('created_at', '')}_\n")
+        for msg in chat.get("messages", []):
+            if msg["role"] not in SPEAKERS:
+                continue
+            self.file.write(f"\n**{SPEAKERS[msg['role']]}** {msg.get('created_at', '')}\n\n{msg['content']}\n")
+
+    def add_memories(self, memories: list):
+        if memories:
+            self.file.write("\n---\n\n## Memories\n\n")
+            self.file.writelines(f"- {mem['content']}\n" for mem in memories)
+
+    def close(self):
+        self.file.close()
+
+
+class HtmlWriter:
+    def __init__(self, path: str, header: dict):
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write(HTML_HEAD)
+        since = f", chats with messages since {html.escape(header['since'])}" if header.get("since") else ""
+        self.file.write(f"<h1>Chat history</h1><p class=\"meta\">Exported {header['exported_at']} UTC{since}</p>\n")
+
+    def add_chat(self, chat: dict):
+        self.file.write(f"<section><h2>{html.escape(chat.get('title', 'Untitled chat'))}</h2>"
+                        f"<p class=\"meta\">{html.escape(chat.get('created_at', ''))}</p>\n")
+        for msg in chat.get("messages", []):
+            if msg["role"] not in SPEAKERS:
+                continue
+            self.file.write(f"<p class=\"meta\">{SPEAKERS[msg['role']]} {html.escape(msg.get('created_at', ''))}</p>"
+                            f"<div class=\"msg {msg['role']}\">{html.escape(msg['content'])}</div>\n")
+        self.file.write("</section>\n")
+
+    def add_memories(self, memories: list):
+        if memories:
+            self.file.write("<section><h2>Memories</h2><ul>\n")
+            self.file.writelines(f"<li>{html.escape(mem['content'])}</li>\n" for mem in memories)
+            self.file.write("</ul></section>\n")
+
+    def close(self):
+        self.file.write("</body></html>\n")
+        self.file.close()
+
+
+def open_writer(path: str, header: dict, fmt: str):
+    if fmt == "jsonl":
+        return JsonlWriter(path, header)
+    if fmt == "md":
+        return MarkdownWriter(path, header)
+    if fmt == "html":
+        return HtmlWriter(path, header)
+    return BundleWriter(path, header, fmt.split(".")[1])
+
+
+def export_chats(chat_manager, memory_manager, path: str, since: str = None, include_memories: bool = True,
+                 progress=None, cancelled=lambda: False) -> dict:
+    """Stream every chat (touched since `since`, if given) into path.
+
+    The file is written under a temporary name and moved into place when
+    complete, so a cancelled or failed export never leaves half a bundle.
+    progress(done, total) is called after each chat.
+    """
+    header = {
+        "format": EXPORT_FORMAT,
+        "version": EXPORT_VERSION,
+        "exported_at": datetime.datetime.utcnow().isoformat(),
+        "since": since
+    }
+    part_path = path + ".part"
+    writer = open_writer(part_path, header, format_for_path(path))
+    exported = 0
+    try:
+        for done, total, chat in iter_chats(chat_manager, since):
+            if cancelled():
+                raise InterruptedError("Export cancelled")
+            if chat is not None:
+                writer.add_chat(chat)
+                exported += 1
+            if progress is not None:
+                progress(done, total)
+        memories = []
+        if include_memories and memory_manager is not None:
+            memories = [mem for mem in memory_manager.read_memories()
+                        if not since or _utc(mem.get("created_at")) >= since]
+            writer.add_memories(memories)
+        writer.close()
+        os.replace(part_path, path)
+    except BaseException:
+        writer.close()
+        os.remove(part_path)
+        raise
+    return {"path": path, "chats": exported, "memories": len(memories), "exported_at": header["exported_at"]}
+
+
+def iter_records(f, name: str = "export"):
+    """Yield ("header" | "chat" | "memories", data) from a JSONL export or tar bundle opened as binary"""
+    magic = f.read(4)
+    f.seek(0)
+    if magic.startswith(ZSTD_MAGIC) or magic.startswith(GZIP_MAGIC):
+        if magic.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise RuntimeError("Reading .tar.zst needs the zstandard package (pip install zstandard)")
+            tar = tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(f), mode="r|")
+        else:
+            tar = tarfile.open(fileobj=f, mode="r|gz")
+        with tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                data = json.loads(tar.extractfile(member).read().decode("utf-8"))
+                if member.name == "manifest.json":
+                    yield "header", data
+                elif member.name == "memories.json":
+                    yield "memories", data
+                elif member.name.startswith("chats/"):
+                    yield "chat", data
+        return
+
+    for number, line in enumerate(io.TextIOWrapper(f, encoding="utf-8"), 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if "chat" in record:
+            yield "chat", record["chat"]
+        elif "memories" in record:
+            yield "memories", record["memories"]
+        elif record.get("format") == EXPORT_FORMAT:
+            yield "header", record
+        else:
+            print(f"Skipping unknown record on line {number} of {name}")
+
+
+def merge_imported_chat(chat_manager, chat: dict) -> bool:
+    """Add an imported chat to the store, or its missing messages to ours; False if it brought nothing new"""
+    try:
+        local = chat_manager.load_chat(chat["id"])
+    except FileNotFoundError:
+        local = None
+    if local is None:
+        if chat.get("nodes"):
+            chat["messages"] = chat_manager.branch_messages(chat["nodes"], chat.get("head"))
+        chat_manager.save_chat(chat)
+        return True
+
+    new_nodes = {node_id: node for node_id, node in chat.get("nodes", {}).items() if node_id not in local["nodes"]}
+    new_fields = {key: value for key, value in chat.items()
+                  if key not in local and key not in ("messages", "nodes", "head")}
+    if not new_nodes and not new_fields:
+        return False
+    local.update(new_fields)
+    local["nodes"].update(new_nodes)
+
+    # Follow their branch if it continues ours, as when another instance writes the chat
+    node_id = chat.get("head")
+    for _ in range(len(local["nodes"])):
+        if node_id is None or node_id == local.get("head"):
+            break
+        node_id = local["nodes"].get(node_id, {}).get("parent")
+    if node_id == local.get("head") and chat.get("head") in local["nodes"]:
+        local["head"] = chat["head"]
+    local["messages"] = chat_manager.branch_messages(local["nodes"], local.get("head"))
+    chat_manager.save_chat(local)
+    return True
+
+
+def import_memories(chat_manager, memory_manager, memories: list) -> int:
+    """Add the memories whose ids the memory file doesn't have yet; returns how many"""
+    memories = [mem for mem in memories if isinstance(mem, dict) and mem.get("id") and mem.get("content")]
+    with chat_manager.lock:
+        current = memory_manager.read_memories()
+        known = {mem["id"] for mem in current}
+        added = [mem for mem in memories if mem["id"] not in known]
+        if added and not memory_manager.write_memories(current + added):
+            raise OSError("Could not write the memory file")
+    return len(added)
+
+
+def import_chats(chat_manager, memory_manager, path: str, progress=None, cancelled=lambda: False) -> dict:
+    """Merge a JSONL export or tar bundle into the store, one chat at a time.
+
+    Every chat is written as soon as it is read, so a cancelled import keeps
+    what it got through and importing again picks up the rest.
+    progress(done, total) is called after each chat, in bytes of the file read.
+    """
+    name = os.path.basename(path)
+    size = os.path.getsize(path)
+    result = {"chats": 0, "unchanged": 0, "failed": 0, "memories": 0}
+    with open(path, "rb") as f:
+        for kind, data in iter_records(f, name):
+            if cancelled():
+                raise InterruptedError("Import cancelled")
+            if kind == "header":
+                if data.get("version", 0) > EXPORT_VERSION:
+                    raise ValueError(f"{name} was exported by a newer version of the app")
+            elif kind == "memories":
+                if memory_manager is not None:
+                    result["memories"] = import_memories(chat_manager, memory_manager, data)
+            elif not isinstance(data, dict) or not CHAT_ID_PATTERN.match(str(data.get("id", ""))):
+                print(f"Skipping a chat without a valid id in {name}")
+                result["failed"] += 1
+            else:
+                try:
+                    result["chats" if merge_imported_chat(chat_manager, data) else "unchanged"] += 1
+                except Exception as e:
+                    print(f"Error importing chat {data['id']}: {e}")
+                    result["failed"] += 1
+                if progress is not None:
+                    progress(f.tell(), size)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export or import the chat history without loading it all at once")
+    parser.add_argument("action", choices=("export", "import"))
+    parser.add_argument("path", help="Export file: .jsonl, .tar.zst, .tar.gz, .md or .html (import: .jsonl or .tar.*)")
+    parser.add_argument("--since", help="Export only chats with messages since this ISO date/time (and newer memories)")
+    parser.add_argument("--chats", default=None, help="Chat folder (default: the app's chats folder)")
+    parser.add_argument("--memories", default=None, help="Memory file (default: the app's memories.json)")
+    parser.add_argument("--no-memories", action="store_true", help="Leave memories out of the export or import")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    from ai_chat_ui import ChatManager, MemoryManager, CHAT_DIR, MEMORY_FILE
+    chat_manager = ChatManager(args.chats or CHAT_DIR)
+    memory_manager = None if args.no_memories else MemoryManager(args.memories or MEMORY_FILE)
+
+    def report(done, total):
+        print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+
+    try:
+        if args.action == "export":
+            since = parse_since(args.since) if args.since else None
+            result = export_chats(chat_manager, memory_manager, args.path, since, progress=report)
+            print(f"\nExported {result['chats']} chats and {result['memories']} memories to {args.path}; "
+                  f"use --since {result['exported_at']}Z next time to export only what's new", file=sys.stderr)
+        else:
+            result = import_chats(chat_manager, memory_manager, args.path, progress=report)
+            print(f"\nImported {result['chats']} chats ({result['unchanged']} already up to date, "
+                  f"{result['failed']} failed) and {result['memories']} new memories", file=sys.stderr)
+    except (OSError, ValueError, RuntimeError, tarfile.TarError) as e:
+        print(f"\n{args.action.capitalize()} failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""Full-text index over past chat turns, for pulling relevant snippets from other chats.
+
+Each turn (a user message and the reply to it) is a row in an SQLite FTS5
+table, ranked with BM25, with its chat id, message id and chat title in a
+plain table keyed by the same rowid. ChatManager.save_chat indexes only the
+turns it hasn't seen yet (keyed by the reply's message id), so keeping the
+index current costs one indexed lookup per save. Writes happen on the chat
+store thread and searches inside reply jobs, so every thread gets its own
+connection and the database runs in WAL mode.
+"""
+import re
+import sqlite3
+import threading
+
+
+CHAT_INDEX_FILE = "chat_index.sqlite"  # lives inside CHAT_DIR
+CHAT_CONTEXT_TOKENS = 512  # prompt budget for snippets from other chats
+CHAT_SNIPPET_LIMIT = 3
+SNIPPET_MESSAGE_CHARS = 600
+STOP_WORDS = {
+    "the", "and", "for", "are", "but", "not", "you", "your", "all", "any", "can", "had", "her",
+    "was", "one", "our", "out", "has", "have", "him", "his", "how", "its", "may", "who", "did",
+    "get", "got", "let", "she", "too", "use", "that", "this", "with", "what", "when", "where",
+    "which", "will", "would", "there", "their", "them", "then", "than", "they", "from", "about",
+    "just", "like", "been", "were", "also", "into", "some", "could", "should", "does", "doing"
+}
+
+
+class ChatIndex:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS turns USING fts5(text)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS turn_meta ("
+                "rowid INTEGER PRIMARY KEY, chat_id TEXT NOT NULL, msg_id TEXT UNIQUE NOT NULL, title TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS turn_meta_chat ON turn_meta (chat_id)")
+            self.is_new = conn.execute("SELECT count(*) FROM turn_meta").fetchone()[0] == 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def index_chat(self, chat_data: dict):
+        """Add the active branch's turns that aren't indexed yet"""
+        chat_id = chat_data["id"]
+        title = chat_data.get("title", "")
+        conn = self._connect()
+        known = {}
+        for msg_id, known_title in conn.execute("SELECT msg_id, title FROM turn_meta WHERE chat_id = ?", (chat_id,)):
+            known[msg_id] = known_title
+
+        rows = []
+        question = None
+        for msg in chat_data.get("messages", []):
+            if msg["role"] == "user":
+                question = msg["content"]
+            elif msg["role"] == "assistant" and question is not None:
+                if msg.get("id") and msg["id"] not in known:
+                    text = (
+                        f"User: {question[:SNIPPET_MESSAGE_CHARS]}\n"
+                        f"AI: {msg['content'][:SNIPPET_MESSAGE_CHARS]}"
+                    )
+                    rows.append((text, msg["id"]))
+                question = None
+
+        renamed = any(known_title != title for known_title in known.values())
+        if rows or renamed:
+            with conn:
+                if renamed:
+                    conn.execute("UPDATE turn_meta SET title = ? WHERE chat_id = ?", (title, chat_id))
+                for text, msg_id in rows:
+                    rowid = conn.execute("INSERT INTO turns (text) VALUES (?)", (text,)).lastrowid
+                    conn.execute(
+                        "INSERT INTO turn_meta (rowid, chat_id, msg_id, title) VALUES (?, ?, ?, ?)",
+                        (rowid, chat_id, msg_id, title)
+                    )
+        return len(rows)
+
+    def remove_chat(self, chat_id: str):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "DELETE FROM turns WHERE rowid IN (SELECT rowid FROM turn_meta WHERE chat_id = ?)", (chat_id,)
+            )
+            conn.execute("DELETE FROM turn_meta WHERE chat_id = ?", (chat_id,))
+
+    @staticmethod
+    def match_query(text: str, max_terms: int = 16) -> str:
+        """Turn free text into an FTS5 OR-query of its distinctive words"""
+        terms = []
+        for word in re.findall(r"\w+", text.lower()):
+            if len(word) >= 3 and word not in STOP_WORDS and word not in terms:
+                terms.append(word)
+        return " OR ".join(f'"{term}"' for term in terms[:max_terms])
+
+    def search(self, text: str, exclude_chat_id: str = None, limit: int = CHAT_SNIPPET_LIMIT) -> list:
+        """Best matching turns from other chats as {"text", "name", "chat_id"}"""
+        query = self.match_query(text)
+        if not query:
+            return []
+        rows = self._connect().execute(
+            "SELECT turns.text, turn_meta.title, turn_meta.chat_id FROM turns "
+            "JOIN turn_meta ON turn_meta.rowid = turns.rowid "
+            "WHERE turns MATCH ? AND turn_meta.chat_id != ? ORDER BY bm25(turns) LIMIT ?",
+            (query, exclude_chat_id or "", limit)
+        ).fetchall()
+        return [{"text": text, "name": title or "Untitled chat", "chat_id": chat_id} for text, title, chat_id in rows]
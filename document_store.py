@@ -0,0 +1,214 @@
+"""Local document store: chunk attached files, embed the chunks and search them.
+
+Files are read in blocks and PDFs page by page, so a large file is never held
+in memory whole. Chunk vectors are appended to a flat float16 file that is
+memory-mapped for search (one matrix-vector product per query, fast enough on
+a CPU for tens of thousands of chunks), and chunk texts go to a JSONL file
+that is read back with one seek per hit.
+
+Layout of a store directory (one per embedding model, since vectors from
+different models can't be compared):
+
+    documents.json   document list, vector dimension and committed row count
+    vectors.f16      row i = normalized embedding of chunk i
+    chunks.jsonl     line i = {"doc": id, "text": ...}
+"""
+import os
+import json
+import datetime
+
+import numpy as np
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # PDF support is optional
+    PdfReader = None
+
+
+DOCUMENTS_DIR = "documents"
+DOCUMENT_EXTENSIONS = (".txt", ".md", ".pdf")
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP = 200
+READ_BLOCK_CHARS = 64 * 1024
+EMBED_BATCH = 16  # chunks embedded per background job, so a reply never waits long behind ingestion
+DOCUMENT_CONTEXT_TOKENS = 1024  # prompt budget for retrieved excerpts
+DOCUMENT_TOP_K = 6
+DOCUMENT_MIN_SCORE = 0.2
+SEARCH_BLOCK_ROWS = 65536
+
+
+def iter_text_blocks(path: str):
+    """Yield the text of a document a block (or PDF page) at a time"""
+    if path.lower().endswith(".pdf"):
+        if PdfReader is None:
+            raise RuntimeError("Reading PDFs needs the pypdf package (pip install pypdf)")
+        for page in PdfReader(path).pages:
+            yield (page.extract_text() or "") + "\n\n"
+        return
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        while True:
+            block = f.read(READ_BLOCK_CHARS)
+            if not block:
+                return
+            yield block
+
+
+def iter_chunks(path: str, chunk_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP):
+    """Yield overlapping chunks of roughly chunk_chars, cut at paragraph or word breaks"""
+    buffer = ""
+    for block in iter_text_blocks(path):
+        buffer += block
+        while len(buffer) >= chunk_chars * 2:
+            cut = _cut_point(buffer, chunk_chars)
+            chunk = buffer[:cut].strip()
+            if chunk:
+                yield chunk
+            buffer = buffer[max(cut - overlap, 1):]
+    while buffer.strip():
+        cut = _cut_point(buffer, chunk_chars) if len(buffer) > chunk_chars else len(buffer)
+        chunk = buffer[:cut].strip()
+        if chunk:
+            yield chunk
+        if cut >= len(buffer):
+            break
+        buffer = buffer[max(cut - overlap, 1):]
+
+
+def _cut_point(text: str, limit: int) -> int:
+    for separator in ("\n\n", "\n", ". ", " "):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut != -1:
+            return cut + len(separator)
+    return limit
+
+
+class DocumentStore:
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.index_path = os.path.join(self.store_dir, "documents.json")
+        self.vectors_path = os.path.join(self.store_dir, "vectors.f16")
+        self.chunks_path = os.path.join(self.store_dir, "chunks.jsonl")
+        self.index = self._load_index()
+        self.line_offsets = self._scan_chunk_offsets()
+        self._vectors = None
+
+    def _load_index(self) -> dict:
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    return json.load(f)
+            except Exception as e:
+                print(f"Error loading document index: {e}")
+        return {"dim": 0, "count": 0, "docs": {}}
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def _scan_chunk_offsets(self) -> list:
+        """Byte offset of every committed chunk line"""
+        count = self.index["count"]
+        offsets = []
+        end = 0
+        if os.path.exists(self.chunks_path):
+            with open(self.chunks_path, "rb") as f:
+                for line in f:
+                    if len(offsets) == count:
+                        break
+                    offsets.append(end)
+                    end += len(line)
+            # Rows past "count" are from an interrupted ingest; drop them so appends line up again
+            if os.path.getsize(self.chunks_path) > end:
+                with open(self.chunks_path, "r+b") as f:
+                    f.truncate(end)
+        self.index["count"] = len(offsets)
+        row_bytes = self.index["dim"] * 2
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) > len(offsets) * row_bytes:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(len(offsets) * row_bytes)
+        return offsets
+
+    def list_documents(self) -> list:
+        docs = [dict(doc, id=doc_id) for doc_id, doc in self.index["docs"].items()]
+        docs.sort(key=lambda d: d.get("added_at", ""))
+        return docs
+
+    def add_chunks(self, doc_id: str, path: str, chunks: list, vectors: np.ndarray):
+        """Append one batch of embedded chunks and commit it to the index"""
+        if not self.index["dim"]:
+            self.index["dim"] = int(vectors.shape[1])
+        elif vectors.shape[1] != self.index["dim"]:
+            raise ValueError("Embedding size doesn't match this document store")
+
+        with open(self.vectors_path, "ab") as f:
+            f.write(vectors.astype(np.float16).tobytes())
+        with open(self.chunks_path, "ab") as f:
+            position = f.tell()
+            for chunk in chunks:
+                line = (json.dumps({"doc": doc_id, "text": chunk}, ensure_ascii=False) + "\n").encode("utf-8")
+                self.line_offsets.append(position)
+                f.write(line)
+                position += len(line)
+
+        doc = self.index["docs"].setdefault(doc_id, {
+            "name": os.path.basename(path),
+            "path": path,
+            "chunks": 0,
+            "added_at": datetime.datetime.utcnow().isoformat()
+        })
+        doc["chunks"] += len(chunks)
+        self.index["count"] += len(chunks)
+        self._save_index()
+        self._vectors = None  # remap to include the new rows
+
+    def _matrix(self):
+        count, dim = self.index["count"], self.index["dim"]
+        if not count:
+            return None
+        if self._vectors is None or self._vectors.shape[0] != count:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode="r", shape=(count, dim))
+        return self._vectors
+
+    def search(self, query_vector: np.ndarray, top_k: int = DOCUMENT_TOP_K,
+               min_score: float = DOCUMENT_MIN_SCORE) -> list:
+        """Return the top_k chunks by cosine similarity as {"text", "name", "score"}"""
+        matrix = self._matrix()
+        if matrix is None or query_vector.shape[-1] != matrix.shape[1]:
+            return []
+        # Widen a block of rows at a time so the product runs in BLAS without copying the whole index
+        query = query_vector.astype(np.float32)
+        scores = np.empty(matrix.shape[0], dtype=np.float32)
+        for start in range(0, matrix.shape[0], SEARCH_BLOCK_ROWS):
+            scores[start:start + SEARCH_BLOCK_ROWS] = matrix[start:start + SEARCH_BLOCK_ROWS].astype(np.float32) @ query
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+
+        results = []
+        with open(self.chunks_path, "rb") as f:
+            for row in best:
+                score = float(scores[row])
+                if score < min_score:
+                    break
+                f.seek(self.line_offsets[row])
+                entry = json.loads(f.readline())
+                doc = self.index["docs"].get(entry["doc"], {})
+                results.append({"text": entry["text"], "name": doc.get("name", "document"), "score": score})
+        return results
+
+
+def build_context(results: list, budget_tokens: int, count_tokens) -> str:
+    """Join retrieved excerpts, best first, until the token budget is spent"""
+    parts = []
+    used = 0
+    for result in results:
+        part = f"[{result['name']}]\n{result['text']}"
+        cost = count_tokens(part)
+        if used + cost > budget_tokens:
+            continue
+        parts.append(part)
+        used += cost
+    return "\n\n".join(parts)
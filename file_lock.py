@@ -0,0 +1,77 @@
+"""Advisory file locks shared between app instances.
+
+Writers take the lock around read-merge-write cycles, so two instances (or
+an instance and a sync tool that honours the lock) never interleave their
+rewrites of the same files. The lock lives in its own small file, because
+the data files are replaced atomically and would lose a lock held on them.
+Uses flock() on POSIX and msvcrt.locking() on Windows. The lock is
+reentrant within a process.
+"""
+import os
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+LOCK_POLL_S = 0.05  # retry interval while another instance holds the lock
+
+
+class FileLock:
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._file = None
+        self._depth = 0
+
+    def _try_lock(self) -> bool:
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def _unlock(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            self._file = open(self.path, "a+b")
+            while not self._try_lock():
+                if not blocking:
+                    self._file.close()
+                    self._file = None
+                    self._thread_lock.release()
+                    return False
+                time.sleep(LOCK_POLL_S)
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._unlock()
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,378 @@
+"""Load test: many chat sessions at once against the app's inference and storage layers.
+
+Every session replays a conversation the way the chat window does: the user
+message is saved through ChatStoreWorker (write-ahead log, checkpoints),
+the reply is queued on the shared InferenceExecutor at interactive priority,
+memory extraction follows at extraction priority, and the reply is saved.
+Sessions run on their own threads, so they contend for the single model
+exactly as several users of one box would.
+
+Each concurrency level runs on a fresh chat folder and reports time to
+first token (queueing included, i.e. what a user waits for), the queueing
+delay alone, turn latency, throughput and disk I/O. Throughput that stops
+growing while TTFT keeps climbing marks the saturation point.
+
+Usage:
+    python load_test.py --model stub --sessions 1,2,4,8,16
+    python load_test.py --model stub:prefill=400,decode=20 --turns 6 --think-s 2
+    python load_test.py --model path/to/model.gguf --conversations batch.jsonl --sessions 1,2,4
+    python load_test.py --model stub --chats chats --json > results.jsonl
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+from PyQt6.QtCore import QCoreApplication
+
+from ai_chat_app import load_model, read_batch_items, build_batch_messages, get_rss_mb
+from ai_chat_ui import (
+    ChatManager, MemoryManager, ChatStoreWorker, InferenceExecutor, MemoryExtractionTask,
+    with_system_prompt, SYSTEM_PROMPT, PRIORITY_INTERACTIVE, PRIORITY_EXTRACTION, REPLY_MAX_TOKENS
+)
+
+
+DEFAULT_SESSIONS = "1,2,4,8"
+DEFAULT_TURNS = 4
+EXTRACTION_WAIT_S = 120  # how long to let queued memory extraction drain after the last reply
+SATURATION_GAIN = 0.10  # a level adding less throughput than this over the previous one is saturated
+SYNTHETIC_OPENERS = [
+    "Can you explain how {topic} works?",
+    "What's a good way to get started with {topic}?",
+    "I like {topic}, what should I try next?",
+    "My name is Sam and I work with {topic} every day. Any tips?",
+    "Give me three quick facts about {topic}.",
+    "Remember that I prefer short answers about {topic}.",
+    "What are common mistakes people make with {topic}?",
+    "How does {topic} compare to what people used ten years ago?"
+]
+SYNTHETIC_TOPICS = [
+    "sourdough baking", "rust programming", "trail running", "home networking", "watercolor painting",
+    "chess openings", "espresso", "houseplants", "budget travel", "jazz piano", "3d printing", "birdwatching"
+]
+
+
+def synthetic_conversations(count: int, turns: int, seed: int = 0) -> list:
+    """count conversations of turns user messages each, about one random topic apiece"""
+    rng = random.Random(seed)
+    conversations = []
+    for _ in range(count):
+        topic = rng.choice(SYNTHETIC_TOPICS)
+        conversations.append([rng.choice(SYNTHETIC_OPENERS).format(topic=topic) for _ in range(turns)])
+    return conversations
+
+
+def recorded_conversations(path: str) -> list:
+    """User turns of every conversation in a batch JSONL file (see ai_chat_app --input) or a chat folder"""
+    conversations = []
+    if os.path.isdir(path):
+        manager = ChatManager(path)
+        for entry in manager.list_chats():
+            try:
+                messages = manager.load_chat(entry["id"])["messages"]
+            except Exception as e:
+                print(f"Skipping chat {entry['id']}: {e}", file=sys.stderr)
+                continue
+            conversations.append([msg["content"] for msg in messages if msg["role"] == "user"])
+    else:
+        for _, item in read_batch_items(path):
+            if "error" in item:
+                continue
+            conversations.append([msg["content"] for msg in build_batch_messages(item) if msg["role"] == "user"])
+    return [turns for turns in conversations if turns]
+
+
+def disk_io_bytes():
+    """(read, written) bytes of this process so far, or None if the platform doesn't say"""
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    except (ImportError, AttributeError):
+        pass
+    try:
+        values = {}
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                values[key] = int(value)
+        return values["read_bytes"], values["write_bytes"]
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def percentile(values: list, p: float):
+    """Nearest-rank percentile (None for no values)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def folder_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class LoadRun:
+    """One concurrency level: N sessions sharing one executor and one chat store"""
+    def __init__(self, model, conversations: list, sessions: int, turns: int, data_dir: str,
+                 think_s: float = 0.0, ramp_s: float = 0.0, extraction: bool = True, seed: int = 0):
+        self.model = model
+        self.conversations = conversations
+        self.sessions = sessions
+        self.turns = turns
+        self.data_dir = data_dir
+        self.think_s = think_s
+        self.ramp_s = ramp_s
+        self.extraction = extraction
+        self.rng = random.Random(seed)
+        self.samples = []  # one dict per finished reply
+        self.save_times = []  # seconds ChatStoreWorker.save_chat held the caller (the GUI thread in the app)
+        self.errors = []
+        self.lock = threading.Lock()  # the app does these from the GUI thread only
+        self.extractions = []
+
+    def _save(self, chat: dict):
+        started = time.perf_counter()
+        self.chat_store.save_chat(chat)
+        with self.lock:
+            self.save_times.append(time.perf_counter() - started)
+
+    def _submit_extraction(self, text: str):
+        done = threading.Event()
+        task = MemoryExtractionTask(text)
+
+        def run(model):
+            try:
+                for content in task(model):
+                    with self.lock:
+                        self.memory_manager.add_memory(content, source="auto")
+            finally:
+                done.set()
+
+        self.extractions.append(done)
+        self.executor.submit(run, PRIORITY_EXTRACTION)
+
+    def _reply(self, messages: list) -> dict:
+        """Queue a reply like generate_reply does and wait for it; returns the timing sample"""
+        done = threading.Event()
+        result = {}
+        submitted = time.perf_counter()
+
+        def run(model):
+            started = time.perf_counter()
+            try:
+                model.set_adapter(None)
+                result["output"] = model.complete(messages, max_tokens=REPLY_MAX_TOKENS, checkpoint=True)
+            except Exception as e:
+                result["error"] = str(e)
+            result["started"] = started
+            result["finished"] = time.perf_counter()
+            done.set()
+
+        self.executor.submit(run, PRIORITY_INTERACTIVE)
+        done.wait()
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        output = result["output"]
+        queue_s = result["started"] - submitted
+        model_ttft = output.get("ttft_s")
+        if model_ttft is None:  # backends that can't tell count the whole call
+            model_ttft = result["finished"] - result["started"]
+        return {
+            "queue_s": queue_s,
+            "ttft_s": queue_s + model_ttft,
+            "latency_s": result["finished"] - submitted,
+            "completion_tokens": output["completion_tokens"],
+            "text": output["text"].strip()
+        }
+
+    def _session(self, index: int):
+        time.sleep(self.ramp_s * index / max(1, self.sessions))
+        user_turns = self.conversations[index % len(self.conversations)][:self.turns]
+        chat = self.chat_manager.create_new_chat(save=False)
+        for text in user_turns:
+            now_iso = time.strftime("%Y-%m-%dT%H:%M:%S")
+            chat["messages"].append({"role": "user", "content": text, "created_at": now_iso})
+            chat["title"] = user_turns[0][:40]
+            self._save(chat)
+            with self.lock:
+                system_prompt = SYSTEM_PROMPT + self.memory_manager.get_memories_as_context()
+            try:
+                sample = self._reply(with_system_prompt(chat["messages"], system_prompt))
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(str(e))
+                return
+            if self.extraction:
+                self._submit_extraction(text)
+            chat["messages"].append({"role": "assistant", "content": sample.pop("text"), "created_at": now_iso})
+            chat["messages"].append({"role": "separator", "content": ""})
+            self._save(chat)
+            with self.lock:
+                self.samples.append(sample)
+            if self.think_s:
+                time.sleep(self.rng.expovariate(1 / self.think_s))
+
+    def run(self) -> dict:
+        chat_dir = os.path.join(self.data_dir, "chats")
+        self.chat_manager = ChatManager(chat_dir)
+        self.memory_manager = MemoryManager(os.path.join(self.data_dir, "memories.json"))
+        self.chat_store = ChatStoreWorker(self.chat_manager, self.memory_manager)
+        self.memory_manager.writer = self.chat_store.save_memories
+        self.executor = InferenceExecutor(self.model)
+
+        io_before = disk_io_bytes()
+        started = time.perf_counter()
+        self.chat_store.start()
+        self.executor.start()
+        threads = [threading.Thread(target=self._session, args=(i,), daemon=True) for i in range(self.sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        replies_done = time.perf_counter()
+
+        deadline = time.monotonic() + EXTRACTION_WAIT_S
+        for done in self.extractions:
+            done.wait(max(0.0, deadline - time.monotonic()))
+        self.executor.stop()
+        self.chat_store.stop()  # final checkpoint: its writes count towards this level's I/O
+        elapsed = time.perf_counter() - started
+        io_after = disk_io_bytes()
+        return self.report(replies_done - started, elapsed, io_before, io_after, folder_size(self.data_dir))
+
+    def report(self, reply_s: float, elapsed: float, io_before, io_after, stored_bytes: int) -> dict:
+        def ms(values, p):
+            value = percentile(values, p)
+            return round(value * 1000, 1) if value is not None else None
+
+        ttfts = [s["ttft_s"] for s in self.samples]
+        queues = [s["queue_s"] for s in self.samples]
+        latencies = [s["latency_s"] for s in self.samples]
+        tokens = sum(s["completion_tokens"] for s in self.samples)
+        record = {
+            "sessions": self.sessions,
+            "turns": len(self.samples),
+            "errors": len(self.errors),
+            "elapsed_s": round(elapsed, 2),
+            "turns_per_s": round(len(self.samples) / reply_s, 3) if reply_s > 0 else None,
+            "tokens_per_s": round(tokens / reply_s, 1) if reply_s > 0 else None,
+            "memories": len(self.memory_manager.memories)
+        }
+        for name, values in (("ttft", ttfts), ("queue", queues), ("latency", latencies), ("save", self.save_times)):
+            for p in (50, 95, 99):
+                record[f"{name}_p{p}_ms"] = ms(values, p)
+        if io_before is not None and io_after is not None:
+            record["disk_read_mb"] = round((io_after[0] - io_before[0]) / 2 ** 20, 2)
+            record["disk_write_mb"] = round((io_after[1] - io_before[1]) / 2 ** 20, 2)
+        record["stored_mb"] = round(stored_bytes / 2 ** 20, 2)
+        rss = get_rss_mb()
+        record["rss_mb"] = round(rss, 1) if rss is not None else None
+        if self.errors:
+            record["first_error"] = self.errors[0]
+        return record
+
+
+def print_table(records: list):
+    columns = [
+        ("sessions", "sessions"), ("turns", "turns"), ("turns_per_s", "turns/s"), ("tokens_per_s", "tok/s"),
+        ("ttft_p50_ms", "ttft p50"), ("ttft_p95_ms", "ttft p95"), ("ttft_p99_ms", "ttft p99"),
+        ("queue_p50_ms", "queue p50"), ("queue_p95_ms", "queue p95"), ("queue_p99_ms", "queue p99"),
+        ("save_p99_ms", "save p99"), ("disk_write_mb", "write MB"), ("disk_read_mb", "read MB")
+    ]
+    print("  ".join(f"{title:>9}" for _, title in columns) + "  note")
+    previous = None
+    for record in records:
+        cells = []
+        for key, _ in columns:
+            value = record.get(key)
+            cells.append(f"{'-' if value is None else value:>9}")
+        note = ""
+        if record["errors"]:
+            note = f"{record['errors']} errors"
+        elif previous and previous["turns_per_s"] and record["turns_per_s"] is not None:
+            gain = record["turns_per_s"] / previous["turns_per_s"] - 1
+            if gain < SATURATION_GAIN:
+                note = f"saturated ({gain:+.0%} throughput)"
+        print("  ".join(cells) + "  " + note)
+        previous = record
+    print("Times in ms. TTFT includes queueing behind other sessions; save is the caller-side cost "
+          "of ChatStoreWorker.save_chat.")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent chat sessions against one model")
+    parser.add_argument("--model", default="stub",
+                        help='Model to load: a .gguf file or a backend spec like "stub" (default) or "openai:<url>"')
+    parser.add_argument("--sessions", default=DEFAULT_SESSIONS,
+                        help=f"Comma-separated concurrency levels to run (default: {DEFAULT_SESSIONS})")
+    parser.add_argument("--turns", type=int, default=DEFAULT_TURNS, help="User messages per session")
+    parser.add_argument("--think-s", type=float, default=0.0,
+                        help="Mean pause between a reply and the next message (exponentially distributed)")
+    parser.add_argument("--ramp-s", type=float, default=0.0, help="Spread session starts over this many seconds")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--conversations", help="Batch JSONL file to take user turns from (see ai_chat_app --input)")
+    source.add_argument("--chats", help="Chat folder to replay user turns from")
+    parser.add_argument("--no-extraction", dest="extraction", action="store_false",
+                        help="Don't queue memory extraction after each message")
+    parser.add_argument("--data-dir", help="Where each level's chat folder goes (default: a temporary folder)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic conversations and think times")
+    parser.add_argument("--json", action="store_true", help="Print one JSON record per level instead of a table")
+    parser.add_argument("--gpu", dest="use_gpu", action="store_true", help="Use GPU acceleration for .gguf models")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    levels = [int(level) for level in args.sessions.split(",") if level.strip()]
+    if not levels or min(levels) < 1:
+        print("--sessions needs one or more positive numbers.", file=sys.stderr)
+        return 2
+
+    if args.conversations or args.chats:
+        conversations = recorded_conversations(args.conversations or args.chats)
+        if not conversations:
+            print("No conversations with user messages found.", file=sys.stderr)
+            return 1
+    else:
+        conversations = synthetic_conversations(max(levels), args.turns, args.seed)
+
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])  # the chat store's signals need one
+    model = load_model(args.model, args.use_gpu)
+    if model is None:
+        return 1
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="ai_chat_load_")
+    print(f"Model {model.model_id}; {len(conversations)} conversations; data in {data_dir}", file=sys.stderr)
+    records = []
+    try:
+        for sessions in levels:
+            run = LoadRun(model, conversations, sessions, args.turns, os.path.join(data_dir, f"sessions-{sessions}"),
+                          think_s=args.think_s, ramp_s=args.ramp_s, extraction=args.extraction, seed=args.seed)
+            record = run.run()
+            records.append(record)
+            if args.json:
+                print(json.dumps(record), flush=True)
+            else:
+                print(f"{sessions} sessions: {record['turns']} turns in {record['elapsed_s']}s", file=sys.stderr)
+    finally:
+        model.close()
+    if not args.json:
+        print_table(records)
+    return 0 if not any(record["errors"] for record in records) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
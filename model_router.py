@@ -0,0 +1,219 @@
+"""Latency-aware routing between several loaded models.
+
+A ModelRouter looks like one InferenceBackend. The first backend is the
+primary (largest) model and the rest are smaller ones, smallest last.
+Background jobs such as memory extraction, and requests capped at a few
+tokens, go to the smallest model. Interactive replies go to the largest
+model whose recent time-to-first-token is within the SLO, so a big model
+that slows down under load (long chats, a busy machine) is swapped for a
+smaller one until it recovers. Samples older than ROUTER_STATS_MAX_AGE_S
+are forgotten, so a downgraded model gets tried again once things calm down.
+LoRA adapters belong to the primary model, so while one is applied
+interactive replies stay there.
+"""
+import time
+import threading
+import collections
+
+from backends import InferenceBackend, CANDIDATE_MAX_TOKENS
+
+
+ROUTER_WINDOW = 20  # recent requests remembered per model
+ROUTER_MIN_SAMPLES = 3  # don't judge a model on fewer requests than this
+ROUTER_STATS_MAX_AGE_S = 120
+TTFT_SLO_S = 3.0  # interactive replies should start within this
+SHORT_REQUEST_TOKENS = 64  # requests capped at this many tokens count as short
+
+
+class LatencyStats:
+    """Rolling time-to-first-token and decode speed of one model"""
+    def __init__(self, window: int = ROUTER_WINDOW):
+        self.samples = collections.deque(maxlen=window)  # (finished_at, ttft_s, tokens_per_s)
+        self.lock = threading.Lock()
+
+    def record(self, ttft: float, completion_tokens: int, elapsed: float):
+        decode_s = elapsed - ttft
+        tokens_per_s = completion_tokens / decode_s if completion_tokens and decode_s > 0 else None
+        with self.lock:
+            self.samples.append((time.monotonic(), ttft, tokens_per_s))
+
+    def _recent(self) -> list:
+        cutoff = time.monotonic() - ROUTER_STATS_MAX_AGE_S
+        with self.lock:
+            return [sample for sample in self.samples if sample[0] >= cutoff]
+
+    def ttft_p90(self):
+        """90th percentile TTFT over recent requests, or None without enough of them"""
+        ttfts = sorted(sample[1] for sample in self._recent())
+        if len(ttfts) < ROUTER_MIN_SAMPLES:
+            return None
+        return ttfts[int(0.9 * (len(ttfts) - 1))]
+
+    def tokens_per_s(self):
+        speeds = sorted(sample[2] for sample in self._recent() if sample[2] is not None)
+        return speeds[len(speeds) // 2] if speeds else None
+
+
+class ModelRouter(InferenceBackend):
+    """Sends each request to one of several loaded backends (largest first)"""
+    def __init__(self, backends: list, background_priority: int, ttft_slo_s: float = TTFT_SLO_S):
+        super().__init__()
+        self.backends = backends
+        self.stats = [LatencyStats() for _ in backends]
+        self.background_priority = background_priority
+        self.ttft_slo_s = ttft_slo_s
+        self.interactive_choice = 0
+        self.adapter = None
+
+    @property
+    def primary(self) -> InferenceBackend:
+        return self.backends[0]
+
+    @property
+    def model_id(self) -> str:
+        # Embeddings always come from the primary model, so its document store stays valid
+        return self.primary.model_id
+
+    @property
+    def supports_json_schema(self) -> bool:
+        return all(backend.supports_json_schema for backend in self.backends)
+
+    def for_priority(self, priority: int):
+        return RoutedBackend(self, priority)
+
+    def pick(self, priority: int, max_tokens: int = None) -> int:
+        """Index of the backend for a request"""
+        smallest = len(self.backends) - 1
+        if priority >= self.background_priority or (max_tokens is not None and max_tokens <= SHORT_REQUEST_TOKENS):
+            return smallest
+        if self.adapter:
+            return 0
+
+        choice = None
+        for index, stats in enumerate(self.stats):
+            ttft = stats.ttft_p90()
+            if ttft is None or ttft <= self.ttft_slo_s:
+                choice = index
+                break
+        if choice is None:
+            # Every model is over the SLO; use whichever starts replies soonest
+            choice = min(range(len(self.stats)), key=lambda i: self.stats[i].ttft_p90())
+
+        if choice > self.interactive_choice:
+            print(f"{self.backends[self.interactive_choice].model_id} is over the {self.ttft_slo_s}s "
+                  f"time-to-first-token SLO, routing replies to {self.backends[choice].model_id}")
+        elif choice < self.interactive_choice:
+            print(f"Routing replies back to {self.backends[choice].model_id}")
+        self.interactive_choice = choice
+        return choice
+
+    def status(self) -> list:
+        """Per-model rolling latency as {"model", "ttft_p90_s", "tokens_per_s"}"""
+        return [
+            {"model": backend.model_id, "ttft_p90_s": stats.ttft_p90(), "tokens_per_s": stats.tokens_per_s()}
+            for backend, stats in zip(self.backends, self.stats)
+        ]
+
+    def tokenize(self, text: str) -> list:
+        return self.primary.tokenize(text)
+
+    def count_tokens_many(self, texts: list) -> list:
+        return self.primary.count_tokens_many(texts)
+
+    def prefill_tokens_per_s(self):
+        return self.primary.prefill_tokens_per_s()
+
+    def set_adapter(self, path: str = None, scale: float = 1.0):
+        self.primary.set_adapter(path, scale)
+        self.adapter = path
+
+    def prefill(self, messages: list, cancelled=lambda: False) -> bool:
+        # Warm the model the next interactive reply will go to
+        return self.backends[self.pick(0)].prefill(messages, cancelled)
+
+    def complete(self, messages: list, max_tokens: int = 200, temperature: float = 0.2,
+                 seed: int = None, json_schema: dict = None, checkpoint: bool = False,
+                 priority: int = 0) -> dict:
+        index = self.pick(priority, max_tokens)
+        started = time.perf_counter()
+        output = self.backends[index].complete(messages, max_tokens, temperature, seed, json_schema, checkpoint)
+        elapsed = time.perf_counter() - started
+        ttft = output.get("ttft_s")
+        self.stats[index].record(ttft if ttft is not None else elapsed, output["completion_tokens"], elapsed)
+        output["model"] = self.backends[index].model_id
+        return output
+
+    def stream(self, messages: list, max_tokens: int = 200, temperature: float = 0.2, seed: int = None,
+               priority: int = 0):
+        index = self.pick(priority, max_tokens)
+        started = time.perf_counter()
+        ttft = None
+        pieces = 0
+        for piece in self.backends[index].stream(messages, max_tokens, temperature, seed):
+            if ttft is None:
+                ttft = time.perf_counter() - started
+            pieces += 1
+            yield piece
+        elapsed = time.perf_counter() - started
+        self.stats[index].record(ttft if ttft is not None else elapsed, pieces, elapsed)
+
+    def complete_many(self, messages: list, n: int, max_tokens: int = CANDIDATE_MAX_TOKENS,
+                      temperature: float = 0.8, priority: int = 0) -> list:
+        return self.backends[self.pick(priority)].complete_many(messages, n, max_tokens, temperature)
+
+    def embed(self, texts: list):
+        return self.primary.embed(texts)
+
+    def cancel(self):
+        for backend in self.backends:
+            backend.cancel()
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+
+
+class RoutedBackend(InferenceBackend):
+    """A ModelRouter seen by one job: every call carries that job's priority"""
+    def __init__(self, router: ModelRouter, priority: int):
+        super().__init__()
+        self.router = router
+        self.priority = priority
+        self.supports_json_schema = router.supports_json_schema
+
+    @property
+    def model_id(self) -> str:
+        return self.router.model_id
+
+    def tokenize(self, text: str) -> list:
+        return self.router.tokenize(text)
+
+    def count_tokens_many(self, texts: list) -> list:
+        return self.router.count_tokens_many(texts)
+
+    def prefill_tokens_per_s(self):
+        return self.router.prefill_tokens_per_s()
+
+    def set_adapter(self, path: str = None, scale: float = 1.0):
+        self.router.set_adapter(path, scale)
+
+    def prefill(self, messages: list, cancelled=lambda: False) -> bool:
+        return self.router.prefill(messages, cancelled)
+
+    def complete(self, messages: list, max_tokens: int = 200, temperature: float = 0.2,
+                 seed: int = None, json_schema: dict = None, checkpoint: bool = False) -> dict:
+        return self.router.complete(messages, max_tokens, temperature, seed, json_schema, checkpoint,
+                                    priority=self.priority)
+
+    def stream(self, messages: list, max_tokens: int = 200, temperature: float = 0.2, seed: int = None):
+        return self.router.stream(messages, max_tokens, temperature, seed, priority=self.priority)
+
+    def complete_many(self, messages: list, n: int, max_tokens: int = CANDIDATE_MAX_TOKENS,
+                      temperature: float = 0.8) -> list:
+        return self.router.complete_many(messages, n, max_tokens, temperature, priority=self.priority)
+
+    def embed(self, texts: list):
+        return self.router.embed(texts)
+
+    def cancel(self):
+        self.router.cancel()
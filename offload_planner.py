@@ -0,0 +1,262 @@
+"""Pick n_gpu_layers / tensor_split / main_gpu so a GGUF model fits the available GPUs.
+
+Per-layer memory is estimated from the GGUF header alone (tensor offsets and
+model hyperparameters), so planning never loads the weights. Device memory can
+be detected with nvidia-smi or simulated, which keeps the planner usable and
+testable on CPU-only machines:
+
+    python offload_planner.py model.gguf --devices 8192,4096
+"""
+import os
+import re
+import struct
+import argparse
+import subprocess
+
+
+GGUF_MAGIC = b"GGUF"
+GGUF_DEFAULT_ALIGNMENT = 32
+DEVICE_RESERVE_MB = 600  # CUDA context + compute buffers left free on every device
+SIMULATED_DEVICES_ENV = "AI_CHAT_GPU_MEMORY_MB"  # e.g. "8192,4096" to fake two cards
+MB = 1024 * 1024
+
+# GGUF metadata value types -> struct format (strings and arrays are handled separately)
+_SCALAR_FORMATS = {
+    0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i",
+    6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"
+}
+_STRING = 8
+_ARRAY = 9
+
+
+def _read(f, fmt):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("Unexpected end of GGUF header")
+    return struct.unpack(fmt, data)[0]
+
+
+def _read_string(f):
+    length = _read(f, "<Q")
+    return f.read(length).decode("utf-8", errors="replace")
+
+
+def _skip_string(f):
+    f.seek(_read(f, "<Q"), os.SEEK_CUR)
+
+
+def _read_value(f, value_type):
+    """Read one metadata value. Arrays (tokenizer vocab etc.) are skipped and returned as None."""
+    if value_type in _SCALAR_FORMATS:
+        return _read(f, _SCALAR_FORMATS[value_type])
+    if value_type == _STRING:
+        return _read_string(f)
+    if value_type == _ARRAY:
+        item_type = _read(f, "<I")
+        count = _read(f, "<Q")
+        if item_type in _SCALAR_FORMATS:
+            f.seek(count * struct.calcsize(_SCALAR_FORMATS[item_type]), os.SEEK_CUR)
+        elif item_type == _STRING:
+            for _ in range(count):
+                _skip_string(f)
+        else:
+            for _ in range(count):
+                _read_value(f, item_type)
+        return None
+    raise ValueError(f"Unknown GGUF value type {value_type}")
+
+
+def read_gguf_info(model_path: str) -> dict:
+    """Read the hyperparameters and per-layer weight sizes from a GGUF file header"""
+    file_size = os.path.getsize(model_path)
+    with open(model_path, "rb") as f:
+        if f.read(4) != GGUF_MAGIC:
+            raise ValueError(f"{model_path} is not a GGUF file")
+        version = _read(f, "<I")
+        if version < 2:
+            raise ValueError(f"GGUF version {version} is not supported")
+        tensor_count = _read(f, "<Q")
+        kv_count = _read(f, "<Q")
+
+        metadata = {}
+        for _ in range(kv_count):
+            key = _read_string(f)
+            metadata[key] = _read_value(f, _read(f, "<I"))
+
+        tensors = []
+        for _ in range(tensor_count):
+            name = _read_string(f)
+            n_dims = _read(f, "<I")
+            f.seek(8 * n_dims + 4, os.SEEK_CUR)  # dims + ggml type
+            tensors.append((name, _read(f, "<Q")))
+
+        alignment = metadata.get("general.alignment") or GGUF_DEFAULT_ALIGNMENT
+        data_start = (f.tell() + alignment - 1) // alignment * alignment
+
+    # Tensor data is laid out back to back, so sizes follow from consecutive offsets
+    tensors.sort(key=lambda t: t[1])
+    data_size = file_size - data_start
+    arch = metadata.get("general.architecture", "llama")
+    block_count = metadata.get(f"{arch}.block_count") or 0
+    layer_bytes = [0] * block_count
+    output_bytes = 0
+    other_bytes = 0
+    for i, (name, offset) in enumerate(tensors):
+        end = tensors[i + 1][1] if i + 1 < len(tensors) else data_size
+        size = end - offset
+        match = re.match(r"blk\.(\d+)\.", name)
+        if match and int(match.group(1)) < block_count:
+            layer_bytes[int(match.group(1))] += size
+        elif name.startswith("output"):
+            output_bytes += size
+        else:
+            other_bytes += size
+
+    n_embd = metadata.get(f"{arch}.embedding_length") or 0
+    n_head = metadata.get(f"{arch}.attention.head_count") or 1
+    n_head_kv = metadata.get(f"{arch}.attention.head_count_kv") or n_head
+    head_dim = n_embd // n_head if n_head else 0
+    key_length = metadata.get(f"{arch}.attention.key_length") or head_dim
+    value_length = metadata.get(f"{arch}.attention.value_length") or head_dim
+
+    return {
+        "architecture": arch,
+        "block_count": block_count,
+        "layer_bytes": layer_bytes,
+        "output_bytes": output_bytes,
+        "other_bytes": other_bytes,
+        "n_embd_k": key_length * n_head_kv,
+        "n_embd_v": value_length * n_head_kv,
+        "context_length": metadata.get(f"{arch}.context_length")
+    }
+
+
+def detect_gpu_memory_mb() -> list:
+    """Free memory per GPU in MiB, from the simulation env var or nvidia-smi ([] if none)"""
+    simulated = os.environ.get(SIMULATED_DEVICES_ENV)
+    if simulated:
+        return [int(x) for x in simulated.split(",") if x.strip()]
+    try:
+        output = subprocess.run(
+            ["nvidia-smi", "--query-gpu=memory.free", "--format=csv,noheader,nounits"],
+            capture_output=True, text=True, timeout=5
+        ).stdout
+        return [int(line.strip()) for line in output.splitlines() if line.strip()]
+    except Exception:
+        return []
+
+
+def plan_offload(model_info: dict, device_memory_mb: list, n_ctx: int = 8192,
+                 kv_bytes_per_element: float = 2, reserve_mb: int = DEVICE_RESERVE_MB) -> dict:
+    """Choose how many layers to offload and how to split them across devices.
+
+    llama.cpp offloads the last n_gpu_layers layers and hands them to the
+    devices in order, in proportion to tensor_split. Once every repeating layer
+    is offloaded the output layer follows them, onto the last device. Layers
+    are split in proportion to each device's free memory, less the output layer
+    on the last one.
+    """
+    block_count = model_info["block_count"]
+    output_bytes = model_info["output_bytes"]
+    kv_layer_bytes = n_ctx * (model_info["n_embd_k"] + model_info["n_embd_v"]) * kv_bytes_per_element
+    layer_costs = [w + kv_layer_bytes for w in model_info["layer_bytes"]]
+
+    capacities = [max(0, mb - reserve_mb) * MB for mb in device_memory_mb]
+    plan = {
+        "n_gpu_layers": 0,
+        "tensor_split": None,
+        "main_gpu": 0,
+        "offloaded_layers": 0,
+        "total_layers": block_count,
+        "device_usage_mb": [0] * len(capacities)
+    }
+    if not capacities or not any(capacities) or not layer_costs:
+        return plan
+
+    main_gpu = max(range(len(capacities)), key=lambda i: capacities[i])
+    last = max(i for i, capacity in enumerate(capacities) if capacity)
+
+    def split(offloaded: int, output: bool):
+        """(layers per device, bytes per device) for the last offloaded layers, or None if they don't fit"""
+        shares = list(capacities)
+        if output:
+            shares[last] -= output_bytes
+            if shares[last] <= 0:
+                return None
+        total = sum(shares)
+        per_device = []
+        assigned = 0
+        cumulative = 0
+        for share in shares:
+            cumulative += share
+            bound = round(offloaded * cumulative / total)
+            per_device.append(bound - assigned)
+            assigned = bound
+
+        usage = []
+        start = block_count - offloaded
+        for count in per_device:
+            usage.append(sum(layer_costs[start:start + count]))
+            start += count
+        if output:
+            usage[last] += output_bytes
+        if any(used > capacity for used, capacity in zip(usage, capacities)):
+            return None
+        return per_device, usage
+
+    # Everything if it fits, otherwise as many of the last layers as fit
+    attempts = [(block_count, True)] + [(offloaded, False) for offloaded in range(block_count, 0, -1)]
+    for offloaded, output in attempts:
+        fitted = split(offloaded, output)
+        if fitted is not None:
+            break
+    else:
+        return plan
+    per_device, usage = fitted
+
+    plan.update({
+        "n_gpu_layers": -1 if output else offloaded,  # -1: everything, including the output layer
+        "main_gpu": main_gpu,
+        "offloaded_layers": offloaded,
+        "device_usage_mb": [round(u / MB) for u in usage]
+    })
+    if len(capacities) > 1:
+        # llama.cpp splits the output layer's slot too, so count it on the last device
+        units = list(per_device)
+        units[last] += output
+        plan["tensor_split"] = [count / sum(units) for count in units]
+    return plan
+
+
+def plan_for_model(model_path: str, n_ctx: int = 8192, device_memory_mb: list = None,
+                   kv_bytes_per_element: float = 2) -> dict:
+    """Read the model header, detect (or take simulated) devices and plan the offload"""
+    if device_memory_mb is None:
+        device_memory_mb = detect_gpu_memory_mb()
+    return plan_offload(read_gguf_info(model_path), device_memory_mb, n_ctx, kv_bytes_per_element)
+
+
+def describe_plan(plan: dict) -> str:
+    if plan["offloaded_layers"] == 0:
+        return "CPU only (no layers fit on the GPU)"
+    text = f"{plan['offloaded_layers']}/{plan['total_layers']} layers on GPU"
+    if plan["n_gpu_layers"] == -1:
+        text += " + output"
+    if plan["tensor_split"]:
+        text += " (split " + ", ".join(f"{s:.0%}" for s in plan["tensor_split"]) + ")"
+    return text
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan GPU offload for a GGUF model.")
+    parser.add_argument("model", help="Path to a .gguf model file")
+    parser.add_argument("--devices", help="Simulated free memory per GPU in MiB, e.g. 8192,4096")
+    parser.add_argument("--n-ctx", type=int, default=8192)
+    args = parser.parse_args()
+
+    devices = [int(x) for x in args.devices.split(",")] if args.devices else None
+    result = plan_for_model(args.model, args.n_ctx, devices)
+    print(describe_plan(result))
+    for key, value in result.items():
+        print(f"  {key}: {value}")
@@ -0,0 +1,104 @@
+"""Context shifting in LlamaCppBackend, against a fake model with a character tokenizer."""
+import re
+import unittest
+import unittest.mock
+
+import numpy as np
+
+import backends
+
+SPECIAL_TOKENS = {"<|im_start|>": 2, "<|im_end|>": 3}
+BOS = 1
+
+
+class FakeContext:
+    def __init__(self):
+        self.calls = []
+
+    def kv_cache_seq_rm(self, seq_id, p0, p1):
+        self.calls.append(("rm", p0, p1))
+
+    def kv_cache_seq_shift(self, seq_id, p0, p1, delta):
+        self.calls.append(("shift", p0, p1, delta))
+
+
+class FakeModel:
+    """One token per character, one per special token"""
+
+    def __init__(self, n_ctx: int):
+        self._n_ctx = n_ctx
+        self._ctx = FakeContext()
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+
+    @property
+    def _input_ids(self):
+        return self.input_ids[:self.n_tokens]
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> list:
+        tokens = [BOS] if add_bos else []
+        for piece in re.split(r"(<\|im_start\|>|<\|im_end\|>)", text.decode("utf-8")):
+            if piece in SPECIAL_TOKENS:
+                tokens.append(SPECIAL_TOKENS[piece])
+            else:
+                tokens.extend(ord(char) + 1000 for char in piece)
+        return tokens
+
+    def cache(self, tokens: list):
+        self.input_ids[:len(tokens)] = tokens
+        self.n_tokens = len(tokens)
+
+
+def chat(turns: int, separators: bool = False) -> list:
+    messages = [{"role": "system", "content": "Be brief."}]
+    for turn in range(turns):
+        if separators and turn % 3 == 0:
+            messages.append({"role": "separator"})
+        messages.append({"role": "user", "content": f"question {turn} " + "x" * 40})
+        messages.append({"role": "assistant", "content": f"answer {turn} " + "y" * 40})
+    return messages
+
+
+class FitContextTest(unittest.TestCase):
+    def setUp(self):
+        self.model = FakeModel(n_ctx=1200)
+        self.backend = backends.LlamaCppBackend("fake.gguf")
+        self.backend.model = self.model
+        self.backend.can_shift = True
+        self.patch = unittest.mock.patch.object(backends, "CONTEXT_SHIFT_FREE_TOKENS", 200)
+        self.patch.start()
+        self.addCleanup(self.patch.stop)
+
+    def test_tokens_match_format_chatml(self):
+        messages = chat(3, separators=True)
+        messages.insert(3, {"role": "system", "content": "ignored"})
+        messages.append({"role": "user", "content": ""})
+        tokens = self.backend._fit_context(messages, 100)[1]
+        prompt = backends.format_chatml(messages).prompt
+        self.assertEqual(tokens, self.model.tokenize(prompt.encode("utf-8"), add_bos=True, special=True))
+
+    def test_separators_do_not_stop_the_shift(self):
+        history = chat(8, separators=True)
+        # The cache holds the conversation as the last reply left it
+        generation = self.model.tokenize(backends.CHATML_GENERATION_PROMPT.encode("utf-8"), add_bos=False)
+        self.model.cache(self.backend._fit_context(history, 100)[1][:-len(generation)])
+        self.assertEqual(self.model._ctx.calls, [])
+
+        history += [{"role": "separator"}, {"role": "user", "content": "q" * 200}]
+        kept, tokens, n_keep, turn_starts = self.backend._fit_context(history, 300)
+
+        self.assertEqual([call[0] for call in self.model._ctx.calls], ["rm", "shift"])
+        self.assertNotIn("separator", [msg["role"] for msg in kept])
+        self.assertEqual(kept[1]["role"], "user")
+        # What stays cached is exactly the start of the new prompt
+        cached = self.model._input_ids.tolist()
+        self.assertGreater(len(cached), n_keep)
+        self.assertEqual(tokens[:len(cached)], cached)
+        self.assertLessEqual(len(tokens), self.model.n_ctx() - 300)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Layer offload planning against a made-up model: 32 layers of 200 MB and a 400 MB output layer."""
+import unittest
+
+import offload_planner
+
+MB = offload_planner.MB
+
+MODEL = {
+    "block_count": 32,
+    "layer_bytes": [200 * MB] * 32,
+    "output_bytes": 400 * MB,
+    "other_bytes": 100 * MB,
+    "n_embd_k": 1024,
+    "n_embd_v": 1024,
+}
+
+
+def plan(device_memory_mb: list, n_ctx: int = 0) -> dict:
+    # No reserve and no KV cache unless asked for, so the sizes stay round
+    return offload_planner.plan_offload(MODEL, device_memory_mb, n_ctx=n_ctx, reserve_mb=0)
+
+
+class PlanOffloadTest(unittest.TestCase):
+    def test_single_gpu_takes_everything(self):
+        result = plan([8192])
+        self.assertEqual(result["n_gpu_layers"], -1)
+        self.assertEqual(result["offloaded_layers"], 32)
+        self.assertIsNone(result["tensor_split"])
+        self.assertEqual(result["device_usage_mb"], [32 * 200 + 400])
+
+    def test_single_gpu_takes_the_last_layers_that_fit(self):
+        result = plan([1000])
+        self.assertEqual(result["n_gpu_layers"], 5)
+        self.assertEqual(result["offloaded_layers"], 5)
+        self.assertEqual(result["device_usage_mb"], [1000])
+
+    def test_kv_cache_counts_against_each_layer(self):
+        # 1024 tokens * 2048 elements * 2 bytes = 4 MB of KV per layer
+        self.assertEqual(plan([1000], n_ctx=1024)["n_gpu_layers"], 4)
+
+    def test_two_gpus_split_unevenly_by_capacity(self):
+        result = plan([8192, 4096])
+        self.assertEqual(result["n_gpu_layers"], -1)
+        self.assertEqual(result["main_gpu"], 0)
+        self.assertEqual(sum(result["device_usage_mb"]), 32 * 200 + 400)
+        self.assertTrue(all(used <= mb for used, mb in zip(result["device_usage_mb"], [8192, 4096])))
+        split = result["tensor_split"]
+        self.assertAlmostEqual(sum(split), 1.0)
+        self.assertGreater(split[0], split[1])
+
+    def test_two_gpus_too_small_share_the_last_layers(self):
+        result = plan([3000, 3000])
+        self.assertEqual(result["n_gpu_layers"], 30)
+        self.assertEqual(result["tensor_split"], [0.5, 0.5])
+        self.assertEqual(result["device_usage_mb"], [3000, 3000])
+
+    def test_zero_capacity_first_device_gets_nothing(self):
+        # 600 MB is exactly the default reserve, so the first card has no room
+        result = offload_planner.plan_offload(MODEL, [600, 8192], n_ctx=0)
+        self.assertEqual(result["n_gpu_layers"], -1)
+        self.assertEqual(result["main_gpu"], 1)
+        self.assertEqual(result["tensor_split"], [0.0, 1.0])
+        self.assertEqual(result["device_usage_mb"], [0, 32 * 200 + 400])
+
+    def test_output_layer_goes_on_the_last_device_with_memory(self):
+        result = offload_planner.plan_offload(MODEL, [8192, 600], n_ctx=0)
+        self.assertEqual(result["n_gpu_layers"], -1)
+        self.assertEqual(result["tensor_split"], [1.0, 0.0])
+        self.assertEqual(result["device_usage_mb"], [32 * 200 + 400, 0])
+
+    def test_output_layer_is_left_out_when_it_does_not_fit(self):
+        # Every repeating layer fits, but not the output layer as well
+        result = plan([32 * 200 + 200])
+        self.assertEqual(result["n_gpu_layers"], 32)
+        self.assertEqual(result["offloaded_layers"], 32)
+        self.assertEqual(result["device_usage_mb"], [32 * 200])
+
+    def test_cpu_only_without_usable_devices(self):
+        for devices in ([], [0], [100, 200]):
+            with self.subTest(devices=devices):
+                result = offload_planner.plan_offload(MODEL, devices, n_ctx=0)
+                self.assertEqual(result["n_gpu_layers"], 0)
+                self.assertEqual(result["offloaded_layers"], 0)
+                self.assertIsNone(result["tensor_split"])
+                self.assertEqual(result["total_layers"], 32)
+
+    def test_describe_plan(self):
+        self.assertEqual(offload_planner.describe_plan(plan([8192])), "32/32 layers on GPU + output")
+        self.assertEqual(offload_planner.describe_plan(plan([3000, 3000])), "30/32 layers on GPU (split 50%, 50%)")
+        self.assertEqual(offload_planner.describe_plan(plan([])), "CPU only (no layers fit on the GPU)")
+
+
+if __name__ == "__main__":
+    unittest.main()
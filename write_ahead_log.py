@@ -0,0 +1,163 @@
+"""Append-only journal of chat and memory changes, replayed after a crash.
+
+Every change is appended as one line, "<crc32 hex> <compact json>", before
+the JSON files it affects are rewritten. Appends are plain buffered writes
+flushed to the OS, so they survive the app dying and cost microseconds on
+the GUI thread; sync() fsyncs them from the chat store thread. A torn or
+corrupt last line (the app died mid-append) fails its checksum and replay
+stops there.
+
+A checkpoint moves the live journal aside (begin_checkpoint), writes the
+JSON files and then deletes the old journal (end_checkpoint). Changes made
+while the files are being written go to a fresh journal, so nothing logged
+is dropped before it is on disk. If the app dies mid-checkpoint, both
+journals are replayed in order on the next start, so recovery reads the
+journal once instead of trusting whichever full saves happened to finish.
+
+Every running instance appends to a journal of its own (claim_journal). At
+startup an instance also takes over every journal no running instance
+holds, so what a crashed instance logged is replayed whichever slot the
+next instance gets; the first checkpoint folds them into its own journal.
+"""
+import os
+import re
+import json
+import zlib
+import itertools
+import threading
+
+from file_lock import FileLock
+
+
+WAL_FILE = "journal.wal"  # lives inside CHAT_DIR
+JOURNAL_NAME = re.compile(r"journal(-\d+)?\.wal(\.old)?$")  # every slot, and its set-aside records
+WAL_CHECKPOINT_RECORDS = 200  # rewrite the JSON files once this many changes are logged
+WAL_CHECKPOINT_IDLE_S = 10.0  # ...or after this long without new changes
+
+
+class WriteAheadLog:
+    def __init__(self, path: str, slot_lock: FileLock = None):
+        self.path = path
+        self.slot_lock = slot_lock  # held while this instance owns the journal
+        self.old_path = path + ".old"
+        self.lock = threading.Lock()
+        self.records = 0  # appended since the last checkpoint began
+        self._file = open(self.path, "ab")
+        self._unsynced = False
+        self.orphans = []  # (path, lock) of journals left by crashed instances, until folded into this one
+
+    @staticmethod
+    def _encode(record: dict) -> bytes:
+        body = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return b"%08x " % zlib.crc32(body) + body + b"\n"
+
+    def append(self, record: dict):
+        line = self._encode(record)
+        with self.lock:
+            self._file.write(line)
+            self._file.flush()
+            self.records += 1
+            self._unsynced = True
+
+    def sync(self):
+        """fsync appended records, so they also survive a power cut"""
+        with self.lock:
+            if self._unsynced:
+                os.fsync(self._file.fileno())
+                self._unsynced = False
+
+    @staticmethod
+    def _read(path: str) -> list:
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, "rb") as f:
+            for number, line in enumerate(f, 1):
+                checksum, _, body = line.rstrip(b"\n").partition(b" ")
+                try:
+                    if not line.endswith(b"\n") or int(checksum, 16) != zlib.crc32(body):
+                        raise ValueError("checksum mismatch")
+                    records.append(json.loads(body))
+                except ValueError:
+                    print(f"Journal {os.path.basename(path)} is cut short at record {number}; "
+                          f"recovering the {len(records)} records before it")
+                    break
+        return records
+
+    def replay(self) -> list:
+        """Every intact record, oldest first"""
+        with self.lock:
+            records = self._read(self.old_path) + self._read(self.path)
+            for path, _ in self.orphans:
+                records += self._read(path + ".old") + self._read(path)
+            return records
+
+    def _fold_orphans(self):
+        """Move the records of adopted journals behind this one's set-aside records"""
+        with open(self.old_path, "ab") as old:
+            for path, _ in self.orphans:
+                for part in (path + ".old", path):
+                    # Re-encoded, so a torn line at the end of one journal can't hide the ones after it
+                    old.write(b"".join(self._encode(record) for record in self._read(part)))
+            old.flush()
+            os.fsync(old.fileno())
+        for path, orphan_lock in self.orphans:
+            for part in (path + ".old", path):
+                if os.path.exists(part):
+                    os.remove(part)
+            orphan_lock.release()
+        self.orphans = []
+
+    def begin_checkpoint(self):
+        """Set the logged records aside; new appends go to an empty journal"""
+        with self.lock:
+            self._file.close()
+            if os.path.exists(self.old_path):
+                # The previous checkpoint never finished; keep its records ahead of these
+                with open(self.old_path, "ab") as old, open(self.path, "rb") as current:
+                    old.write(current.read())
+                    old.flush()
+                    os.fsync(old.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.old_path)
+            if self.orphans:
+                self._fold_orphans()
+            self._file = open(self.path, "ab")
+            self.records = 0
+            self._unsynced = False
+
+    def end_checkpoint(self):
+        """The records set aside are now in the JSON files; drop them"""
+        with self.lock:
+            if os.path.exists(self.old_path):
+                os.remove(self.old_path)
+
+    def close(self):
+        with self.lock:
+            self._file.close()
+            for _, orphan_lock in self.orphans:
+                orphan_lock.release()
+            self.orphans = []
+        if self.slot_lock is not None:
+            self.slot_lock.release()
+
+
+def claim_journal(directory: str) -> WriteAheadLog:
+    """Open the first journal slot in directory that no running instance holds,
+    adopting the journals of every other slot nobody holds"""
+    for slot in itertools.count(1):
+        name = WAL_FILE if slot == 1 else f"journal-{slot}.wal"
+        path = os.path.join(directory, name)
+        slot_lock = FileLock(path + ".lock")
+        if slot_lock.acquire(blocking=False):
+            wal = WriteAheadLog(path, slot_lock)
+            break
+
+    orphans = {os.path.join(directory, name.removesuffix(".old"))
+               for name in os.listdir(directory) if JOURNAL_NAME.match(name)}
+    for orphan in sorted(orphans - {wal.path}):
+        orphan_lock = FileLock(orphan + ".lock")
+        if orphan_lock.acquire(blocking=False):  # otherwise a running instance owns it
+            wal.orphans.append((orphan, orphan_lock))
+    return wal